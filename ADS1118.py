@@ -1,5 +1,6 @@
 import logging.config
 from BB_SPI import SpiDev
+from Instrumentation import timed
 #from spidev import SpiDev
 import time
 
@@ -201,7 +202,8 @@ class ADS1118(object):
             # Configuration has changed, or we want a singleshot measurement.
             self.__last_cmd = [MSB, LSB, 0, 0]
             # self.__spi.mode = 0b11
-            result = self.__spi.xfer2(self.__last_cmd)
+            with timed('spi.ADS1118'):
+                result = self.__spi.xfer2(self.__last_cmd)
             assert result[2] | ((ss & 0b1) << 7) == MSB
             assert result[3] | 0b1 == LSB
             # self.__spi.mode = 0b01
@@ -233,7 +235,8 @@ class ADS1118(object):
         """
 
         # Clock out two bytes, holding MOSI/DIN low.
-        reading = self.__spi.xfer2([0x00, 0x00, 0x00, 0x00])
+        with timed('spi.ADS1118'):
+            reading = self.__spi.xfer2([0x00, 0x00, 0x00, 0x00])
         ADC = (reading[0] << 7) + reading[1]  # Shift MSB up 8 bits, add to LSB
         if (reading[0] & (0b1 << 7)) != 0:
             # Reading is negative (two's compliment)
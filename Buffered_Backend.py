@@ -0,0 +1,344 @@
+import json
+import logging.config
+import os
+from collections import deque
+from threading import Thread, Condition, Lock
+from time import sleep, time
+
+from Instrumentation import count
+from PiSmoker_Backend import PiSmoker_Backend
+from TempBatch import TempBatch
+from TemperatureSample import TemperatureSample
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+SPOOL_PATH = '/home/pi/PiSmoker/spool.jsonl'
+MAX_BUFFER = 2000  # Writes held in memory, the rest wait in the spool file only
+BATCH_SIZE = 50  # Writes delivered per worker pass
+RETRY_MIN = 1.0  # Backoff after a failed delivery, doubling up to RETRY_MAX
+RETRY_MAX = 60.0
+REPLAY_PAUSE = 0.2  # Pause between batches while catching up on a backlog, so replay does not swamp the link
+BATCHED = ('PostTemps', 'WriteControl')  # Appends to paths of their own, delivered in batches whatever their order
+MAX_ATTEMPTS = 10  # Failures of the same write before checking whether the backend is rejecting it for good
+
+
+# noinspection PyBroadException
+class Buffered_Backend(PiSmoker_Backend):
+    """Write-behind wrapper around another backend.
+
+    PostTemps, WriteControl, WriteParameters, WriteProgram and AdvanceProgram only append a line to an append-only
+    spool file and (while it has room) a bounded in-memory buffer, then return.  A worker thread delivers them to the
+    wrapped backend in order.  A write which raises or returns -1 stays at the head of the queue and is retried with
+    exponential backoff, so nothing behind it is delivered out of order or lost.  Once the buffer overflows, the
+    worker reads the backlog back from the spool instead.
+
+    A backend reports a rejected write (e.g. an HTTP 4xx) the same way as an unreachable server, so after
+    max_attempts failures of the same write the worker tries the one behind it: if that goes through, the backend is
+    up and the head write is dropped (counted as buffered.poisoned) rather than blocking everything for good.  While
+    both fail it is treated as an outage and nothing is dropped.
+
+    Temperatures are spooled as one-sample TempBatch lines.  Samples and control records only ever append to paths
+    of their own, so the ones between two other writes are delivered together however they interleave: the samples
+    through PostTempBatch(), then the control records through WriteControlBatch(), and a backlog goes out in a few
+    compact requests.  With linger set, the worker also holds new writes back for up to that long to batch them in
+    steady state.
+
+    The position of the last delivered write is kept next to the spool, so writes still pending when the process
+    stops are replayed on the next start.  So are the samples already delivered ahead of control records which keep
+    failing: they are skipped on retries and replays rather than sent twice.  The spool is truncated whenever
+    everything in it has been delivered.
+
+    Reads go straight to the wrapped backend.
+    """
+    backend = None  # type: PiSmoker_Backend
+    _buffer = None  # type: deque
+    _cond = None  # type: Condition
+    _spool_lock = None  # type: Lock
+
+    def __init__(self, backend, spool_path=SPOOL_PATH, max_buffer=MAX_BUFFER, batch_size=BATCH_SIZE, linger=0,
+                 max_attempts=MAX_ATTEMPTS):
+        """
+
+        @param backend: Backend to deliver to, e.g. Firebase_Backend created with async=False so failures are seen
+        @type backend: PiSmoker_Backend
+        @param linger: [Optional] Seconds to hold new writes back so more of them go in one delivery
+        @type linger: float
+        @param max_attempts: Failures of one write before it may be dropped as rejected
+        @type max_attempts: int
+        """
+        self.backend = backend
+        self.spool_path = spool_path
+        self.pos_path = spool_path + '.pos'
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self._failures = 0  # Consecutive failed attempts at the write at the head of the queue
+        self._since = 0  # When the buffer last went from empty to holding a write
+        self._buffer = deque()  # (end offset in spool, method, args)
+        self._cond = Condition()
+        self._spool_lock = Lock()  # Spool appends and truncation, so the buffer is never held up by the disk
+        self._backoff = RETRY_MIN
+
+        self._spool = open(spool_path, 'ab')
+        self._spool.seek(0, os.SEEK_END)
+        self._write_pos = self._spool.tell()
+        if self._write_pos and not self._ends_with_newline():
+            # Torn last line from a crash: terminate it so the next write starts on a line of its own
+            self._spool.write('\n')
+            self._spool.flush()
+            self._write_pos += 1
+        pos, sent = self._load_pos()
+        self._read_pos = min(pos, self._write_pos)
+        # Spool offsets of samples delivered while the control records spooled with them were not
+        self._sent = set(end for end in sent if self._read_pos < end <= self._write_pos)
+        self._spilled = self._read_pos < self._write_pos  # Undelivered writes from a previous run
+        if self._spilled:
+            logger.info('Replaying %i bytes of spooled writes', self._write_pos - self._read_pos)
+
+        self._worker = Thread(target=self._deliver_loop, name='BufferedBackend')
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def __getattr__(self, item):
+        # Anything else (e.g. ReadTemps, flush) is the wrapped backend's
+        return getattr(self.backend, item)
+
+    # Spool
+    def _load_pos(self):
+        """
+        @return: Position of the last delivered write, and the samples delivered beyond it
+        @rtype: (int, set)
+        """
+        try:
+            with open(self.pos_path) as f:
+                fields = f.read().split()
+            return (int(fields[0]) if fields else 0), set(int(end) for end in fields[1:])
+        except (IOError, ValueError):
+            return 0, set()
+
+    def _ends_with_newline(self):
+        with open(self.spool_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == '\n'
+
+    def _save_pos(self, pos):
+        tmp = self.pos_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(' '.join(str(end) for end in [pos] + sorted(self._sent)))
+        os.rename(tmp, self.pos_path)
+
+    def _checkpoint(self, pos):
+        try:
+            self._save_pos(pos)
+        except (IOError, OSError) as e:
+            # Disk trouble (e.g. a full SD card): keep delivering, a restart may replay some writes
+            count('buffered.spool_errors')
+            logger.info('Error updating spool position (%s)', e)
+
+    def _enqueue(self, method, *args):
+        line = json.dumps([method, args]) + '\n'
+        with self._spool_lock:
+            try:
+                self._spool.write(line)
+                self._spool.flush()
+            except IOError as e:
+                # Disk trouble: keep going in memory only
+                count('buffered.spool_errors')
+                logger.info('Error writing spool (%s)', e)
+            with self._cond:
+                self._write_pos += len(line)
+                if not self._spilled and len(self._buffer) < self.max_buffer:
+                    if not self._buffer:
+                        self._since = time()
+                    self._buffer.append((self._write_pos, method, args))
+                else:
+                    self._spilled = True
+                    count('buffered.spilled')
+                self._cond.notify()
+
+    def _truncate(self):
+        """Empty the spool if everything in it has been delivered.
+
+        @return: True if it was emptied
+        """
+        with self._spool_lock:
+            with self._cond:
+                if self._buffer or self._spilled or self._read_pos != self._write_pos:
+                    return False
+            try:
+                self._spool.truncate(0)
+            except (IOError, OSError) as e:
+                count('buffered.spool_errors')
+                logger.info('Error truncating spool (%s)', e)
+                return False
+            with self._cond:
+                self._read_pos = self._write_pos = 0
+            return True
+
+    def _refill(self):
+        """Load the next writes from the spool into the buffer (called with the lock held)."""
+        with open(self.spool_path, 'rb') as f:
+            f.seek(self._read_pos)
+            end = self._read_pos
+            while len(self._buffer) < self.max_buffer and end < self._write_pos:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break
+                end += len(line)
+                try:
+                    method, args = json.loads(line)
+                except ValueError:
+                    count('buffered.corrupt')
+                    continue  # Torn line from a crash
+                self._buffer.append((end, method, args))
+        if end >= self._write_pos:
+            self._spilled = False
+        elif not self._buffer:
+            # Nothing readable up to the end of the spool: skip over it rather than stall forever
+            self._read_pos = end
+            self._spilled = end < self._write_pos
+
+    def pending(self):
+        """Writes waiting in memory, and bytes of spool not yet delivered."""
+        with self._cond:
+            return len(self._buffer), self._write_pos - self._read_pos
+
+    # Delivery
+    @staticmethod
+    def _groups(batch):
+        """Split a batch into deliveries: runs of PostTemps and WriteControl go together, anything else on its own."""
+        group = []
+        for item in batch:
+            if group and (item[1] not in BATCHED or group[-1][1] not in BATCHED):
+                yield group
+                group = []
+            group.append(item)
+        if group:
+            yield group
+
+    def _pop(self, group):
+        """Remove a delivered (or dropped) group from the head of the buffer."""
+        last = group[-1][0]
+        with self._cond:
+            while self._buffer and self._buffer[0][0] <= last:
+                self._buffer.popleft()
+        self._sent = set(end for end in self._sent if end > last)
+
+    def _deliver(self, group):
+        end, method, args = group[0]
+        if method not in BATCHED:
+            return getattr(self.backend, method)(*args)
+        temps = TempBatch()
+        for end, method, args in group:
+            if method != 'PostTemps' or end in self._sent:
+                continue
+            try:
+                if len(args) == 1:
+                    temps.extend(TempBatch.from_text(args[0]))
+                else:
+                    # Spooled as (target, sample dict) by an older version
+                    temps.append(args[0], TemperatureSample.from_dict(args[1]))
+            except (ValueError, TypeError, AttributeError, IndexError):
+                count('buffered.corrupt')
+        controls = [args[0] for end, method, args in group if method == 'WriteControl']
+        if len(temps):
+            if self.backend.PostTempBatch(temps) == -1:
+                return -1
+            if controls:
+                # Delivered: remember them, so a failure of the controls does not send them again (nor a restart)
+                self._sent.update(end for end, method, args in group if method == 'PostTemps')
+                self._checkpoint(self._read_pos)
+        if controls:
+            return self.backend.WriteControlBatch(controls)
+
+    def _attempt(self, group):
+        """
+        @return: True if the group was delivered
+        """
+        try:
+            return self._deliver(group) != -1
+        except Exception:
+            logger.exception('Error delivering %s', group[0][1])
+            return False
+
+    def _deliver_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._spilled:
+                    self._cond.wait()
+                while self.linger and not self._spilled and len(self._buffer) < self.batch_size:
+                    remaining = self._since + self.linger - time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._buffer:
+                    self._refill()
+                batch = [self._buffer[i] for i in range(min(self.batch_size, len(self._buffer)))]
+
+            failed = False
+            delivered = self._read_pos
+            groups = deque(self._groups(batch))
+            while groups:
+                group = groups.popleft()
+                if not self._attempt(group):
+                    self._failures += 1
+                    if self._failures < self.max_attempts or not groups or not self._attempt(groups[0]):
+                        failed = True
+                        break
+                    # The write behind it went through, so the backend is up and rejecting this one, which would
+                    # otherwise block everything behind it for good: drop it
+                    count('buffered.poisoned', len(group))
+                    logger.warning('Dropping %s after %i failed attempts', group[0][1], self._failures)
+                    self._pop(group)
+                    group = groups.popleft()
+                self._failures = 0
+                delivered = group[-1][0]
+                self._pop(group)
+                count('buffered.delivered', len(group))
+
+            with self._cond:
+                moved = delivered != self._read_pos
+                self._read_pos = delivered
+                backlog = len(self._buffer) or self._spilled
+            # The spool files are only touched once the lock is released: appends and pending() never wait on them
+            if not backlog and self._truncate():
+                moved = True
+            if moved:
+                self._checkpoint(self._read_pos)
+
+            if failed:
+                count('buffered.retries')
+                logger.info('Backend write failed, retrying in %.0f s', self._backoff)
+                sleep(self._backoff)
+                self._backoff = min(self._backoff * 2, RETRY_MAX)
+            else:
+                self._backoff = RETRY_MIN
+                if backlog:
+                    sleep(REPLAY_PAUSE)
+
+    # PiSmoker_Backend
+    def PostTemps(self, target_temp, Ts):
+        self._enqueue('PostTemps', TempBatch([(target_temp, Ts)]).to_text())
+
+    def WriteControl(self, D):
+        self._enqueue('WriteControl', D)
+
+    def WriteParameters(self, Parameters):
+        self._enqueue('WriteParameters', dict(Parameters))
+
+    def WriteProgram(self, Program):
+        self._enqueue('WriteProgram', list(Program))
+
+    def AdvanceProgram(self, Program):
+        self._enqueue('AdvanceProgram', list(Program))
+
+    def ReadParameters(self):
+        return self.backend.ReadParameters()
+
+    def ReadProgram(self, run_program):
+        return self.backend.ReadProgram(run_program)
+
+    def Subscribe(self, on_parameters, on_program=None):
+        return self.backend.Subscribe(on_parameters, on_program)
@@ -0,0 +1,222 @@
+import logging.config
+from collections import deque
+from threading import Thread, Condition
+from time import sleep, time
+
+from Instrumentation import count
+from PiSmoker_Backend import PiSmoker_Backend
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+MAX_PENDING = 1000  # Writes queued per sink
+RETRY_DELAY = 1.0  # First retry delay, doubling per attempt
+
+# What a sink does with a new write when its queue is full
+DROP_NEWEST = 'newest'  # Refuse the new write (keeps the history intact, e.g. for a log)
+DROP_OLDEST = 'oldest'  # Discard the oldest queued write (keeps the latest state, e.g. for a live view)
+# Only appends may be dropped: parameter patches and program writes are never resent, so losing one would leave
+# the sink out of step for the rest of the cook.  They are always queued, over max_pending if need be.
+DROPPABLE = ('PostTemps', 'PostTempBatch', 'WriteControl', 'WriteControlBatch')
+
+
+def merge_parameters(*sources):
+    """Merge parameter changes read from several sources in one pass.
+
+    Sources are given highest precedence first; a key set by several sources takes the value from the first one.
+    PiSmoker.UpdateParameters() puts LCD input ahead of the backend (someone at the smoker beats the web UI), and
+    Composite_Backend.ReadParameters() orders its sinks as listed.
+
+    @param sources: Parameter dictionaries (None or empty for a source with nothing new)
+    @rtype: dict
+    """
+    merged = {}
+    for source in reversed(sources):
+        merged.update(source or {})
+    return merged
+
+
+class Sink(object):
+    """One child backend of a Composite_Backend, with its own queue, worker thread and policy."""
+    backend = None  # type: PiSmoker_Backend
+    _queue = None  # type: deque
+    _cond = None  # type: Condition
+
+    def __init__(self, backend, name, max_pending=MAX_PENDING, overflow=DROP_OLDEST, retries=0,
+                 retry_delay=RETRY_DELAY, read=True):
+        """
+
+        @param backend: Child backend
+        @type backend: PiSmoker_Backend
+        @param name: Used in log messages and counters (composite.<name>.dropped etc.)
+        @type name: str
+        @param max_pending: Writes queued before the overflow policy applies
+        @param overflow: DROP_NEWEST or DROP_OLDEST, applied to DROPPABLE writes only
+        @param retries: Times a write which raises or returns -1 is retried (with backoff) before it is dropped
+        @param read: Read parameters and programs from this sink
+        @type read: bool
+        """
+        if overflow not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self.backend = backend
+        self.name = name
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.read = read
+        self._queue = deque()
+        self._cond = Condition()
+        self._busy = False
+
+        self._worker = Thread(target=self._write_loop, name='Sink-%s' % name)
+        self._worker.setDaemon(True)
+        self._worker.start()
+
+    def submit(self, method, *args):
+        with self._cond:
+            if len(self._queue) >= self.max_pending:
+                oldest = None
+                if self.overflow == DROP_OLDEST:
+                    oldest = next((i for i, (queued, _) in enumerate(self._queue) if queued in DROPPABLE), None)
+                if oldest is not None:
+                    count('composite.%s.dropped' % self.name)
+                    del self._queue[oldest]
+                elif method in DROPPABLE:
+                    count('composite.%s.dropped' % self.name)
+                    return
+            self._queue.append((method, args))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue) + self._busy
+
+    def join(self, timeout=None):
+        """Wait until everything queued so far has been written (or dropped).
+
+        @return: True if the queue drained in time
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                method, args = self._queue.popleft()
+                self._busy = True
+            try:
+                self._write(method, args)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    # noinspection PyBroadException
+    def _write(self, method, args):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                if getattr(self.backend, method)(*args) != -1:
+                    count('composite.%s.written' % self.name)
+                    return
+            except Exception:
+                logger.exception('Error in %s.%s', self.name, method)
+            if attempt < self.retries:
+                count('composite.%s.retries' % self.name)
+                sleep(delay)
+                delay *= 2
+        count('composite.%s.failed' % self.name)
+        logger.info('%s.%s failed, dropping it', self.name, method)
+
+
+# noinspection PyBroadException
+class Composite_Backend(PiSmoker_Backend):
+    """Fan-out backend: every write goes to all of its sinks, e.g. local SQLite, Firebase and a metrics store.
+
+    Each Sink has its own queue and worker thread, so writes return at once and a slow or unreachable sink only
+    backs up (and eventually drops, per its overflow policy) its own queue.  Failed writes are retried per sink.
+
+    Reads go to the sinks with read=True, on the caller's thread, in the order the sinks were given, which is also
+    their precedence: parameters are merged with merge_parameters(), and the first sink returning a program wins.
+    """
+    sinks = None  # type: [Sink, ...]
+
+    def __init__(self, sinks):
+        """
+
+        @param sinks: Sinks, highest read precedence first
+        @type sinks: [Sink, ...]
+        """
+        self.sinks = list(sinks)
+
+    def _submit(self, method, *args):
+        for sink in self.sinks:
+            sink.submit(method, *args)
+
+    def _readers(self):
+        return [sink for sink in self.sinks if sink.read]
+
+    def pending(self):
+        """Writes not yet delivered, per sink name."""
+        return {sink.name: sink.pending() for sink in self.sinks}
+
+    def join(self, timeout=None):
+        """Wait for all sinks to catch up.  Returns True if they all did in time."""
+        deadline = None if timeout is None else time() + timeout
+        return all([sink.join(None if deadline is None else max(deadline - time(), 0)) for sink in self.sinks])
+
+    # PiSmoker_Backend
+    def PostTemps(self, target_temp, Ts):
+        self._submit('PostTemps', target_temp, Ts)
+
+    def PostTempBatch(self, batch):
+        self._submit('PostTempBatch', batch)
+
+    def WriteControl(self, D):
+        self._submit('WriteControl', D)
+
+    def WriteControlBatch(self, Ds):
+        self._submit('WriteControlBatch', list(Ds))
+
+    def WriteParameters(self, Parameters):
+        self._submit('WriteParameters', dict(Parameters))
+
+    def WriteProgram(self, Program):
+        self._submit('WriteProgram', list(Program))
+
+    def AdvanceProgram(self, Program):
+        self._submit('AdvanceProgram', list(Program))
+
+    def ReadParameters(self):
+        results = []
+        for sink in self._readers():
+            try:
+                results.append(sink.backend.ReadParameters())
+            except Exception:
+                logger.info('Error reading parameters from %s', sink.name)
+        return merge_parameters(*results)
+
+    def ReadProgram(self, run_program):
+        for sink in self._readers():
+            try:
+                Program = sink.backend.ReadProgram(run_program)
+            except Exception:
+                logger.info('Error reading Program from %s', sink.name)
+                continue
+            if Program:
+                return Program
+        return None
+
+    def Subscribe(self, on_parameters, on_program=None):
+        """Subscribe to every reading sink which can push changes.  Pushed changes arrive one source at a time, so
+        they are passed on as they come rather than merged."""
+        return any([sink.backend.Subscribe(on_parameters, on_program) for sink in self._readers()])
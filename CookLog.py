@@ -0,0 +1,251 @@
+import logging.config
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from math import isinf, isnan
+from time import time
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+COOKLOG_PATH = '/home/pi/PiSmoker/cooklog'
+SEGMENT_RECORDS = 1 << 16  # Records per preallocated segment file (2 MiB, about two days of a cook)
+INDEX_STRIDE = 64  # Records per sparse index entry
+RETENTION = 30 * 86400  # Segments whose records are all older than this (s) are deleted
+
+# Record kinds
+SAMPLE = 1  # v = target, grill, meat, firebox, ambient
+CONTROL = 2  # flags = mode index (PiSmoker_Parameters.MODES), v = u, P, I, D, Estimate
+RELAY = 3  # flags = relay index (RELAYS), v[0] = new state
+KINDS = (SAMPLE, CONTROL, RELAY)
+RELAYS = ('auger', 'fan', 'igniter')
+
+# time (s), kind, flags, sequence number (low 16 bits, for tail recovery), five values (NaN when missing)
+RECORD = struct.Struct('<dBBH5f')
+NAN = float('nan')
+DTYPE = [('time', '<f8'), ('kind', 'u1'), ('flags', 'u1'), ('seq', '<u2'), ('v', '<f4', (5,))]
+
+
+def _segment_name(first):
+    return '%012i.seg' % first
+
+
+class CookLog(object):
+    """Append-only binary log of a cook: temperature samples, controller state and relay events.
+
+    Fixed size records (RECORD, 32 bytes) go into segment files preallocated to SEGMENT_RECORDS records and mapped
+    with mmap, so an append is one struct.pack_into() into memory; the kernel writes the pages back.  A process crash
+    loses nothing that was appended; after a power cut the tail is recovered on open: unused space is all zeros, so
+    the end of the log is found by binary search, and trailing records whose sequence number or contents do not
+    check out are discarded.
+
+    Every INDEX_STRIDE-th record's time is kept in a sparse index (rebuilt on open with one read per stride), so
+    range() finds its start by bisection and reads at most a stride or two it does not need.  Records are expected in
+    (roughly) time order, as the controller writes them.
+
+    Records keep their numbers for the life of the log.  Once a segment's records are all older than the retention
+    period it is deleted, on open and whenever a new segment is started, so the log holds the last few weeks of cooks
+    rather than filling the SD card.
+
+    Files are plain arrays of RECORD; arrays() maps them as NumPy record arrays without copying, for analysis.
+    """
+    _segments = None  # type: [(int, mmap.mmap), ...]
+    _index_times = None  # type: [float, ...]
+    first = 0  # Number of the oldest record kept
+    count = 0  # Number of the next record
+
+    def __init__(self, path=COOKLOG_PATH, segment_records=SEGMENT_RECORDS, retention=RETENTION):
+        """
+
+        @param path: Directory holding the segment files
+        @type path: str
+        @param segment_records: Records per new segment
+        @type segment_records: int
+        @param retention: Seconds of records to keep (None keeps everything)
+        @type retention: float
+        """
+        self.path = path
+        self.segment_records = segment_records
+        self.retention = retention
+        self._segments = []  # (first record number, mmap)
+        self._index_times = []
+        self._index_first = 0  # Record number of the first index entry
+        self._mm = None
+        self._pos = 0  # Next record in the current segment
+        self._capacity = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        names = sorted(name for name in os.listdir(path) if name.endswith('.seg'))
+        for name in names:
+            first = int(name[:-len('.seg')])
+            if not self._segments:
+                # Older segments may have been deleted
+                self.first = self.count = first
+                self._index_first = first + -first % INDEX_STRIDE
+            elif first != self.count:
+                logger.warning('Cook log segment %s does not follow record %i, ignoring the rest', name, self.count)
+                break
+            self._map(first, name)
+            self._pos = self._recover() if name == names[-1] else self._capacity
+            self.count = first + self._pos
+            # Index entries are every INDEX_STRIDE-th record of the whole log, as append() makes them
+            for n in range(first + -first % INDEX_STRIDE, self.count, INDEX_STRIDE):
+                self._index_times.append(self._time(self._mm, n - first))
+        if self._segments:
+            logger.info('Cook log %s: %i records', path, self.count - self.first)
+            self._expire(time())
+
+    # Segments
+    def _map(self, first, name):
+        with open(os.path.join(self.path, name), 'r+b') as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        self._capacity = len(self._mm) // RECORD.size
+        self._segments.append((first, self._mm))
+
+    def _new_segment(self):
+        name = _segment_name(self.count)
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.truncate(self.segment_records * RECORD.size)  # Sparse zeros, so unused records read as empty
+        self._map(self.count, name)
+        self._pos = 0
+
+    def _expire(self, now):
+        """Delete the oldest segments while every record in them is older than the retention period."""
+        while self.retention and len(self._segments) > 1:
+            first, mm = self._segments[0]
+            if self._time(mm, len(mm) // RECORD.size - 1) >= now - self.retention:
+                break
+            os.remove(os.path.join(self.path, _segment_name(first)))
+            # Readers may still be going through the old list and mapping: replace rather than mutate or close them
+            self.first = self._segments[1][0]
+            self._segments = self._segments[1:]
+            expired = max(0, -(-(self.first - self._index_first) // INDEX_STRIDE))
+            self._index_times = self._index_times[expired:]
+            self._index_first += expired * INDEX_STRIDE
+            logger.info('Cook log: deleted segment %s', _segment_name(first))
+
+    @staticmethod
+    def _time(mm, i):
+        return struct.unpack_from('<d', mm, i * RECORD.size)[0]
+
+    @staticmethod
+    def _valid(mm, i, first):
+        t, kind, flags, seq = RECORD.unpack_from(mm, i * RECORD.size)[:4]
+        return kind in KINDS and seq == (first + i) & 0xffff and t > 0 and not isnan(t) and not isinf(t)
+
+    def _recover(self):
+        """Find the end of the last segment, dropping a damaged tail.  Returns the number of good records."""
+        mm, first = self._mm, self._segments[-1][0]
+        lo, hi = 0, self._capacity
+        while lo < hi:  # First record whose kind byte is still zero
+            mid = (lo + hi) // 2
+            if ord(mm[mid * RECORD.size + 8]):
+                lo = mid + 1
+            else:
+                hi = mid
+        n = lo
+        # Walk back to the last record which checks out; appends are ordered, so that is where the log ends
+        good = n
+        while good > 0 and not self._valid(mm, good - 1, first):
+            good -= 1
+        if good < n or mm[n * RECORD.size:(n + 1) * RECORD.size].strip('\0'):
+            logger.warning('Cook log: discarding damaged records after %i', first + good)
+            mm[good * RECORD.size:] = '\0' * (len(mm) - good * RECORD.size)
+        return good
+
+    # Writing
+    def append(self, kind, t, v0=NAN, v1=NAN, v2=NAN, v3=NAN, v4=NAN, flags=0):
+        """
+        @param kind: SAMPLE, CONTROL or RELAY
+        @param t: time()
+        @param v0: Values as listed for the kind (NaN, not None, when missing)
+        """
+        if self._pos >= self._capacity:
+            self._new_segment()
+            self._expire(t)
+        if not self.count % INDEX_STRIDE:
+            self._index_times.append(t)
+        RECORD.pack_into(self._mm, self._pos * RECORD.size, t, kind, flags, self.count & 0xffff, v0, v1, v2, v3, v4)
+        self._pos += 1
+        self.count += 1
+
+    def log_sample(self, target, Ts):
+        """
+        @type Ts: TemperatureSample.TemperatureSample
+        """
+        self.append(SAMPLE, Ts.time, target,
+                    NAN if Ts.grill is None else Ts.grill, NAN if Ts.meat is None else Ts.meat,
+                    NAN if Ts.firebox is None else Ts.firebox, NAN if Ts.ambient is None else Ts.ambient)
+
+    def log_control(self, t, mode, u, P, I, D, Estimate):
+        self.append(CONTROL, t, u, P, I, D, NAN if Estimate is None else Estimate, flags=mode)
+
+    def log_relay(self, t, relay_id, state):
+        self.append(RELAY, t, float(state), flags=RELAYS.index(relay_id))
+
+    def flush(self):
+        """Write the current segment's dirty pages to disk (only needed against power loss)."""
+        if self._mm is not None:
+            self._mm.flush()
+
+    def close(self):
+        self.flush()
+        for first, mm in self._segments:
+            mm.close()
+        self._segments = []
+        self._mm = None
+
+    def __len__(self):
+        return self.count - self.first
+
+    # Reading
+    def __getitem__(self, n):
+        """Record n as a tuple (time, kind, flags, seq, v0..v4)."""
+        if not self.first <= n < self.count:
+            raise IndexError(n)
+        i = bisect_right([first for first, mm in self._segments], n) - 1
+        first, mm = self._segments[i]
+        return RECORD.unpack_from(mm, (n - first) * RECORD.size)
+
+    def range(self, start, end=None, kind=None):
+        """Records with start <= time <= end (and of one kind, if given).
+
+        @rtype: [tuple, ...]
+        """
+        index_times, index_first, segments = self._index_times, self._index_first, self._segments
+        block = max(bisect_right(index_times, start) - 2, 0)  # One block of slack for out of order times
+        stop = self.count
+        if end is not None:
+            stop = index_first + min(bisect_right(index_times, end) + 1, len(index_times)) * INDEX_STRIDE
+        records = []
+        n = index_first + block * INDEX_STRIDE if block else self.first
+        for first, mm in segments:
+            last = min(first + len(mm) // RECORD.size, stop, self.count)
+            while first <= n < last:
+                record = RECORD.unpack_from(mm, (n - first) * RECORD.size)
+                if record[0] >= start and (end is None or record[0] <= end) and (kind is None or record[1] == kind):
+                    records.append(record)
+                n += 1
+        return records
+
+
+def arrays(path=COOKLOG_PATH):
+    """Map a cook log's segments as NumPy record arrays (DTYPE), without copying, trimmed to the records written.
+
+    NumPy is only needed for this, e.g. on the machine doing the analysis:
+    >>> samples = numpy.concatenate(arrays())
+    >>> samples = samples[samples['kind'] == SAMPLE]
+
+    @rtype: [numpy.ndarray, ...]
+    """
+    import numpy
+
+    segments = []
+    for name in sorted(name for name in os.listdir(path) if name.endswith('.seg')):
+        records = numpy.memmap(os.path.join(path, name), dtype=DTYPE, mode='r')
+        empty = numpy.flatnonzero(records['kind'] == 0)
+        segments.append(records[:empty[0]] if len(empty) else records)
+    return segments
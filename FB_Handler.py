@@ -1,7 +1,10 @@
-from firebase import FirebaseAuthentication, FirebaseApplication
-from time import time
 import logging.config
+from threading import Lock
+from time import time
+
+from FirebaseClient import FirebaseClient, FirebaseStream, NOT_MODIFIED, push_id
 from PiSmoker_Backend import PiSmoker_Backend
+from TempBatch import TempBatch
 
 logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
 logger = logging.getLogger(__name__)
@@ -9,8 +12,7 @@ logger = logging.getLogger(__name__)
 
 # noinspection PyBroadException
 class Firebase_Backend(PiSmoker_Backend):
-    firebase_inst = None
-    """@type self.firebase_inst: firebase"""
+    client = None  # type: FirebaseClient
     fb_params = {'print': 'silent'}
     _polling_interval = 3  # Frequency to poll web for new parameters
     _read_program_interval = 60  # Frequency to poll web for new program
@@ -19,51 +21,110 @@ class Firebase_Backend(PiSmoker_Backend):
     _last_read_parameters = time()
     _last_write_program = time()
     _last_read_program = time()
+    _program_running = False
     _last_write_control = time()
     _last_read_control = time()
     _do_async = True
+    compact = False
     _init_args = None
     _init_kwargs = None
+    _batch = None  # type: dict
+    _batch_lock = None  # type: Lock
+    _flush_pending = False
+    _parameter_stream = None  # type: FirebaseStream
+    _program_stream = None  # type: FirebaseStream
+    _program = ()  # [(push id, step), ...] as last written to or read from /Program
+    _program_etag = None
+
+    def __init__(self, app_url, auth_secret, async=True, compact=False, *args, **kwargs):
+        """
 
-    def __init__(self, app_url, auth_secret, async=True, *args, **kwargs):
-        auth = FirebaseAuthentication(secret=auth_secret, email='pismoker@shimavak.net')
-        self.firebase_inst = FirebaseApplication(app_url, authentication=auth)
+        @param compact: Upload temperatures as TempBatch blobs under /TempBatches instead of one /Temps child per
+        sample: about a tenth of the bytes, for metered links.  The web UI only plots /Temps.
+        @type compact: bool
+        """
+        self.client = FirebaseClient(app_url, auth=auth_secret.strip(), **kwargs)
         self._do_async = async
+        self.compact = compact
         self._init_args = args
         self._init_kwargs = kwargs
+        self._batch = {}
+        self._batch_lock = Lock()
 
     def _get(self, url):
-        return
-        return self.firebase_inst.get(url=url, name=None, connection=None, params=self.fb_params)
+        return self.client.get(url)
 
     def _post(self, url, data):
-        return
-        return self.firebase_inst.post(url=url, data=data, connection=None, params=self.fb_params)
+        return self.client.post(url, data, params=self.fb_params)
 
     def _post_async(self, url, data):
-        return
-        return self.firebase_inst.post_async(url, data, params=self.fb_params, callback=self.PostCallback)
+        return self._stream(url, data)
 
     def _patch(self, url, data):
-        return
-        return self.firebase_inst.patch(url=url, data=data, connection=None, params=self.fb_params)
+        return self.client.patch(url, data, params=self.fb_params)
 
     def _patch_async(self, url, data):
-        return
-        return self.firebase_inst.patch_async(url=url, data=data, callback=self.PostCallback, params=self.fb_params)
+        return self.client.submit(self._patch, url, data)
 
     def _delete(self, url, name):
-        return
-        return self.firebase_inst.delete(url=url, name=name, connection=None, params=self.fb_params)
+        return self.client.delete('%s/%s' % (url.rstrip('/'), name))
 
     def _put(self, url, name, data):
-        return
-        return self.firebase_inst.put(url=url, name=name, data=data, connection=None, params=self.fb_params)
+        return self.client.put('%s/%s' % (url.rstrip('/'), name), data, params=self.fb_params)
+
+    def _stream(self, url, data):
+        """Append data under a new push id at url (like POST), batching with other pending appends.
+
+        Appends to /Temps and /Controls queue up while a request is in flight and are then sent together as one
+        multi-location PATCH, so a round trip carries every sample taken meanwhile.  Push ids are generated here, so
+        the web UI sees the same ordered children a POST would have made.
+        """
+        with self._batch_lock:
+            self._batch['%s/%s' % (url.strip('/'), push_id())] = data
+            schedule = not self._flush_pending
+            self._flush_pending = True
+        if not self._do_async:
+            return self._flush_stream()
+        if schedule:
+            return self.client.submit(self._flush_stream)
+
+    def _flush_stream(self):
+        with self._batch_lock:
+            batch, self._batch = self._batch, {}
+            self._flush_pending = False
+        if batch:
+            return self.client.patch('/', batch, params=self.fb_params)
 
     def PostTemps(self, target_temp, Ts):
+        if self.compact:
+            return self.PostTempBatch(TempBatch([(target_temp, Ts)]))
         T = super(Firebase_Backend, self).PostTemps(target_temp, Ts)
         try:
-            return self._post_async('/Temps', T)
+            if self._do_async:
+                return self._post_async('/Temps', T)
+            return self._post('/Temps', T)
+        except:
+            logger.info('Error writing Temps to Firebase')
+            return -1
+
+    def _post_temp_batch(self, batch):
+        if self.compact:
+            return self._post('/TempBatches', {'time': batch.rows[0][1].time * 1000, 'n': len(batch),
+                                               'data': batch.to_text()})
+        T = {}
+        for target_temp, Ts in batch:
+            T['Temps/%s' % push_id()] = super(Firebase_Backend, self).PostTemps(target_temp, Ts)
+        return self.client.patch('/', T, params=self.fb_params)
+
+    def PostTempBatch(self, batch):
+        """Post several samples in one request: a single TempBatch when compact, otherwise one multi-location PATCH
+        adding a /Temps child per sample."""
+        if not len(batch):
+            return
+        try:
+            if self._do_async:
+                return self.client.submit(self._post_temp_batch, batch)
+            return self._post_temp_batch(batch)
         except:
             logger.info('Error writing Temps to Firebase')
             return -1
@@ -108,12 +169,33 @@ class Firebase_Backend(PiSmoker_Backend):
 
     def WriteParameters(self, Parameters):
         if self._do_async:
-            self._WriteParameters_async(Parameters)
+            return self._WriteParameters_async(Parameters)
         else:
-            self._WriteParameters_sync(Parameters)
+            return self._WriteParameters_sync(Parameters)
+
+    def Subscribe(self, on_parameters, on_program=None):
+        """Stream /Parameters (and /Program) from Firebase instead of polling them.
+
+        on_parameters(changes) gets only the keys which changed, as soon as Firebase pushes them.  While a stream is
+        connected ReadParameters() returns nothing and ReadProgram() answers from the stream's copy of /Program;
+        while it is down both fall back to polling.
+        """
+        self._parameter_stream = FirebaseStream(self.client, '/Parameters', on_parameters)
+        self._parameter_stream.start()
+        if on_program is not None:
+            self._program_stream = FirebaseStream(self.client, '/Program', on_program)
+            self._program_stream.start()
+        return True
+
+    @staticmethod
+    def _streaming(stream):
+        return stream is not None and stream.connected.is_set()
 
     def ReadParameters(self):
         """Read parameters file written by web server and LCD"""
+        if self._streaming(self._parameter_stream):
+            return {}  # Changes are pushed to the Subscribe() callback
+
         # Read from queue
         now = time()
 
@@ -131,18 +213,58 @@ class Firebase_Backend(PiSmoker_Backend):
     def WriteControl(self, D):
         """Write Control settings to backend"""
         try:
-            return self._post_async('/Controls', D)
+            if self._do_async:
+                return self._post_async('/Controls', D)
+            return self._post('/Controls', D)
+        except:
+            logger.info('Error writing Controls to Firebase')
+            return -1
+
+    def _write_control_batch(self, Ds):
+        return self.client.patch('/', {'Controls/%s' % push_id(): D for D in Ds}, params=self.fb_params)
+
+    def WriteControlBatch(self, Ds):
+        """Write several control records in one multi-location PATCH adding a /Controls child each."""
+        if not Ds:
+            return
+        try:
+            if self._do_async:
+                return self.client.submit(self._write_control_batch, Ds)
+            return self._write_control_batch(Ds)
         except:
             logger.info('Error writing Controls to Firebase')
             return -1
 
     def WriteProgram(self, Program):
+        """Replace /Program with a single PUT, so readers see the old or the new program and never part of one.
+        Steps are stored under push ids generated in order, which is how the web UI lists them."""
+        steps = [(push_id(), P) for P in Program]
         try:
-            self._delete('/', 'Program')
-            for P in Program:
-                self._post('/Program', P)
+            self._put('/', 'Program', dict(steps))
         except:
             logger.info('Error writing Program to Firebase')
+            return -1
+        self._program = steps
+
+    def AdvanceProgram(self, Program):
+        """Delete the completed steps in one small PATCH, when /Program is known to still hold them followed by
+        Program.  Otherwise write Program out in full."""
+        known = self._program
+        done = len(known) - len(Program)
+        if done < 0 or [P for key, P in known[done:]] != list(Program):
+            return self.WriteProgram(Program)
+        if done == 0:
+            return
+        try:
+            self._patch('/Program', {key: None for key, P in known[:done]})
+        except:
+            logger.info('Error advancing Program in Firebase')
+            return -1
+        self._program = known[done:]
+
+    def _read_program(self, raw):
+        self._program = sorted((raw or {}).items())
+        return [P for key, P in self._program] or None
 
     def ReadProgram(self, run_program):
         """
@@ -152,15 +274,21 @@ class Firebase_Backend(PiSmoker_Backend):
         @return:
         @rtype: []
         """
+        if run_program and self._streaming(self._program_stream):
+            return self._read_program(self._program_stream.mirror)
+
+        # Read at once when programs are switched on, otherwise at most every _read_program_interval
+        starting = run_program and not self._program_running
+        self._program_running = run_program
         now = time()
-        if now - self._last_read_program > self._read_program_interval and run_program:
+        if run_program and (starting or now - self._last_read_program > self._read_program_interval):
+            self._last_read_program = now  # Before the request, so every outcome counts towards the interval
             try:
-                raw = self._get('/Program')
-
-                if raw is not None:
-                    return [k[1] for k in sorted(raw.items())]
-                    # for k in sorted(raw.items()):
-                    #    NewProgram.append(k[1])
+                # Only downloaded when it changed since the last read
+                etag, raw = self.client.get_if_changed('/Program', self._program_etag)
+                if raw is NOT_MODIFIED:
+                    return [P for key, P in self._program] or None
+                self._program_etag = etag
+                return self._read_program(raw)
             except:
                 logger.info('Error reading Program from Firebase')
-            self._last_read_program = now
@@ -13,12 +13,20 @@ class Adafruit_CharLCDPlate:
         self.screen = initscr()
         noecho()
         self.screen.nodelay(1)
+        self.col = self.row = 0
 
     def message(self, text):
         # print text
-        self.screen.addstr(5, 5, text)
+        for i, line in enumerate(text.split('\n')):
+            if i:
+                self.col, self.row = 0, self.row + 1
+            self.screen.addstr(5 + self.row, 5 + self.col, line)
+            self.col += len(line)
         self.screen.refresh()
 
+    def set_cursor(self, col, row):
+        self.col, self.row = col, row
+
     def home(self):
         self.screen.clear()
 
@@ -33,3 +41,4 @@ class Adafruit_CharLCDPlate:
 
     def clear(self):
         self.screen.clear()
+        self.col = self.row = 0
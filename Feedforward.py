@@ -0,0 +1,78 @@
+import logging.config
+import time
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+AMBIENT_NOMINAL = 70.0  # Ambient temperature (F) at which the PID was tuned, no compensation applied here
+FF_LIMIT = 0.35  # Maximum magnitude of the combined feedforward term
+
+
+# Feedforward terms added to the PID output in Hold mode
+# u = u_PID + u_amb + u_fb
+# u_amb = K_amb * (AMBIENT_NOMINAL - T_ambient)
+#   Heat loss scales with (grill - ambient), so a colder day needs a higher base auger rate.
+# u_fb = -K_fb * dT_firebox/dt (filtered)
+#   The firebox thermocouple sits in the flame and responds well before the grill RTD.  A falling firebox
+#   (flame-out, pellet bridge) asks for more pellets, a pellet surge asks for fewer.
+
+class Feedforward:
+    K_amb = K_fb = Tau_fb = None
+    Amb = FB = u = Rate = None
+    Last = LastUpdate = None
+
+    def __init__(self, K_amb, K_fb, Tau_fb=9.0):
+        """
+
+        @param K_amb: Ambient gain (u per F below AMBIENT_NOMINAL)
+        @type K_amb: float
+        @param K_fb: Firebox lead gain (u per F/s of firebox rate)
+        @type K_fb: float
+        @param Tau_fb: Time constant (s) of the filter applied to the firebox rate
+        @type Tau_fb: float
+        """
+        self.setGains(K_amb, K_fb, Tau_fb)
+        self.reset()
+
+    def setGains(self, K_amb, K_fb, Tau_fb=None):
+        self.K_amb = float(K_amb)
+        self.K_fb = float(K_fb)
+        if Tau_fb is not None:
+            self.Tau_fb = float(Tau_fb)
+        logger.info('Feedforward gains: K_amb: %f K_fb: %f Tau_fb: %f', self.K_amb, self.K_fb, self.Tau_fb)
+
+    def reset(self):
+        self.Amb = 0.0
+        self.FB = 0.0
+        self.u = 0.0
+        self.Rate = 0.0
+        self.Last = None
+        self.LastUpdate = None
+
+    def update(self, ambient=None, firebox=None, now=None):
+        """Update the feedforward term from the latest samples.
+
+        @param ambient: Ambient temperature (F), None if unavailable
+        @type ambient: float
+        @param firebox: Firebox temperature (F), None if unavailable
+        @type firebox: float
+        @return: Feedforward contribution to u
+        @rtype: float
+        """
+        now = now or time.time()
+
+        if ambient is not None:
+            self.Amb = self.K_amb * (AMBIENT_NOMINAL - ambient)
+
+        if firebox is not None:
+            if self.Last is not None and now > self.LastUpdate:
+                dT = now - self.LastUpdate
+                alpha = self.Tau_fb / (self.Tau_fb + dT)
+                self.Rate = alpha * self.Rate + (1 - alpha) * (firebox - self.Last) / dT
+            self.Last = firebox
+            self.LastUpdate = now
+            self.FB = -self.K_fb * self.Rate
+
+        self.u = min(max(self.Amb + self.FB, -FF_LIMIT), FF_LIMIT)
+        return self.u
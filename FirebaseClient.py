@@ -0,0 +1,407 @@
+import httplib
+import json
+import logging.config
+import random
+import socket
+from Queue import Queue, LifoQueue, Empty, Full
+from copy import deepcopy
+from threading import Thread, Lock, Event
+from time import time
+from urllib import urlencode
+from urlparse import urlsplit
+
+from Instrumentation import count, histogram
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = 2  # Keep-alive connections kept open
+WORKERS = 2  # Threads running submit()ed requests
+MAX_PENDING = 100  # Requests waiting for a worker before submit() refuses more
+TIMEOUT = 10.0
+STREAM_TIMEOUT = 90.0  # Firebase sends a keep-alive event every 30 s, reconnect if nothing arrives for this long
+STREAM_RETRY_MIN = 1.0  # Reconnect backoff, doubling up to STREAM_RETRY_MAX
+STREAM_RETRY_MAX = 30.0
+
+NOT_MODIFIED = object()  # get_if_changed() result when the data still has the given ETag
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class FirebaseError(IOError):
+    """Request failed (HTTP error status, or the connection failed twice)."""
+
+    def __init__(self, message, status=None):
+        super(FirebaseError, self).__init__(message)
+        self.status = status
+
+
+class PushId(object):
+    """Firebase style push ids: 8 characters of millisecond time then 12 random ones, incremented within the same
+    millisecond, so ids generated here sort in creation order just like ones from POST."""
+
+    def __init__(self):
+        self._last_time = 0
+        self._last_rand = [0] * 12
+        self._lock = Lock()
+
+    def __call__(self, now=None):
+        ms = int((now or time()) * 1000)
+        with self._lock:
+            if ms == self._last_time:
+                for i in range(11, -1, -1):
+                    if self._last_rand[i] < 63:
+                        self._last_rand[i] += 1
+                        break
+                    self._last_rand[i] = 0
+            else:
+                self._last_time = ms
+                self._last_rand = [random.randrange(64) for _ in range(12)]
+            rand = list(self._last_rand)
+        stamp = []
+        for _ in range(8):
+            stamp.append(PUSH_CHARS[ms % 64])
+            ms //= 64
+        return ''.join(reversed(stamp)) + ''.join(PUSH_CHARS[r] for r in rand)
+
+
+push_id = PushId()
+
+
+# noinspection PyBroadException
+class FirebaseClient(object):
+    """Firebase REST client over a small pool of persistent (keep-alive) HTTP connections.
+
+    Each request borrows a connection from the pool and returns it afterwards, so TCP and TLS set-up is paid once per
+    connection rather than once per request.  A request failing on a reused connection (the server closed it while
+    idle) is retried once on a fresh one.  submit() runs requests on a bounded pool of worker threads instead of
+    spawning a process per call.
+
+    Every request is timed into Instrumentation as 'firebase.<METHOD> /<top level key>', e.g. 'firebase.PATCH /'.
+    """
+
+    def __init__(self, url, auth=None, pool_size=POOL_SIZE, workers=WORKERS, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        """
+
+        @param url: Database URL, e.g. https://pismoker.firebaseio.com/
+        @type url: str
+        @param auth: [Optional] Database secret or token, sent as the auth query parameter
+        @type auth: str
+        """
+        parts = urlsplit(url)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.base = parts.path.rstrip('/')
+        self.auth = auth
+        self.timeout = timeout
+        self._pool = LifoQueue(maxsize=pool_size)  # Most recently used first, least likely to have timed out
+        self._work = Queue(maxsize=max_pending)
+        self._workers = []
+        for i in range(workers):
+            t = Thread(target=self._worker, name='Firebase-%i' % i)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    # Connections
+    def _connect(self):
+        count('firebase.connections')
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except Empty:
+            return self._connect(), False
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def _url(self, path, params):
+        query = dict(params or {})
+        if self.auth:
+            query['auth'] = self.auth
+        url = '%s/%s.json' % (self.base, path.strip('/'))
+        return url + ('?' + urlencode(query) if query else '')
+
+    def request(self, method, path, data=None, params=None, headers=None, raw=False):
+        """Send one request on a pooled connection.
+
+        @param path: Database path, e.g. '/Parameters'
+        @param data: [Optional] JSON serialisable body
+        @param params: [Optional] Extra query parameters, e.g. {'print': 'silent'}
+        @param raw: Return (status, response headers, body text) instead of the decoded body
+        @return: Decoded JSON response (None for an empty body)
+        @raise FirebaseError: HTTP error status or connection failure
+        """
+        body = json.dumps(data) if data is not None else None
+        url = self._url(path, params)
+        hdrs = {'Connection': 'keep-alive'}
+        if body is not None:
+            hdrs['Content-Type'] = 'application/json'
+        hdrs.update(headers or {})
+        top = path.strip('/').split('/', 1)[0]
+        hist = histogram('firebase.%s /%s' % (method, top))
+
+        start = time()
+        for attempt in (0, 1):
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, url, body, hdrs)
+                resp = conn.getresponse()
+                text = resp.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue  # Stale keep-alive connection, try a fresh one
+                hist.record(time() - start)
+                count('firebase.errors')
+                raise FirebaseError('%s %s: %s' % (method, path, e))
+            if resp.getheader('connection', '').lower() == 'close' or resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            break
+        hist.record(time() - start)
+
+        if raw:
+            return resp.status, dict(resp.getheaders()), text
+        if resp.status >= 400:
+            count('firebase.errors')
+            raise FirebaseError('%s %s: HTTP %i %s' % (method, path, resp.status, text[:200]), resp.status)
+        return json.loads(text) if text else None
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params=params)
+
+    def get_if_changed(self, path, etag=None):
+        """Conditional GET: the body is only sent (and decoded) when path no longer has the given ETag.
+
+        @param etag: [Optional] ETag returned by the previous call
+        @return: (etag, data), data is NOT_MODIFIED when unchanged
+        @raise FirebaseError: HTTP error status or connection failure
+        """
+        headers = {'X-Firebase-ETag': 'true'}
+        if etag:
+            headers['If-None-Match'] = etag
+        status, hdrs, text = self.request('GET', path, headers=headers, raw=True)
+        new_etag = hdrs.get('etag')
+        if status == 304 or (etag and new_etag == etag):  # Servers ignoring If-None-Match still send the ETag
+            count('firebase.not_modified')
+            return etag, NOT_MODIFIED
+        if status >= 400:
+            count('firebase.errors')
+            raise FirebaseError('GET %s: HTTP %i %s' % (path, status, text[:200]), status)
+        return new_etag, json.loads(text) if text else None
+
+    def put(self, path, data, params=None):
+        return self.request('PUT', path, data, params)
+
+    def post(self, path, data, params=None):
+        return self.request('POST', path, data, params)
+
+    def patch(self, path, data, params=None):
+        return self.request('PATCH', path, data, params)
+
+    def delete(self, path, params=None):
+        return self.request('DELETE', path, params=params)
+
+    # Worker pool
+    def submit(self, fn, *args):
+        """Run fn(*args) on a worker thread.  Never blocks: when MAX_PENDING requests are already waiting the call is
+        dropped and -1 returned."""
+        try:
+            self._work.put_nowait((fn, args))
+        except Full:
+            count('firebase.dropped')
+            logger.info('Firebase request queue full, dropping %s', getattr(fn, '__name__', fn))
+            return -1
+
+    def _worker(self):
+        while True:
+            fn, args = self._work.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.info('Error in Firebase request %s (%s)', getattr(fn, '__name__', fn), e)
+            finally:
+                self._work.task_done()
+
+    def join(self):
+        """Wait for all submitted requests to finish."""
+        self._work.join()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                return
+
+
+def _tree_set(tree, path, value):
+    """Set value at path (list of keys) in a nested dict, None deletes.  Returns the (possibly new) tree."""
+    if not path:
+        return value if isinstance(value, dict) else ({} if value is None else value)
+    if not isinstance(tree, dict):
+        tree = {}
+    node = tree
+    for key in path[:-1]:
+        if not isinstance(node.get(key), dict):
+            node[key] = {}
+        node = node[key]
+    if value is None:
+        node.pop(path[-1], None)
+    else:
+        node[path[-1]] = value
+    return tree
+
+
+# noinspection PyBroadException
+class FirebaseStream(Thread):
+    """Firebase REST streaming (server-sent events) subscription to one path.
+
+    Keeps a mirror of the subtree and, for every put/patch event, calls callback(changes) with only the top level
+    keys whose value changed ({key: new value}, None for a deleted key).  The stream runs on its own connection,
+    outside the pool.  After a disconnect it reconnects with backoff; Firebase starts every stream with a put of the
+    whole subtree, which is diffed against the mirror, so anything changed while disconnected is delivered once and
+    nothing else is repeated.
+    """
+
+    def __init__(self, client, path, callback, name=None):
+        """
+
+        @type client: FirebaseClient
+        @param path: Database path, e.g. '/Parameters'
+        @param callback: callback(changes), called on the stream thread
+        """
+        super(FirebaseStream, self).__init__(name=name or 'FirebaseStream%s' % path.replace('/', '-'))
+        self.setDaemon(True)
+        self.client = client
+        self.path = path
+        self.callback = callback
+        self.mirror = {}
+        self.connected = Event()
+        self._stopped = Event()
+        self._conn = None
+
+    def stop(self):
+        self._stopped.set()
+        conn = self._conn
+        if conn is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+    def run(self):
+        backoff = STREAM_RETRY_MIN
+        while not self._stopped.is_set():
+            try:
+                if self._listen():
+                    backoff = STREAM_RETRY_MIN  # Had a working stream, start the backoff again
+            except (httplib.HTTPException, socket.error, FirebaseError, ValueError) as e:
+                logger.info('Firebase stream %s lost (%s)', self.path, e)
+            except Exception:
+                logger.exception('Error in Firebase stream %s', self.path)
+            self.connected.clear()
+            if self._stopped.is_set():
+                break
+            count('firebase.stream.reconnects')
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, STREAM_RETRY_MAX)
+
+    def _open(self):
+        host, url = self.client.host, self.client._url(self.path, None)
+        for _ in range(5):  # Firebase redirects streams to the server holding the data
+            if self.client.secure:
+                conn = httplib.HTTPSConnection(host, timeout=STREAM_TIMEOUT)
+            else:
+                conn = httplib.HTTPConnection(host, timeout=STREAM_TIMEOUT)
+            self._conn = conn
+            conn.request('GET', url, headers={'Accept': 'text/event-stream'})
+            resp = conn.getresponse()
+            if resp.status in (301, 302, 307):
+                location = urlsplit(resp.getheader('location'))
+                host, url = location.netloc, location.path + ('?' + location.query if location.query else '')
+                conn.close()
+                continue
+            if resp.status != 200:
+                conn.close()
+                raise FirebaseError('Stream %s: HTTP %i' % (self.path, resp.status), resp.status)
+            return resp
+        raise FirebaseError('Stream %s: too many redirects' % self.path)
+
+    @staticmethod
+    def _lines(resp):
+        if not resp.chunked:
+            while True:
+                line = resp.fp.readline()
+                if not line:
+                    return
+                yield line.rstrip('\r\n')
+        else:
+            buf = ''
+            while True:
+                c = resp.read(1)
+                if not c:
+                    return
+                if c == '\n':
+                    yield buf.rstrip('\r')
+                    buf = ''
+                else:
+                    buf += c
+
+    def _listen(self):
+        """Read one connection's worth of events.  Returns True if the stream delivered anything."""
+        resp = self._open()
+        self.connected.set()
+        got_events = False
+        event, data = None, []
+        try:
+            for line in self._lines(resp):
+                if self._stopped.is_set():
+                    break
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+                elif not line and event:
+                    self._event(event, '\n'.join(data))
+                    got_events = True
+                    event, data = None, []
+        finally:
+            self._conn.close()
+        return got_events
+
+    def _event(self, event, data):
+        count('firebase.stream.events')
+        if event in ('put', 'patch'):
+            message = json.loads(data)
+            path = [p for p in message['path'].split('/') if p]
+            old = deepcopy(self.mirror)
+            if event == 'put':
+                self.mirror = _tree_set(self.mirror, path, message['data'])
+            else:
+                for key, value in (message['data'] or {}).items():
+                    self.mirror = _tree_set(self.mirror, path + [k for k in key.split('/') if k], value)
+            changes = self.diff(old, self.mirror)
+            if changes:
+                self.callback(changes)
+        elif event in ('cancel', 'auth_revoked'):
+            raise FirebaseError('Stream %s: %s %s' % (self.path, event, data))
+        # keep-alive: nothing to do, the read timeout is reset by any data
+
+    @staticmethod
+    def diff(old, new):
+        """Top level keys of new which differ from old (deleted keys map to None)."""
+        old = old if isinstance(old, dict) else {}
+        new = new if isinstance(new, dict) else {}
+        changes = {key: value for key, value in new.items() if old.get(key) != value}
+        changes.update({key: None for key in old if key not in new})
+        return changes
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging.config
+import socket
+import sys
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from urlparse import urlsplit, parse_qs
+
+from FirebaseClient import push_id
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+STANDIN_PORT = 9200
+KEEPALIVE_INTERVAL = 30  # Same as Firebase
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):  # Clients hanging up on a stream are expected
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FirebaseStandIn(Thread):
+    """Local stand-in for the Firebase REST API subset PiSmoker uses, for testing without the real database.
+
+    In-memory JSON tree with GET, PUT, POST (push ids), PATCH (including multi-location 'a/b' keys) and DELETE on
+    <path>.json, print=silent, and HTTP/1.1 keep-alive.  GET with 'X-Firebase-ETag: true' returns an ETag, and
+    'If-None-Match' with the current one gets 304.  Counts connections and requests so tests can check that the
+    client reuses connections.
+
+    GET with 'Accept: text/event-stream' streams like Firebase: a put of the whole subtree, then put/patch events
+    relative to the streamed path for every write touching it, and keep-alive events.  drop_streams() disconnects
+    all streams, to test reconnects.
+
+    >>> server = FirebaseStandIn(port=0); server.start()
+    >>> backend = Firebase_Backend(server.url, 'secret')
+    """
+
+    def __init__(self, port=STANDIN_PORT, address='127.0.0.1', data=None):
+        super(FirebaseStandIn, self).__init__(name='FirebaseStandIn')
+        self.setDaemon(True)
+        self.data = data if data is not None else {}
+        self.lock = Lock()
+        self.connections = 0
+        self.requests = []  # (method, path)
+        self.streams = []  # (path, Queue of (event, data))
+        self.keepalive = KEEPALIVE_INTERVAL
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with server.lock:
+                    server.connections += 1
+
+            def _handle(self):
+                parts = urlsplit(self.path)
+                if not parts.path.endswith('.json'):
+                    return self._reply(404, {'error': 'Not found'})
+                path = [p for p in parts.path[:-len('.json')].split('/') if p]
+                query = parse_qs(parts.query)
+                length = int(self.headers.getheader('content-length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                if self.command == 'GET' and 'text/event-stream' in (self.headers.getheader('accept') or ''):
+                    return self._stream(path)
+                with server.lock:
+                    server.requests.append((self.command, '/' + '/'.join(path)))
+                    result = server.apply(self.command, path, body)
+                    server.notify(self.command, path, body, result)
+                if query.get('print') == ['silent']:
+                    return self._reply(204, None)
+                if self.command == 'GET' and self.headers.getheader('x-firebase-etag') == 'true':
+                    etag = hashlib.sha1(json.dumps(result, sort_keys=True)).hexdigest()
+                    if self.headers.getheader('if-none-match') == etag:
+                        return self._reply(304, None, {'ETag': etag})
+                    return self._reply(200, result, {'ETag': etag})
+                self._reply(200, result)
+
+            def _reply(self, status, result, headers=None):
+                text = json.dumps(result) if status not in (204, 304) else ''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(text)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(text)
+
+            def _stream(self, path):
+                q = Queue()
+                with server.lock:
+                    server.requests.append(('STREAM', '/' + '/'.join(path)))
+                    q.put(('put', {'path': '/', 'data': server.get(path)}))
+                    server.streams.append((path, q))
+                self.close_connection = 1  # Event stream runs until the connection closes
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    while True:
+                        try:
+                            event, data = q.get(timeout=server.keepalive)
+                        except Empty:
+                            event, data = 'keep-alive', None
+                        if event is None:
+                            break
+                        self.wfile.write('event: %s\ndata: %s\n\n' % (event, json.dumps(data)))
+                        self.wfile.flush()
+                except socket.error:
+                    pass
+                finally:
+                    with server.lock:
+                        server.streams = [s for s in server.streams if s[1] is not q]
+
+            do_GET = do_PUT = do_POST = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((address, port), Handler)
+
+    @property
+    def url(self):
+        return 'http://%s:%i/' % self.httpd.server_address
+
+    # Tree operations (called with the lock held)
+    def get(self, path):
+        node = self.data
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    def set(self, path, value):
+        if not path:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node = self.data
+        for key in path[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        if value is None:
+            node.pop(path[-1], None)
+        else:
+            node[path[-1]] = value
+
+    def apply(self, method, path, body):
+        if method == 'GET':
+            return self.get(path)
+        elif method == 'PUT':
+            self.set(path, body)
+            return body
+        elif method == 'POST':
+            name = push_id()
+            self.set(path + [name], body)
+            return {'name': name}
+        elif method == 'PATCH':
+            for key, value in (body or {}).items():
+                self.set(path + [k for k in key.split('/') if k], value)
+            return body
+        elif method == 'DELETE':
+            self.set(path, None)
+            return None
+
+    def notify(self, method, path, body, result):
+        """Queue events for the streams a write touches (called with the lock held)."""
+        if method == 'GET':
+            return
+        for stream_path, q in self.streams:
+            n = len(stream_path)
+            if path[:n] == stream_path:
+                relative = '/' + '/'.join(path[n:])
+                if method == 'PATCH':
+                    q.put(('patch', {'path': relative, 'data': body}))
+                elif method == 'POST':
+                    q.put(('put', {'path': relative.rstrip('/') + '/' + result['name'], 'data': body}))
+                else:
+                    q.put(('put', {'path': relative, 'data': body if method == 'PUT' else None}))
+            elif stream_path[:len(path)] == path:
+                q.put(('put', {'path': '/', 'data': self.get(stream_path)}))  # Written above the stream
+
+    def drop_streams(self):
+        with self.lock:
+            for path, q in self.streams:
+                q.put((None, None))
+
+    def run(self):
+        logger.info('Firebase stand-in on %s', self.url)
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    FirebaseStandIn(port=int(sys.argv[1]) if len(sys.argv) > 1 else STANDIN_PORT).run()
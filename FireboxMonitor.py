@@ -0,0 +1,270 @@
+import logging.config
+from math import exp
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+TAU_LEVEL = 4.0  # Smoothing time constant (s) for the level estimate
+TAU_TREND = 6.0  # Smoothing time constant (s) for slope and curvature, sets the effective window
+ARM_TEMP = 250.  # Firebox must have been above this (F) for a flame-out to be possible
+FLAMEOUT_SLOPE = -1.0  # F/s
+FLAMEOUT_DROP = 25.  # Minimum drop (F) from the recent peak
+HORIZON = 10.  # Look-ahead (s) for the slope extrapolated with the curvature
+FLAMEOUT_COUNT = 2  # Consecutive samples meeting the criteria
+PEAK_DECAY = 600.  # Time constant (s) with which the tracked peak relaxes toward the level
+RECOVER_SLOPE = 1.0  # F/s
+RECOVER_RISE = 20.  # Rise (F) above the post flame-out trough to consider the fire re-established
+IGNITION_TEMP = 200.  # Firebox temperature (F) above which combustion can be self-sustaining
+IGNITION_SLOPE = 0.5  # F/s
+IGNITION_COUNT = 3  # Consecutive samples meeting the criteria
+
+
+class TrendEstimator(object):
+    """Incremental level/slope/curvature estimate (Holt double exponential smoothing with time-aware gains).
+
+    Every update is O(1) and keeps no history, so it can run on every sample of a multi-day cook.
+    """
+    Level = Slope = Curvature = None
+    LastUpdate = None
+
+    def __init__(self, tau_level=TAU_LEVEL, tau_trend=TAU_TREND):
+        self.tau_level = tau_level
+        self.tau_trend = tau_trend
+
+    def reset(self):
+        self.Level = self.LastUpdate = None
+        self.Slope = self.Curvature = 0.0
+
+    def update(self, now, value):
+        if self.Level is None:
+            self.Level = value
+            self.Slope = self.Curvature = 0.0
+            self.LastUpdate = now
+            return self.Level, self.Slope, self.Curvature
+
+        dt = now - self.LastUpdate
+        if dt <= 0:
+            return self.Level, self.Slope, self.Curvature
+
+        alpha = 1 - exp(-dt / self.tau_level)
+        beta = 1 - exp(-dt / self.tau_trend)
+
+        last_level = self.Level
+        predicted = self.Level + self.Slope * dt
+        self.Level = predicted + alpha * (value - predicted)
+
+        last_slope = self.Slope
+        self.Slope += beta * ((self.Level - last_level) / dt - self.Slope)
+        self.Curvature += beta * ((self.Slope - last_slope) / dt - self.Curvature)
+
+        self.LastUpdate = now
+        return self.Level, self.Slope, self.Curvature
+
+
+class FlameoutDetector(object):
+    """Streaming flame-out detector for the firebox thermocouple.
+
+    A flame-out is flagged when the firebox has been lit (above ARM_TEMP), is falling faster than FLAMEOUT_SLOPE,
+    will still be falling HORIZON seconds out when the slope is extrapolated with the curvature (so a dip which is
+    already turning around is ignored), and has dropped at least FLAMEOUT_DROP from its recent peak, for
+    FLAMEOUT_COUNT consecutive samples.
+    """
+    Trend = None  # type: TrendEstimator
+    Peak = Trough = None
+    Armed = Flameout = False
+    _count = 0
+
+    def __init__(self, slope=FLAMEOUT_SLOPE, drop=FLAMEOUT_DROP, count=FLAMEOUT_COUNT):
+        self.slope = slope
+        self.drop = drop
+        self.count = count
+        self.Trend = TrendEstimator()
+        self.reset()
+
+    def reset(self):
+        self.Trend.reset()
+        self.Peak = self.Trough = None
+        self.Armed = self.Flameout = False
+        self._count = 0
+
+    def update(self, now, T):
+        """Add a firebox sample.
+
+        @param now: Sample time (s)
+        @type now: float
+        @param T: Firebox temperature (F)
+        @type T: float
+        @return: True on the sample where a new flame-out is detected
+        @rtype: bool
+        """
+        last = self.Trend.LastUpdate
+        level, slope, curvature = self.Trend.update(now, T)
+
+        if self.Peak is None or level > self.Peak:
+            self.Peak = level
+        elif last is not None:
+            self.Peak -= (self.Peak - level) * min((now - last) / PEAK_DECAY, 1.0)
+
+        if level > ARM_TEMP:
+            self.Armed = True
+
+        if self.Flameout:
+            self.Trough = min(self.Trough, level)
+            return False
+
+        if (self.Armed and slope < self.slope and slope + curvature * HORIZON < 0 and
+                self.Peak - level > self.drop):
+            self._count += 1
+        else:
+            self._count = 0
+
+        if self._count >= self.count:
+            logger.info('Flame-out detected: firebox %.1f (peak %.1f) slope %.2f F/s', level, self.Peak, slope)
+            self.Flameout = True
+            self.Trough = level
+            self._count = 0
+            return True
+        return False
+
+    def recovered(self):
+        """Fire re-established after a flame-out: rising again and well clear of the trough."""
+        return (self.Flameout and self.Trend.Slope > RECOVER_SLOPE and
+                self.Trend.Level - self.Trough > RECOVER_RISE)
+
+    def clear(self):
+        self.Flameout = False
+        self.Trough = None
+        self.Peak = self.Trend.Level
+        self._count = 0
+
+
+class IgnitionDetector(object):
+    """Confirms ignition from the firebox rise rate.
+
+    Combustion is taken as self-sustaining once the firebox is above IGNITION_TEMP and still rising faster than
+    IGNITION_SLOPE for IGNITION_COUNT consecutive samples.  Shares the TrendEstimator of a FlameoutDetector so the
+    firebox is only smoothed once.
+    """
+    Trend = None  # type: TrendEstimator
+    Ignited = False
+    _count = 0
+
+    def __init__(self, trend, temp=IGNITION_TEMP, slope=IGNITION_SLOPE, count=IGNITION_COUNT):
+        self.Trend = trend
+        self.temp = temp
+        self.slope = slope
+        self.count = count
+
+    def reset(self):
+        self.Ignited = False
+        self._count = 0
+
+    def update(self):
+        """Check the shared trend after it has been updated with a new sample.
+
+        @return: True on the sample where ignition is first confirmed
+        @rtype: bool
+        """
+        if self.Ignited or self.Trend.Level is None:
+            return False
+
+        if self.Trend.Level > self.temp and self.Trend.Slope > self.slope:
+            self._count += 1
+        else:
+            self._count = 0
+
+        if self._count >= self.count:
+            logger.info('Ignition confirmed: firebox %.1f slope %.2f F/s', self.Trend.Level, self.Trend.Slope)
+            self.Ignited = True
+            return True
+        return False
+
+
+def simulate(hours=12., flameouts=6, interval=3., noise=2.0, seed=0):
+    """Run the detector over a synthetic firebox trace with injected flame-outs.
+
+    @return: (list of detection latencies (s), number of false positives, hours simulated)
+    @rtype: ([float, ...], int, float)
+    """
+    import random
+    rnd = random.Random(seed)
+    n = int(hours * 3600 / interval)
+    events = sorted(rnd.sample(range(n // 10, n - 400), flameouts))
+    latencies = []
+    false_positives = 0
+    detector = FlameoutDetector()
+    T = 70.
+    out_since = None
+    for i in range(n):
+        now = i * interval
+        if events and i == events[0]:
+            events.pop(0)
+            out_since = now
+        if out_since is not None:
+            T += (70. - T) * interval / 240.  # Cooling of the firebox once the fire is out
+            if now - out_since > 600:
+                out_since = None  # Operator relit it
+        else:
+            T += (550. - T) * interval / 90. + rnd.gauss(0, 0.5)  # Burning, with pellet drop flicker
+        if detector.update(now, T + rnd.gauss(0, noise)):
+            if out_since is not None:
+                latencies.append(now - out_since)
+            else:
+                false_positives += 1
+        if detector.Flameout and out_since is None:
+            detector.clear()
+    return latencies, false_positives, hours
+
+
+def replay(path):
+    """Replay the 'Temps: {...}' lines from a PiSmoker log through the detector.
+
+    @return: list of (time, firebox temperature) where flame-outs were detected
+    @rtype: [(float, float), ...]
+    """
+    from ast import literal_eval
+    detector = FlameoutDetector()
+    detections = []
+    with open(path) as f:
+        for line in f:
+            if 'Temps: ' not in line:
+                continue
+            try:
+                Ts = literal_eval(line.split('Temps: ', 1)[1].strip())
+            except (ValueError, SyntaxError):
+                continue
+            if 'firebox' not in Ts:
+                continue
+            if detector.update(Ts['time'], Ts['firebox']):
+                detections.append((Ts['time'], Ts['firebox']))
+            elif detector.recovered():
+                detector.clear()
+    return detections
+
+
+if __name__ == '__main__':
+    # python FireboxMonitor.py                                      12 h, 6 flame-outs: 5 detected, max 15 s
+    # python FireboxMonitor.py --hours 48 --flameouts 10 --seeds 4  38 of 40 detected, mean 13.8 s, max 15 s
+    # python FireboxMonitor.py <logfile>                            Replay a PiSmoker log
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Flame-out detection on a simulated cook, or on a replayed PiSmoker log')
+    parser.add_argument('log', nargs='?', help='PiSmoker log to replay instead of simulating')
+    parser.add_argument('--hours', type=float, default=12., help='Length of each simulated cook')
+    parser.add_argument('--flameouts', type=int, default=6, help='Flame-outs injected into each simulated cook')
+    parser.add_argument('--seeds', type=int, default=1, help='Simulated cooks, with seeds 0, 1, ...')
+    args = parser.parse_args()
+
+    if args.log:
+        for t, T in replay(args.log):
+            print('Flame-out at %.0f (firebox %.1f F)' % (t, T))
+    else:
+        lat, fp, hrs = [], 0, 0.
+        for seed in range(args.seeds):
+            seed_lat, seed_fp, seed_hrs = simulate(args.hours, args.flameouts, seed=seed)
+            lat += seed_lat
+            fp += seed_fp
+            hrs += seed_hrs
+        print('Detected %i of %i flame-outs, latency mean %.1f s max %.1f s, %i false positives in %.0f h' %
+              (len(lat), args.flameouts * args.seeds, sum(lat) / max(len(lat), 1), max(lat or [0]), fp, hrs))
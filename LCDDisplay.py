@@ -1,11 +1,13 @@
 import logging.config
+from Queue import Queue, Empty
 from threading import Thread
-from time import sleep
+from time import sleep, time
 
 # import Adafruit_CharLCD as LCD
-from Queue import Queue
-
 import FakeLCD as LCD
+from Instrumentation import count, timed
+from TelemetryBus import TelemetryBus, PARAMETERS, TEMPS, LCD_INPUT
+from TemperatureSample import TemperatureSample
 
 buttons = ((LCD.SELECT, 'Mode'),
            (LCD.LEFT, 'Left'),
@@ -15,45 +17,134 @@ buttons = ((LCD.SELECT, 'Mode'),
 
 Modes = ('Off', 'Start', 'Smoke', 'Hold', 'Ignite', 'Shutdown')
 
+LCD_COLS = 16
+LCD_ROWS = 2
+FRAME_BUDGET = 0.25  # Minimum time between frames sent to the LCD
+# The plate drives the HD44780 in 4 bit mode through an MCP23017: per byte (character or command) that is RS, two
+# nibbles and two enable pulses, about 9 I2C register writes.
+I2C_PER_LCD_WRITE = 9
+POLL_INTERVAL = 0.05  # Button sampling / display loop period
+DEBOUNCE_TIME = 0.05  # Button changes within this time of the last accepted change are contact bounce
+REPEAT_DELAY = 0.5  # Hold time before a button starts to auto-repeat
+REPEAT_INTERVAL = 0.15
+REPEAT_BUTTONS = ('Up', 'Down')
+
 # Start logging
 logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
 logger = logging.getLogger(__name__)
 
 
+class ButtonReader(object):
+    """Samples the plate buttons, debounces them and queues press/auto-repeat events.
+
+    On the Adafruit plate all five buttons sit on one MCP23017 port, so they are read with a single input_pins() call
+    (one I2C register read) instead of an is_pressed() transaction per button.  LCDs without _mcp (FakeLCD) fall back
+    to is_pressed().  Debounce is a lockout: the first edge is acted on at once and anything within DEBOUNCE_TIME of it
+    is ignored, so presses are not delayed by the debounce.
+    """
+
+    def __init__(self, lcd, buttons, events=None, debounce=DEBOUNCE_TIME, repeat_delay=REPEAT_DELAY,
+                 repeat_interval=REPEAT_INTERVAL, repeat=REPEAT_BUTTONS):
+        """
+
+        @param buttons: ((pin, name), ...)
+        @param events: [Optional] Queue receiving button names
+        @type events: Queue
+        """
+        self.lcd = lcd
+        self.buttons = buttons
+        self.pins = [pin for pin, name in buttons]
+        self.Events = events or Queue()
+        self.debounce = debounce
+        self.repeat_delay = repeat_delay
+        self.repeat_interval = repeat_interval
+        self.repeat = repeat
+        self.pressed = [False] * len(buttons)
+        self.changed = [0.] * len(buttons)
+        self.next_repeat = [None] * len(buttons)
+
+    def read(self):
+        """Raw button states.
+
+        @return: True for each pressed button, in buttons order
+        @rtype: [bool, ...]
+        """
+        mcp = getattr(self.lcd, '_mcp', None)
+        if mcp is not None:
+            count('lcd.button_reads')
+            return [not level for level in mcp.input_pins(self.pins)]  # Pulled up, pressed reads low
+        count('lcd.button_reads', len(self.pins))
+        return [self.lcd.is_pressed(pin) for pin in self.pins]
+
+    def poll(self, now=None):
+        """Sample the buttons once and queue any events.
+
+        @return: Number of events queued
+        @rtype: int
+        """
+        now = now or time()
+        events = 0
+        for i, raw in enumerate(self.read()):
+            name = self.buttons[i][1]
+            if raw != self.pressed[i] and now - self.changed[i] >= self.debounce:
+                self.pressed[i] = raw
+                self.changed[i] = now
+                if raw:
+                    self.Events.put(name)
+                    events += 1
+                    self.next_repeat[i] = now + self.repeat_delay if name in self.repeat else None
+                else:
+                    self.next_repeat[i] = None
+            elif self.pressed[i] and self.next_repeat[i] is not None and now >= self.next_repeat[i]:
+                self.Events.put(name)
+                events += 1
+                self.next_repeat[i] = max(self.next_repeat[i] + self.repeat_interval, now)
+        return events
+
+
 # noinspection PyBroadException
 class LCDDisplay(Thread):
-    qP = qT = qR = None  # type: Queue
+    Bus = None  # type: TelemetryBus
+    sParameters = sTemps = None  # type: TelemetryBus.Subscription
     Parameters = None  # type: dict
-    Ts = None  # type: list
+    Ts = None  # type: TemperatureSample
 
-    def __init__(self, qP, qT, qR):
+    def __init__(self, bus):
+        """
+
+        @param bus: Telemetry bus, parameters and temperatures are read from it and button input published to it
+        @type bus: TelemetryBus
+        """
         super(LCDDisplay, self).__init__()
         try:
             self.lcd = LCD.Adafruit_CharLCDPlate()
         except:
             logger.info('Unable to initialize LCD')
 
-        self.qP = qP
-        self.qT = qT
-        self.qR = qR
-        self.Ts = {'time': 0, 'grill': 0, 'meat1': 0}
+        self.Bus = bus
+        self.sParameters = bus.subscribe(PARAMETERS)
+        self.sTemps = bus.subscribe(TEMPS)
+        self.Ts = TemperatureSample(0, grill=0, meat=0)
         self.Parameters = {'target': 0, 'mode': '', 'PMode': ''}
 
-        self.Display = ''
+        self.Buttons = ButtonReader(getattr(self, 'lcd', None), buttons)
+
+        self.Display = None  # Shadow copy of what is on the LCD (list of rows), None forces a full redraw
+        self.FrameBudget = FRAME_BUDGET
+        self.LastFrame = 0
 
     def run(self):
         while True:
             self.GetButtons()
-            while not self.qP.empty():
-                self.Parameters = self.qP.get()
-            while not self.qT.empty():
-                self.Ts = self.qT.get()
+            # Only the newest snapshots matter for the display
+            self.Parameters = self.sParameters.poll() or self.Parameters
+            self.Ts = self.sTemps.poll() or self.Ts
 
             self.UpdateDisplay()
-            sleep(0.05)
+            sleep(POLL_INTERVAL)
 
     def UpdateDisplay(self):
-        text = 'T%i G%i M%i'.ljust(16) % (self.Parameters['target'], self.Ts['grill'], self.Ts['meat1'])
+        text = 'T%i G%i M%i'.ljust(16) % (self.Parameters['target'], self.Ts.grill or 0, self.Ts.meat or 0)
         text += '\n'
         if self.Parameters['mode'] == 'Hold' or self.Parameters['mode'] == 'Start':
             text += '%s %3.2f   %s' % (self.Parameters['mode'].ljust(5), self.Parameters['u'], self.GetCurrentState())
@@ -65,40 +156,112 @@ class LCDDisplay(Thread):
 
         self.Send2Display(text)
 
+    @staticmethod
+    def Frame(text):
+        """Split text into LCD_ROWS rows of exactly LCD_COLS characters."""
+        rows = text.split('\n')[:LCD_ROWS]
+        rows += [''] * (LCD_ROWS - len(rows))
+        return [row[:LCD_COLS].ljust(LCD_COLS) for row in rows]
+
+    @staticmethod
+    def Diff(old, new):
+        """Runs of changed characters between two rows.
+
+        Runs separated by a single unchanged character are merged, rewriting it costs the same as the extra cursor
+        command.
+
+        @return: [(column, text), ...]
+        @rtype: list
+        """
+        runs = []
+        start = end = None
+        for col in range(LCD_COLS):
+            if old[col] != new[col]:
+                if start is None:
+                    start = col
+                elif col - end > 1:
+                    runs.append((start, new[start:end]))
+                    start = col
+                end = col + 1
+        if start is not None:
+            runs.append((start, new[start:end]))
+        return runs
+
     def Send2Display(self, text):
-        if self.Display != text:
-            try:
-                self.lcd.clear()
-                self.lcd.message(text)
-                self.Display = text
-            except:
-                logger.info('Unable to update LCD - %s', text)
+        """Bring the LCD up to date with text, writing only the characters which changed.
+
+        At most one frame is sent per FrameBudget, changes within the budget are coalesced into the next frame.
+
+        @return: Number of LCD writes (characters plus commands) sent, 0 if nothing was sent
+        @rtype: int
+        """
+        frame = self.Frame(text)
+        if frame == self.Display:
+            return 0
+        now = time()
+        if now - self.LastFrame < self.FrameBudget:
+            return 0  # Called again on the next pass of run(), with whatever is current by then
+
+        writes = 0
+        try:
+            with timed('lcd.frame'):
+                if self.Display is None:
+                    self.lcd.clear()
+                    self.lcd.message('\n'.join(frame))
+                    writes = 1 + LCD_ROWS * LCD_COLS + LCD_ROWS - 1
+                else:
+                    for row in range(LCD_ROWS):
+                        for col, run in self.Diff(self.Display[row], frame[row]):
+                            self.lcd.set_cursor(col, row)
+                            self.lcd.message(run)
+                            writes += 1 + len(run)
+            self.Display = frame
+        except:
+            logger.info('Unable to update LCD - %s', text)
+            self.Display = None  # Unknown state, redraw everything next time
+        self.LastFrame = now
+        count('lcd.frames')
+        count('lcd.writes', writes)
+        count('lcd.i2c_transactions', writes * I2C_PER_LCD_WRITE)
+        return writes
+
+    def PutParameters(self, NewParameters):
+        self.Bus.publish(LCD_INPUT, NewParameters)
 
     def GetButtons(self):
-        for button in buttons:
+        """Sample the buttons and act on every queued press."""
+        try:
+            self.Buttons.poll()
+        except:
+            logger.info('Unable to read buttons')
+        while True:
             try:
-                if self.lcd.is_pressed(button[0]):
-                    if button[1] == 'Mode':
-                        NewMode = self.GetCurrentMode() + 1
-                        if NewMode == len(Modes):
-                            NewMode = 0
-                        NewParameters = {'mode': Modes[NewMode]}
-                        self.qR.put(NewParameters)
-                    elif button[1] == 'Up':
-                        if self.Parameters['mode'] == 'Smoke':
-                            NewParameters = {'PMode': self.Parameters['PMode'] + 1}
-                        else:
-                            NewParameters = {'target': self.Parameters['target'] + 5}
-                        self.qR.put(NewParameters)
-                    elif button[1] == 'Down':
-                        if self.Parameters['mode'] == 'Smoke':
-                            NewParameters = {'PMode': self.Parameters['PMode'] - 1}
-                        else:
-                            NewParameters = {'target': self.Parameters['target'] - 5}
-                        self.qR.put(NewParameters)
-                    sleep(0.03)
-            except:
-                logger.info('Unable to read buttons')
+                button = self.Buttons.Events.get_nowait()
+            except Empty:
+                break
+            self.HandleButton(button)
+
+    def HandleButton(self, button):
+        NewParameters = None
+        if button == 'Mode':
+            NewMode = (self.GetCurrentMode() or 0) + 1
+            if NewMode == len(Modes):
+                NewMode = 0
+            NewParameters = {'mode': Modes[NewMode]}
+        elif button == 'Up':
+            if self.Parameters['mode'] == 'Smoke':
+                NewParameters = {'PMode': self.Parameters['PMode'] + 1}
+            else:
+                NewParameters = {'target': self.Parameters['target'] + 5}
+        elif button == 'Down':
+            if self.Parameters['mode'] == 'Smoke':
+                NewParameters = {'PMode': self.Parameters['PMode'] - 1}
+            else:
+                NewParameters = {'target': self.Parameters['target'] - 5}
+        if NewParameters:
+            self.PutParameters(NewParameters)
+            # Apply locally too, so auto-repeat keeps counting before the controller publishes the new value
+            self.Parameters = dict(self.Parameters, **NewParameters)
 
     def GetCurrentMode(self):
         for i in range(len(Modes)):
@@ -2,6 +2,8 @@ import logging.config
 import spidev
 import time
 
+from Instrumentation import timed
+
 # Start logging
 logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
 logger = logging.getLogger(__name__)
@@ -86,13 +88,16 @@ class MAX31865:
         else:
             config = 0b11000010  # 0xC2
 
-        self.spi.xfer2([0x80, config])
+        with timed('spi.MAX31865'):
+            self.spi.xfer2([0x80, config])
         time.sleep(0.25)
         self.read()
 
     def read(self):
-        MSB = self.spi.xfer2([0x01, 0x00])[1]
-        LSB = self.spi.xfer2([0x02, 0x00])[1]
+        with timed('spi.MAX31865'):
+            MSB = self.spi.xfer2([0x01, 0x00])[1]
+        with timed('spi.MAX31865'):
+            LSB = self.spi.xfer2([0x02, 0x00])[1]
 
         # Check fault
         if LSB & 0b00000001:
@@ -111,7 +116,8 @@ class MAX31865:
         @return: Fault code returned from chip
         @rtype: int
         """
-        Fault = self.spi.xfer2([0x07, 0x00])[1]
+        with timed('spi.MAX31865'):
+            Fault = self.spi.xfer2([0x07, 0x00])[1]
 
         logger.debug(faultCodes[Fault], self.cs)
 
@@ -0,0 +1,174 @@
+import logging.config
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import Instrumentation
+from PiSmoker_Parameters import MODES
+from TemperatureSample import PROBES
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = 9105
+PID_TERMS = ('P', 'I', 'D', 'u', 'error')
+
+
+class Sample(object):
+    """One time series.  The rendered text line is cached and only re-formatted when the value changes."""
+    __slots__ = ('prefix', 'value', 'line')
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.value = None
+        self.line = None
+
+    def set(self, value):
+        if value != self.value:
+            self.value = value
+            self.line = None
+
+    def render(self):
+        if self.line is None:
+            self.line = '%s %r\n' % (self.prefix, float(self.value))
+        return self.line
+
+
+class MetricsRegistry(object):
+    """Prometheus text exposition format registry.
+
+    Series are created once and then updated in place.  A scrape walks the cached lines and only formats series
+    whose value changed since the last scrape, so rendering does not churn the allocator while the control loop runs.
+    """
+    _families = None  # name: [header, {labels: Sample}]
+    _order = None
+
+    def __init__(self):
+        self._families = {}
+        self._order = []
+
+    def series(self, name, help_text='', metric_type='gauge', **labels):
+        """Get (or create) the series name{labels}.
+
+        @rtype: Sample
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = ['# HELP %s %s\n# TYPE %s %s\n' % (name, help_text, name, metric_type), {}]
+            self._families[name] = family
+            self._order.append(name)
+        key = tuple(sorted(labels.items()))
+        sample = family[1].get(key)
+        if sample is None:
+            if key:
+                prefix = '%s{%s}' % (name, ','.join('%s="%s"' % kv for kv in key))
+            else:
+                prefix = name
+            sample = family[1][key] = Sample(prefix)
+        return sample
+
+    def set(self, name, value, help_text='', metric_type='gauge', **labels):
+        if value is not None:
+            self.series(name, help_text, metric_type, **labels).set(value)
+
+    def render(self):
+        out = []
+        for name in self._order:
+            header, samples = self._families[name]
+            out.append(header)
+            for sample in samples.itervalues():
+                if sample.value is not None:
+                    out.append(sample.render())
+        return ''.join(out)
+
+
+class PiSmokerCollector(object):
+    """Copies the live PiSmoker state into a MetricsRegistry at scrape time."""
+
+    def __init__(self, smoker, registry):
+        """
+
+        @param smoker: Running controller
+        @type smoker: PiSmoker.PiSmoker
+        @param registry: Registry to fill
+        @type registry: MetricsRegistry
+        """
+        self.smoker = smoker
+        self.registry = registry
+
+    def __call__(self):
+        r = self.registry
+        s = self.smoker
+        if s.Temps:
+            Ts = s.Temps[-1]
+            for probe in PROBES:
+                r.set('pismoker_temperature_fahrenheit', getattr(Ts, probe), 'Latest probe temperature', probe=probe)
+            r.set('pismoker_sample_time_seconds', Ts.time, 'Time of the latest temperature sample')
+        r.set('pismoker_target_fahrenheit', s.Parameters['target'], 'Grill target temperature')
+        r.set('pismoker_estimate_fahrenheit', s.Estimator.T, 'Kalman estimate of the grill temperature')
+        r.set('pismoker_output', s.Parameters['u'], 'Auger duty cycle applied')
+        for term in PID_TERMS:
+            r.set('pismoker_pid', getattr(s.Control, term), 'PID terms', term=term)
+        r.set('pismoker_feedforward', s.Feedforward.u, 'Feedforward contribution to the auger duty')
+        for mode in MODES:
+            r.set('pismoker_mode', int(s.Parameters['mode'] == mode), 'Current mode (1 = active)', mode=mode)
+        for relay in s.relays:
+            r.set('pismoker_relay_state', int(s.G.GetState(relay)), 'Relay state', relay=relay)
+            r.set('pismoker_relay_toggles_total', s.G.ToggleCount[relay], 'Relay toggles', 'counter', relay=relay)
+
+        # Timing histograms from Instrumentation: backend calls, main loop stages, SPI, scheduler
+        for name, hist in Instrumentation.histograms.items():
+            group, _, call = name.partition('.')
+            metric = 'pismoker_%s_latency_seconds' % group
+            r.set(metric, hist.percentile(50), 'Latency quantiles', call=call, quantile='0.5')
+            r.set(metric, hist.percentile(99), 'Latency quantiles', call=call, quantile='0.99')
+            r.set(metric, hist.max, 'Latency quantiles', call=call, quantile='1')
+            r.set('pismoker_%s_seconds_total' % group, hist.total, 'Total time', 'counter', call=call)
+            r.set('pismoker_%s_calls_total' % group, hist.count, 'Number of calls', 'counter', call=call)
+        for name, n in Instrumentation.counters.items():
+            group, _, call = name.rpartition('.')
+            r.set('pismoker_%s_total' % call, n, 'Event count', 'counter', call=group)
+
+
+# noinspection PyBroadException
+class MetricsServer(Thread):
+    """Minimal HTTP server exposing GET /metrics on a daemon thread."""
+
+    def __init__(self, registry, collect=None, port=METRICS_PORT, address=''):
+        super(MetricsServer, self).__init__(name='Metrics')
+        self.setDaemon(True)
+        self.registry = registry
+        self.collect = collect
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.scrape()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer((address, port), Handler)
+
+    def scrape(self):
+        if self.collect:
+            try:
+                self.collect()
+            except Exception:
+                logger.exception('Error collecting metrics')
+        return self.registry.render()
+
+    def run(self):
+        logger.info('Serving metrics on port %i', self.httpd.server_address[1])
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
@@ -5,6 +5,8 @@ import time
 logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
 logger = logging.getLogger(__name__)
 
+DERIVATIVE_FILTER_N = 8.0  # Derivative filter: time constant Tf = Td / N
+
 
 # PID controller based on proportional band in standard PID form
 # https://en.wikipedia.org/wiki/PID_controller#Ideal_versus_standard_PID_form
@@ -12,13 +14,24 @@ logger = logging.getLogger(__name__)
 # PB = Proportional Band
 # Ti = Goal of eliminating in Ti seconds
 # Td = Predicts error value at Td in seconds
+#
+# Discrete form used in update():
+# * D acts on the measurement (not the error) so target changes do not kick the output, and is passed through a
+#   first order low pass filter with time constant Td / N.
+# * I uses conditional integration plus back-calculation against the output limits (u_min, u_max), so the
+#   integrator tracks the clamped output instead of winding up while the auger is pinned at U_MIN or U_MAX.
+# * The first sample after construction only initializes the measurement history, it never produces a D spike.
 
 class PID:
     P = I = D = u = Derv = Inter = Inter_max = None
     Kp = Ki = Kd = None
-    LastUpdate = error = setPoint = None
+    Td = Tf = Tt = None
+    u_min = u_max = None
+    LastUpdate = error = setPoint = Last = None
 
-    def __init__(self, PB, Ti, Td):
+    def __init__(self, PB, Ti, Td, u_min=0.0, u_max=1.0):
+        self.u_min = u_min
+        self.u_max = u_max
         self.CalculateGains(PB, Ti, Td)
 
         self.P = 0.0
@@ -30,7 +43,7 @@ class PID:
         self.Inter = 0.0
         self.Inter_max = abs(0.5 / self.Ki)
 
-        self.Last = 150
+        self.Last = None
 
         self.setTarget(0.0)
 
@@ -38,27 +51,65 @@ class PID:
         self.Kp = -1 / PB
         self.Ki = self.Kp / Ti
         self.Kd = self.Kp * Td
+        self.Td = float(Td)
+        self.Tf = self.Td / DERIVATIVE_FILTER_N
+        # Tracking time constant for back-calculation, rule of thumb sqrt(Ti * Td) (Astrom & Hagglund)
+        self.Tt = (Ti * Td) ** 0.5 if Td > 0 else float(Ti)
         logger.info('PB: %f Ti: %f Td: %f --> Kp: %f Ki: %f Kd: %f', PB, Ti, Td, self.Kp, self.Ki, self.Kd)
 
-    def update(self, Current):
+    def setLimits(self, u_min, u_max):
+        self.u_min = u_min
+        self.u_max = u_max
+
+    def update(self, Current, Rate=None):
+        """Run one controller step.
+
+        @param Current: Measured temperature
+        @type Current: float
+        @param Rate: [Optional] Externally estimated rate of Current (deg/s), replaces the filtered difference
+        @type Rate: float
+        @return: Unclamped controller output
+        @rtype: float
+        """
         now = time.time()
+        dT = max(now - self.LastUpdate, 1e-3)
+
         # P
         error = Current - self.setPoint
         self.P = self.Kp * error + 0.5  # P = 1 for PB/2 under setPoint, P = 0 for PB/2 over setPoint
 
-        # I
-        dT = now - self.LastUpdate
-        # if self.P > 0 and self.P < 1: #Ensure we are in the PB, otherwise do not calculate I to avoid windup
-        self.Inter += error * dT
+        # D (on measurement, filtered)
+        if Rate is not None:
+            self.Derv = Rate
+        elif self.Last is None:
+            # First sample, nothing to differentiate against yet.
+            self.Derv = 0.0
+        else:
+            alpha = self.Tf / (self.Tf + dT)
+            self.Derv = alpha * self.Derv + (1 - alpha) * (Current - self.Last) / dT
+        self.D = self.Kd * self.Derv
+
+        # I (conditional integration)
+        u_pre = self.P + self.Ki * self.Inter + self.D
+        # Kp < 0, so a positive error pushes u down.  Skip integration if it would push further into saturation.
+        if not ((u_pre >= self.u_max and error < 0) or (u_pre <= self.u_min and error > 0)):
+            self.Inter += error * dT
+
+        # I (back-calculation), only bleeds off integral action that is driving the saturation, never past zero
+        I = self.Ki * self.Inter
+        u_raw = self.P + I + self.D
+        excess = min(max(u_raw, self.u_min), self.u_max) - u_raw
+        if excess * I < 0:
+            I_new = I + excess * min(dT / self.Tt, 1.0)
+            if I_new * I < 0:
+                I_new = 0.0
+            self.Inter = I_new / self.Ki
+
         self.Inter = max(self.Inter, -self.Inter_max)
         self.Inter = min(self.Inter, self.Inter_max)
 
         self.I = self.Ki * self.Inter
 
-        # D
-        self.Derv = (Current - self.Last) / dT
-        self.D = self.Kd * self.Derv
-
         # PID
         self.u = self.P + self.I + self.D
 
@@ -73,11 +124,23 @@ class PID:
 
         return self.u
 
+    def setIntegrator(self, I):
+        """Pre-load the integral term (bumpless hand-over from an open loop mode).
+
+        @param I: Integral contribution to u
+        @type I: float
+        """
+        self.Inter = min(max(I / self.Ki, -self.Inter_max), self.Inter_max)
+        self.I = self.Ki * self.Inter
+        self.Last = None
+        self.Derv = 0.0
+        self.LastUpdate = time.time()
+        logger.info('Integrator preset: %f', self.I)
+
     def setTarget(self, setPoint):
         self.setPoint = setPoint
         self.error = 0.0
         self.Inter = 0.0
-        self.Derv = 0.0
         self.LastUpdate = time.time()
         logger.info('New Target: %f', setPoint)
 
@@ -1,16 +1,32 @@
-from Queue import Queue
 from collections import deque
 from logging import getLogger, config
+from signal import signal, SIGUSR1
 from time import sleep, time
 
 from ADS1118 import ADS1118
+from Buffered_Backend import Buffered_Backend, SPOOL_PATH
+from CookLog import CookLog, COOKLOG_PATH
+from Composite_Backend import Composite_Backend, Sink, merge_parameters, DROP_NEWEST, DROP_OLDEST
 from FB_Handler import Firebase_Backend
+from Feedforward import Feedforward
+from History import History
+from FireboxMonitor import FlameoutDetector, IgnitionDetector
+from Instrumentation import Instrumented, timed, timed_fn, log_report, REPORT_INTERVAL
+from KalmanFilter import KalmanFilter
 from LCDDisplay import LCDDisplay
 from MAX31865 import MAX31865
+from Metrics import MetricsRegistry, MetricsServer, PiSmokerCollector
 from PID import PID
 from PiSmoker_Backend import PiSmoker_Backend
-from TemperatureProbe import TemperatureProbe, RTD, THERMOCOUPLE
+from PiSmoker_Parameters import PiSmoker_Parameters, MODES
+from ProgramEngine import ProgramEngine
+from SQLite_Backend import SQLite_Backend, DB_PATH
+from Scheduler import Scheduler
+from TelemetryBus import TelemetryBus, PARAMETERS, TEMPS, LCD_INPUT, LCD_INPUT_HISTORY
+from TemperatureProbe import TemperatureProbe, RTD, THERMOCOUPLE, INTERNAL
+from TemperatureSample import TemperatureSample, FIELDS
 from Traeger import Traeger
+from WebServer import WebServer, WEB_PORT
 
 SMOKER_AUTH_TOKEN_TXT = '/home/pi/PiSmoker/AuthToken.txt'
 
@@ -21,7 +37,16 @@ U_MAX = 1.0  #
 IGNITER_TEMP = 100  # Temperature to start igniter
 STARTUP_TEMP = 115
 SHUTDOWN_TIME = 10 * 60  # Time to run fan after shutdown
+REIGNITE_TIME = 5 * 60  # Maximum time to run the igniter after a firebox flame-out
+REIGNITE_U = 0.25  # Auger duty cap while re-igniting, avoids piling unburnt pellets in the firebox
 TEMP_INTERVAL = 3  # Frequency to record temperatures
+PARAMETER_INTERVAL = 1  # Frequency to ask the backend for new parameters (backend applies its own polling interval)
+SINK_POLICIES = {'sqlite': {'overflow': DROP_NEWEST, 'retries': 2},  # Keep the local log complete
+                 'firebase': {'overflow': DROP_OLDEST}}  # Spooled and retried by Buffered_Backend already
+COOKLOG_FLUSH_INTERVAL = 60  # Cook log pages are forced to disk this often (a process crash loses nothing anyway)
+PROGRAM_SETTLE = 2  # Quiet time after a pushed program change before reading it, so a rewrite in progress is not read
+MODE_INTERVAL = 5  # Longest time between DoMode passes when no relay or control deadline is pending
+RESUM_INTERVAL = 1000  # Temperature_Record appends between full recomputes of the running sums
 
 _MEAT1_CHANNEL = '01'
 _FIREBOX_CHANNEL = '23'
@@ -44,44 +69,67 @@ _logger = getLogger(__name__)
 
 # noinspection SpellCheckingInspection
 class Temperature_Record(deque):
-    _average = None
+    """Window of TemperatureSample with a running per-field average.
+
+    append() (the only call made per sample) updates running sums for the new and the evicted sample instead of
+    re-averaging the whole window.  Other mutations fall back to a full recompute.
+    """
+    _sums = _counts = None  # type: list
+    _average = None  # type: TemperatureSample
+    _appends = 0
 
     def __init__(self, iterable=(), maxlen=None):
         super(Temperature_Record, self).__init__(iterable, maxlen)
         self._update_average()
 
     def _update_average(self):
-        if len(self) > 0:
-            try:
-                try:
-                    self._average = {key: 0 for key in self[0]}
-                    n = len(self) * 1.
-                    for item in self:
-                        for key in self._average:
-                            self._average[key] += (item[key] / n)
-                except LookupError or ValueError:
-                    self._average = sum(self) / len(self)
-            except StandardError:
-                self._average = None
-        else:
-            self._average = None
+        self._sums = [0.] * len(FIELDS)
+        self._counts = [0] * len(FIELDS)
+        for item in self:
+            self._add(item, 1)
+        self._average = None
+
+    def _add(self, item, sign):
+        for i, field in enumerate(FIELDS):
+            value = getattr(item, field)
+            if value is not None:
+                self._sums[i] += sign * value
+                self._counts[i] += sign
 
     def average(self):
+        """Mean of each field over the window (None for probes with no readings), or None if empty.
+
+        @rtype: TemperatureSample
+        """
+        if self._average is None and len(self) > 0:
+            average = TemperatureSample()
+            for i, field in enumerate(FIELDS):
+                if self._counts[i]:
+                    setattr(average, field, self._sums[i] / self._counts[i])
+            self._average = average
         return self._average
 
-    def append(self, *args, **kwargs):
-        to_return = super(Temperature_Record, self).append(*args, **kwargs)
-        self._update_average()
-        return to_return
+    def append(self, item):
+        evicted = self[0] if self.maxlen is not None and len(self) == self.maxlen and self.maxlen > 0 else None
+        super(Temperature_Record, self).append(item)
+        self._appends += 1
+        if self._appends % RESUM_INTERVAL == 0:
+            self._update_average()  # Bound floating point drift in the running sums
+            return
+        self._add(item, 1)
+        if evicted is not None:
+            self._add(evicted, -1)
+        self._average = None
 
     def appendleft(self, *args, **kwargs):
         to_return = super(Temperature_Record, self).appendleft(*args, **kwargs)
         self._update_average()
         return to_return
 
-    def popleft(self, *args, **kwargs):
-        to_return = super(Temperature_Record, self).popleft(*args, **kwargs)
-        self._update_average()
+    def popleft(self):
+        to_return = super(Temperature_Record, self).popleft()
+        self._add(to_return, -1)
+        self._average = None
         return to_return
 
     def pop(self, *args, **kwargs):
@@ -125,45 +173,39 @@ class Temperature_Record(deque):
         return to_return
 
 
-class PiSmoker_Parameters(dict):
-    """
-    Modification of dict class to implement on_update callbacks
-    """
-    _setter_cb = None  # Signature:
-
-    def __init__(self, setter_cb=None, *args, **kwargs):
-        super(PiSmoker_Parameters, self).__init__(*args, **kwargs)
-
-        if setter_cb:
-            self._setter_cb = setter_cb
-
-    def __setitem__(self, key, value):
-        super(PiSmoker_Parameters, self).__setitem__(key, value)
-        if self._setter_cb:
-            self._setter_cb(key, value)
-
-
 class PiSmoker(object):
     Parameters = None  # type: PiSmoker_Parameters
     db = None  # type: PiSmoker_Backend
     G = None  # type: Traeger
     Program = []
-    qT = qR = qP = None  # type: Queue
+    Engine = None  # type: ProgramEngine
+    Bus = None  # type: TelemetryBus
+    LCDInput = None  # type: TelemetryBus.Subscription
     Control = None  # type: PID
+    Feedforward = None  # type: Feedforward
+    Estimator = None  # type: KalmanFilter
+    Flameout = None  # type: FlameoutDetector
+    Ignition = None  # type: IgnitionDetector
+    ReigniteTime = StartTime = None
     Temps = None  # type: Temperature_Record
     relays = None
+    ProgramReader = None  # Set by main() to read the program off the loop thread and hand it to LoadProgram
 
-    def __init__(self, db, qT=None, qR=None, qP=None, relays=None):
+    def __init__(self, db, bus=None, relays=None, cooklog=None):
         """
 
         @param db: Database backend, expects methods from PiSmoker_Backend
         @type db: PiSmoker_Backend.PiSmoker_Backend
+        @param bus: [Optional] Telemetry bus shared with the LCD and other consumers
+        @type bus: TelemetryBus
         @param relays: [Optional]Dictionary of relay names and GPIO pins
         @type relays: dict
+        @param cooklog: [Optional] Local binary record of samples, control state and relay toggles
+        @type cooklog: CookLog
         """
-        self.Parameters = PiSmoker_Parameters(self.ParameterUpdateCallback,
-                {'mode':  'Off', 'target': 225, 'PB': 60.0, 'Ti': 180.0, 'Td': 45.0, 'CycleTime': PIDCycleTime,
-                 'u': U_MIN, 'PMode': 2.0, 'program': False, 'ProgramToggle': time()})  # 60,180,45 held +- 5F
+        self.Parameters = PiSmoker_Parameters(mode='Off', target=225, PB=60.0, Ti=180.0, Td=45.0,
+                                              CycleTime=PIDCycleTime, u=U_MIN, PMode=2.0, program=False,
+                                              ProgramToggle=time(), FFAmb=0.004, FFFirebox=0.05)  # 60,180,45 held +- 5F
         # Initialize Traeger Object
         if relays:
             self.relays = relays
@@ -171,10 +213,14 @@ class PiSmoker(object):
             self.relays = _RELAYS
         self.G = Traeger(self.relays)
         self.db = db
+        self.CookLog = cooklog
+        if cooklog is not None:
+            self.G.listener = cooklog.log_relay
 
-        self.qT = qT or Queue()
-        self.qR = qR or Queue()
-        self.qP = qP or Queue()
+        # Parameters and temperatures are published for the LCD (and anyone else), LCD button input comes back
+        self.Bus = bus or TelemetryBus()
+        self.Bus.topic(LCD_INPUT, history=LCD_INPUT_HISTORY)
+        self.LCDInput = self.Bus.subscribe(LCD_INPUT)
 
         # PID controller based on proportional band in standard PID form
         # https://en.wikipedia.org/wiki/PID_controller#Ideal_versus_standard_PID_form
@@ -184,10 +230,28 @@ class PiSmoker(object):
         # Td = Predicts error value at Td in seconds
 
         # Start controller
-        self.Control = PID(self.Parameters['PB'], self.Parameters['Ti'], self.Parameters['Td'])
+        self.Control = PID(self.Parameters['PB'], self.Parameters['Ti'], self.Parameters['Td'],
+                           u_min=U_MIN, u_max=U_MAX)
         self.Control.setTarget(self.Parameters['target'])
 
-        self.Temps = Temperature_Record(maxlen=int(self.Parameters['CycleTime'] / TEMP_INTERVAL))
+        # Feedforward from ambient (ADS1118 internal sensor) and firebox thermocouple
+        self.Feedforward = Feedforward(self.Parameters['FFAmb'], self.Parameters['FFFirebox'])
+
+        # Grill temperature/rate estimate fed to the controller in place of the boxcar average
+        self.Estimator = KalmanFilter()
+
+        # Firebox flame-out detection
+        self.Flameout = FlameoutDetector()
+        self.Ignition = IgnitionDetector(self.Flameout.Trend)
+
+        self.Engine = ProgramEngine()
+
+        self.Temps = Temperature_Record(maxlen=max(1, int(self.Parameters['CycleTime'] / TEMP_INTERVAL)))
+
+        # React to parameter changes, whoever makes them (backend, LCD, program, mode logic)
+        self.Parameters.subscribe(['target', 'PB', 'Ti', 'Td', 'FFAmb', 'FFFirebox', 'PMode', 'mode', 'program',
+                                   'CycleTime'], self.ParameterUpdateCallback)
+
         # Set mode
         self.ModeUpdated()
 
@@ -200,85 +264,146 @@ class PiSmoker(object):
         @rtype:
         """
         now = time()
-        if not self.Temps or now - self.Temps[-1]['time'] > TEMP_INTERVAL:
-            Ts = {'time': now}
-            Ts.update({probe: probe_list[probe].read() for probe in probe_list})
-            self.Temps.append(Ts)
-            _logger.info("Temps: %r" % self.Temps[-1])
-            self.db.PostTemps(self.Parameters['target'], Ts)
+        if not self.Temps or now - self.Temps[-1].time > TEMP_INTERVAL:
+            self.RecordTemps(self.ReadTemps(probe_list))
+
+    @staticmethod
+    def ReadTemps(probe_list):
+        """Read all probes (blocking SPI, safe to run off the control thread).
+
+        @param probe_list: Dictionary of probes which provide the read() function to get the temperature.
+        @type probe_list: dict
+        @return: Temperature sample
+        @rtype: TemperatureSample
+        """
+        Ts = TemperatureSample(time())
+        for probe in probe_list:
+            setattr(Ts, probe, probe_list[probe].read())
+        return Ts
+
+    def RecordTemps(self, Ts):
+        """Record a sample and update everything that depends on it.
 
-            # Push temperatures to LCD
-            #self.qT.put(Ts)
+        @param Ts: Temperature sample from ReadTemps (an old style dict is converted)
+        @type Ts: TemperatureSample
+        """
+        if not isinstance(Ts, TemperatureSample):
+            Ts = TemperatureSample.from_dict(Ts)
+        now = Ts.time
+        self.Temps.append(Ts)
+        _logger.info('Temps: %r', Ts)
+        self.db.PostTemps(self.Parameters['target'], Ts)
+        if self.CookLog is not None:
+            self.CookLog.log_sample(self.Parameters['target'], Ts)
+        self.Estimator.update(now, Ts.grill, Ts.firebox, self.Parameters['u'])
+        self.UpdateFeedforward(Ts)
+        if Ts.firebox is not None:
+            if self.Flameout.update(now, Ts.firebox):
+                self.Ignition.reset()
+                if self.Parameters['mode'] in ['Hold', 'Smoke']:
+                    self.Reignite()
+                else:
+                    # Expected (e.g. the fire dying after Shutdown), nothing to re-light: don't latch, keep watching
+                    self.Flameout.clear()
+            self.Ignition.update()
+
+        self.Bus.publish(TEMPS, Ts)
+
+    def UpdateFeedforward(self, Ts):
+        """Update feedforward terms on every sample, so firebox disturbances are acted on between control cycles.
+
+        @param Ts: Latest temperature sample
+        @type Ts: TemperatureSample
+        """
+        ff = self.Feedforward.update(Ts.ambient, Ts.firebox, Ts.time)
+        if self.Parameters['mode'] == 'Hold' and self.Control.Last is not None:
+            u = min(max(self.Control.u + ff, U_MIN), self.MaxU())
+            if abs(u - self.Parameters['u']) > 0.005:
+                self.Parameters['u'] = u
 
     def readLCD(self):
         NewParameters = {}
-        while not self.qR.empty():
-            NewParameters.update(self.qR.get())
+        for Input in self.LCDInput.drain():
+            NewParameters.update(Input)
         return NewParameters
 
     def ParameterUpdateCallback(self, parameter, value):
-        _logger.info('New Parameters: %s -- %r (%r)', parameter, float(value), self.Parameters[parameter])
+        """Observer for Parameters, only called when a value actually changes.
+
+        @param parameter: Parameter name
+        @type parameter: str
+        @param value: New (validated) value
+        """
+        _logger.info('New Parameters: %s -- %r', parameter, value)
         if parameter == 'target':
-            self.Control.setTarget(float(value))
+            self.Control.setTarget(value)
         elif parameter in ['PB', 'Ti', 'Td']:
             self.Control.setGains(self.Parameters['PB'], self.Parameters['Ti'], self.Parameters['Td'])
+        elif parameter in ['FFAmb', 'FFFirebox']:
+            self.Feedforward.setGains(self.Parameters['FFAmb'], self.Parameters['FFFirebox'])
         elif parameter == 'PMode':
             self.ModeUpdated()
         elif parameter == 'mode':
             self.ModeUpdated()
         elif parameter == 'program':
-            self.ReadProgram()
-            self.ProcessProgram()
-            # TODO: Figure out reason for break after program
-            # break  # Stop processing new parameters - not sure why?
-        # Write parameters back after all changes have been handled.
-        self.db.WriteParameters(self.Parameters)
-
-    def UpdateParameters(self):
-        # Loop through each key, see what changed
-        NewParameters = self.db.ReadParameters() or {}
-        NewParameters.update(self.readLCD())
-        for k in NewParameters.keys():
-            _logger.info('New self.Parameters: %s -- %r (%r)', k, float(NewParameters[k]), self.Parameters[k])
-            if k in ['target', 'PB', 'Ti', 'Td', 'PMode']:
-                if float(self.Parameters[k]) != float(NewParameters[k]):
-                    self.Parameters[k] = float(NewParameters[k])
-            elif k == 'mode':
-                if self.Parameters[k] != NewParameters[k]:
-                    self.Parameters[k] = NewParameters[k]
-            elif k == 'program':
-                if self.Parameters[k] != NewParameters[k]:
-                    self.Parameters[k] = NewParameters[k]
-                    self.Parameters['LastReadProgram'] = time() - 10000
-                    # TODO: Figure out reason for break after program
-                    # break  # Stop processing new parameters - not sure why?
-            elif k == 'CycleTime':
-                if self.Parameters[k] != NewParameters[k]:
-                    self.Parameters[k] = NewParameters[k]
-                    self.Temps = Temperature_Record(self.Temps or (), maxlen=int(self.Parameters[k] / TEMP_INTERVAL))
+            if value:
+                self.Parameters['LastReadProgram'] = time() - 10000
+                if self.ProgramReader is not None:
+                    self.ProgramReader()  # A program that turns out to be new restarts through LoadProgram
+                else:
+                    self.ReadProgram()
+                self.ProcessProgram()
+        elif parameter == 'CycleTime':
+            self.Temps = Temperature_Record(self.Temps or (), maxlen=max(1, int(value / TEMP_INTERVAL)))
+        # Changes are written back by FlushParameters() once all of them have been handled.
+
+    def UpdateParameters(self, NewParameters=None):
+        """Apply new parameters from the backend and LCD.
+
+        Values are validated by Parameters.ingest(); malformed or out of range values are logged and skipped.  The
+        backend is never read here: main() reads it on a worker thread and passes the result in.
+
+        @param NewParameters: [Optional] Parameters read from the backend (None or {} when there is nothing new)
+        @type NewParameters: dict
+        @return: Parameters which changed
+        @rtype: dict
+        """
+        # Someone at the smoker takes precedence over the backend
+        return self.Parameters.ingest(merge_parameters(self.readLCD(), NewParameters))
 
     def GetAverageSince(self, startTime, probe='grill'):
         # TODO: Rolling average
         n = 0
         total = 0
         for Ts in self.Temps:
-            if Ts['time'] < startTime:
+            if Ts.time < startTime:
                 continue
-            total += Ts[probe]
+            total += getattr(Ts, probe)
             n += 1
         return total / n
 
     # Modes
     def ModeUpdated(self):
+        if self.Parameters['mode'] != 'Start':
+            self.StartTime = None
+
         if self.Parameters['mode'] == 'Off':
             _logger.info('Setting mode to Off')
             self.G.Initialize()
+            self.Ignition.reset()
+            self.ResetFlameout()
 
         elif self.Parameters['mode'] == 'Shutdown':
             self.G.Initialize()
             self.G.SetState('fan', True)
+            self.Ignition.reset()
+            self.ResetFlameout()
 
         elif self.Parameters['mode'] == 'Start':
+            if self.StartTime is None:
+                self.StartTime = time()
+            self.Ignition.reset()
+            self.ResetFlameout()
             self.G.SetState('fan', True)
             self.G.SetState('auger', True)
             self.G.SetState('igniter', True)
@@ -320,14 +445,13 @@ class PiSmoker(object):
         elif self.Parameters['mode'] == 'Shutdown':
             if (now - self.G.ToggleTime['fan']) > SHUTDOWN_TIME:
                 self.Parameters['mode'] = 'Off'
-                self.ModeUpdated()
 
         elif self.Parameters['mode'] == 'Start':
             self.DoAugerControl()
-            self.G.SetState('igniter', True)
-            if self.Temps[-1]['grill'] > STARTUP_TEMP:
-                self.Parameters['mode'] = 'Hold'
-                self.ModeUpdated()
+            if self.Ignition.Ignited or self.Temps[-1].grill > STARTUP_TEMP:
+                self.FinishStart()
+            else:
+                self.G.SetState('igniter', True)
 
         elif self.Parameters['mode'] == 'Smoke':
             self.DoAugerControl()
@@ -340,16 +464,62 @@ class PiSmoker(object):
             self.DoControl()
             self.DoAugerControl()
 
-    def WriteParameters(self):
-        """Write parameters to file"""
+    def FinishStart(self):
+        """Hand over from Start to Hold once the fire is lit, with the integrator pre-loaded from the Start duty."""
+        u_start = self.Parameters['u']
+        duration = time() - (self.StartTime or time())
+        _logger.info('Start to Hold in %.0f s (%s)', duration,
+                     self.Ignition.Ignited and 'firebox ignition' or 'grill above %i' % STARTUP_TEMP)
+        self.StartTime = None
+        self.Parameters['StartDuration'] = duration
+        self.G.SetState('igniter', False)
+        self.Parameters['mode'] = 'Hold'
+        # P contributes 0.5 at target, so this holds the Start duty at target until the integrator learns more.
+        self.Control.setIntegrator(u_start - 0.5)
+
+    def NextDeadline(self):
+        """Time at which DoMode next has something to do (auger toggle, control update, shutdown timer, program step).
+
+        @return: time() of the next deadline
+        @rtype: float
+        """
+        now = time()
+        deadlines = [now + MODE_INTERVAL]
+        mode = self.Parameters['mode']
+        if mode == 'Shutdown':
+            deadlines.append(self.G.ToggleTime['fan'] + SHUTDOWN_TIME)
+        elif mode in ['Start', 'Smoke', 'Ignite', 'Hold']:
+            if self.G.GetState('auger'):
+                deadlines.append(self.G.ToggleTime['auger'] + self.Parameters['CycleTime'] * self.Parameters['u'])
+            else:
+                deadlines.append(self.G.ToggleTime['auger'] + self.Parameters['CycleTime'] *
+                                 (1 - self.Parameters['u']))
+            if mode == 'Hold':
+                deadlines.append(self.Control.LastUpdate + self.Parameters['CycleTime'])
+        if self.Parameters['program'] and self.Engine.next_deadline() is not None:
+            deadlines.append(self.Engine.next_deadline())
+        # DoMode compares with '>', so land just after the deadline rather than on it.
+        return max(min(deadlines), now) + 0.01
 
+    def WriteParameters(self):
+        """Record relay states in the parameters.  The backend write happens in FlushParameters()."""
         for r in self.relays:
             self.Parameters[r] = self.G.GetState(r)
 
-        self.Parameters['LastWritten'] = time()
-        self.qP.put(self.Parameters)
+    def FlushParameters(self):
+        """Send everything that changed since the last flush as a single patch.  Called once per loop tick.
 
-        self.db.WriteParameters(self.Parameters)
+        @return: Patch that was written (empty if nothing changed)
+        @rtype: dict
+        """
+        self.WriteParameters()
+        patch = self.Parameters.dirty()
+        if patch:
+            self.Parameters.clear_dirty()
+            self.Parameters.LastWritten = patch['LastWritten'] = time()  # Bypasses dirty tracking
+            self.Bus.publish(PARAMETERS, self.Parameters.to_dict())
+            self.db.WriteParameters(patch)
+        return patch
 
     def DoAugerControl(self):
         # Auger currently on AND TimeSinceToggle > Auger On Time
@@ -367,10 +537,44 @@ class PiSmoker(object):
             self.CheckIgniter()
             self.WriteParameters()
 
+    def Reignite(self):
+        """Start a controlled re-ignite after a firebox flame-out: igniter on, fan on, auger duty capped."""
+        _logger.info('Firebox flame-out, re-igniting')
+        self.ReigniteTime = time()
+        self.G.SetState('fan', True)
+        self.G.SetState('igniter', True)
+        self.Parameters['u'] = min(self.Parameters['u'], REIGNITE_U)
+        self.WriteParameters()
+
+    def MaxU(self):
+        if self.ReigniteTime is not None:
+            return REIGNITE_U
+        return U_MAX
+
+    def ResetFlameout(self):
+        # New fire (or none): forget any flame-out and re-ignite attempt from the last one
+        self.Flameout.reset()
+        self.ReigniteTime = None
+
     def CheckIgniter(self):
-        # Check if igniter needed
-        # TODO: Update igniter check code
-        if self.Temps[-1]['grill'] < IGNITER_TEMP:
+        # Re-ignite in progress, hold the igniter on until the firebox recovers
+        if self.ReigniteTime is not None:
+            if self.Flameout.recovered():
+                _logger.info('Firebox re-lit after %.0f s', time() - self.ReigniteTime)
+                self.ReigniteTime = None
+                self.Flameout.clear()
+            elif time() - self.ReigniteTime > REIGNITE_TIME:
+                _logger.info('Firebox did not re-light in %.0f s', time() - self.ReigniteTime)
+                self.ReigniteTime = None
+                self.Flameout.clear()
+            else:
+                self.G.SetState('igniter', True)
+                return
+
+        # Check if igniter needed, a lit firebox overrides the (much slower) grill temperature check
+        if self.Ignition.Ignited:
+            self.G.SetState('igniter', False)
+        elif self.Temps[-1].grill < IGNITER_TEMP:
             self.G.SetState('igniter', True)
         else:
             self.G.SetState('igniter', False)
@@ -380,77 +584,89 @@ class PiSmoker(object):
             _logger.info('Disabling igniter due to timeout')
             self.G.SetState('igniter', False)
             self.Parameters['mode'] = 'Shutdown'
-            self.ModeUpdated()
 
     def DoControl(self):
         if (time() - self.Control.LastUpdate) > self.Parameters['CycleTime']:
-            self.Parameters['u'] = min(max(self.Control.update(self.Temps.average()['grill']), U_MIN), U_MAX)
-            _logger.info('u %f', self.Parameters['u'])
+            # Shift the PID limits by the feedforward term so anti-windup sees the real output clamp
+            ff = self.Feedforward.u
+            self.Control.setLimits(U_MIN - ff, U_MAX - ff)
+            if self.Estimator.initialized():
+                u = self.Control.update(self.Estimator.T, Rate=self.Estimator.Rate)
+            else:
+                u = self.Control.update(self.Temps.average().grill)
+            self.Parameters['u'] = min(max(u + ff, U_MIN), self.MaxU())
+            _logger.info('u %f (FF %f)', self.Parameters['u'], ff)
 
             # Post control state
             D = {'time':  time() * 1000, 'u': self.Parameters['u'], 'P': self.Control.P, 'I': self.Control.I,
                  'D':     self.Control.D,
                  'PID':   self.Control.u, 'Error': self.Control.error, 'Derv': self.Control.Derv,
-                 'Inter': self.Control.Inter}
+                 'Inter': self.Control.Inter, 'Estimate': self.Estimator.T,
+                 'FF':    ff, 'FFAmb': self.Feedforward.Amb, 'FFFirebox': self.Feedforward.FB}
 
             self.db.WriteControl(D)
+            if self.CookLog is not None:
+                self.CookLog.log_control(D['time'] / 1000, MODES.index(self.Parameters['mode']), D['u'], D['P'],
+                                         D['I'], D['D'], D['Estimate'])
 
             self.WriteParameters()
 
         return self.Parameters
 
     def ReadProgram(self):
+        """Read the program from the backend and load it.  Blocks on the backend, main() reads on a worker instead."""
+        self.LoadProgram(self.db.ReadProgram(self.Parameters['program']))
+
+    def LoadProgram(self, NewProgram):
+        """Switch to a program read from the backend, if it differs from the one running.
+
+        @param NewProgram: Steps returned by the backend's ReadProgram, None when it had nothing
+        @type NewProgram: list
+        @rtype: bool
+        """
         # Check if program is new
-        NewProgram = self.db.ReadProgram(self.Parameters['program'])
-        if NewProgram and self.Program != NewProgram:
+        if NewProgram and self.Engine.remaining() != NewProgram:
             _logger.info('Detected new program')
-        self.SetProgram(NewProgram)
+            self.SetProgram(NewProgram)
+            return True
+        return False
 
     def EvaluateTriggers(self):
-        now = time()
-        if self.Parameters['program'] and len(self.Program) > 0:
-            P = self.Program[0]
-
-            if P['trigger'] == 'Time':
-                if now - self.Parameters['ProgramToggle'] > float(P['triggerValue']):
-                    self.NextProgram()
-
-            elif P['trigger'] == 'MeatTemp':
-                if self.Temps[-1]['meat'] > float(P['triggerValue']):
-                    self.NextProgram()
+        if self.Parameters['program'] and self.Temps:
+            rate = self.Estimator.Rate * 60 if self.Estimator.initialized() else None
+            if self.Engine.update(time(), self.Temps[-1], rate):
+                self.NextProgram()
 
     def NextProgram(self):
         _logger.info('Advancing to next program')
-        self.Program.pop(0)  # Remove current program
-
-        self.db.WriteProgram(self.Program)
-        if len(self.Program) > 0:
-            self.ProcessProgram()
-        else:
-            _logger.info('Last program reached, disabling program')
-            self.Parameters['program'] = False
-            self.WriteParameters()
+        self.Engine.advance(time())
 
-    def ProcessProgram(self):
-        if self.Program:
-            if len(self.Program) > 0:
-                self.Parameters['ProgramToggle'] = time()
+        self.db.AdvanceProgram(self.Engine.remaining())
+        self.ProcessProgram(restart=False)
 
-                P = self.Program[0]
-                self.Parameters['mode'] = P['mode']
-                self.ModeUpdated()
+    def ProcessProgram(self, restart=True):
+        """Apply the active program step, or switch programs off when there is none.
 
-                self.Parameters['target'] = float(P['target'])
-                self.Control.setTarget(self.Parameters['target'])
-                self.WriteParameters()
+        @param restart: Restart the step's trigger clock (False when NextProgram already started it)
+        @type restart: bool
+        """
+        step = self.Engine.current()
+        if step is not None:
+            self.Parameters['ProgramToggle'] = time()
+            if restart:
+                self.Engine.start(self.Parameters['ProgramToggle'])
+            # Program steps come from the backend, so validate them like any other external input
+            self.Parameters.ingest({'mode': step.mode, 'target': step.target})
+            self.WriteParameters()
 
-            else:
-                _logger.info('Last program reached, disabling program')
-                self.Parameters['program'] = False
-                self.WriteParameters()
+        elif self.Engine.Steps and self.Parameters['program']:
+            _logger.info('Last program reached, disabling program')
+            self.Parameters['program'] = False
+            self.WriteParameters()
 
     def SetProgram(self, Program):
         self.Program = Program
+        self.Engine.load(Program)
         self.ProcessProgram()
 
 
@@ -464,72 +680,170 @@ def main(*args, **kwargs):
                                    read_cj_fn=ADS_ADC.read_its, temp_in_F=True)
     firebox_probe = TemperatureProbe(THERMOCOUPLE, read_fn=ADS_ADC.read, read_fn_kwargs={'channel': _FIREBOX_CHANNEL},
                                      read_cj_fn=ADS_ADC.read_its, temp_in_F=True)
+    ambient_probe = TemperatureProbe(INTERNAL, read_fn=ADS_ADC.read_its, temp_in_F=True)
     Probes = {'grill':   grill_probe,
               'meat':    meat1_probe,
-              'firebox': firebox_probe}
-
-    # Start firebase
-    auth_file = SMOKER_AUTH_TOKEN_TXT
-    if 'auth' in kwargs:
-        auth_file = kwargs['auth']
-    elif len(args) > 0:
-        auth_file = args[0]
-    f = open(auth_file, 'r')
-    Secret = f.read()
-    f.close()
-    firebase_db = Firebase_Backend(FB_URL, Secret)
-
-    # Initialize LCD
-    qP = Queue()  # Queue for Parameters
-    qT = Queue()  # Queue for Temps
-    qR = Queue()  # Return for Parameters
-    qT.put({'time':0, 'grill': 0, 'meat1': 0})
-    #lcd = LCDDisplay(qP, qT, qR)
-    #lcd.setDaemon(True)
-    #lcd.start()
+              'firebox': firebox_probe,
+              'ambient': ambient_probe}
+
+    # Start backend: Firebase (default), a local SQLite database which needs no network, or several at once
+    # (e.g. backend='sqlite+firebase', read precedence in that order)
+    def Backend(name):
+        if name == 'sqlite':
+            return Instrumented(SQLite_Backend(kwargs.get('db_path', DB_PATH)), 'sqlite')
+        elif name == 'firebase':
+            auth_file = SMOKER_AUTH_TOKEN_TXT
+            if 'auth' in kwargs:
+                auth_file = kwargs['auth']
+            elif len(args) > 0:
+                auth_file = args[0]
+            f = open(auth_file, 'r')
+            Secret = f.read()
+            f.close()
+            # Writes are spooled and delivered by a worker, so the loop never waits on the network and outages lose
+            # nothing
+            # On a metered link, compact=True and a linger of a minute or so cut the upload to a few percent
+            firebase = Instrumented(Firebase_Backend(FB_URL, Secret, async=False, compact=kwargs.get('compact', False)),
+                                    'firebase')
+            return Buffered_Backend(firebase, kwargs.get('spool_path', SPOOL_PATH), linger=kwargs.get('linger', 0))
+        raise ValueError('Unknown backend %r' % name)
+
+    names = kwargs.get('backend', 'firebase').split('+')
+    if len(names) == 1:
+        backend_db = Instrumented(Backend(names[0]), 'backend')
+    else:
+        backend_db = Instrumented(Composite_Backend([Sink(Backend(name), name, **SINK_POLICIES.get(name, {}))
+                                                     for name in names]), 'backend')
+
+    Loop = Scheduler()
+    Bus = TelemetryBus()
 
     ##############
     # Setup       #
     ##############
 
     # Default parameters
-    Smoker = PiSmoker(firebase_db, qT=qT, qP=qP, qR=qR, relays=_RELAYS)
+    Log = CookLog(kwargs.get('cooklog_path', COOKLOG_PATH))
+    Smoker = PiSmoker(backend_db, bus=Bus, relays=_RELAYS, cooklog=Log)
 
-    # Setup variables
-    # Parameters['LastReadProgram'] = time.time()
-    # Parameters['LastReadWeb'] = time.time()
+    # Downsampled history and min/mean/max rollups for the plots, kept up to date as samples arrive
+    Hist = History(Log)
+    Bus.subscribe(TEMPS, callback=lambda Ts: Hist.add(Smoker.Parameters['target'], Ts))
+
+    # Initialize LCD
+    #lcd = LCDDisplay(Bus)
+    #lcd.setDaemon(True)
+    #lcd.start()
 
     ###############
     # Main Loop    #
     ###############
+    # Each activity is its own task on the scheduler.  Probe reads and backend polls run on worker threads and hand
+    # their results back to the loop thread, so the relay deadlines in Mode are never held up by SPI or network I/O.
+    state = {'mode': None, 'program': None}
+
+    def Mode():
+        # Runs at the next relay/control deadline, or early when new temperatures or parameters arrive.
+        Loop.cancel(state['mode'])
+        with timed('stage.EvaluateTriggers'):
+            Smoker.EvaluateTriggers()
+        with timed('stage.DoMode'):
+            Smoker.DoMode()
+        with timed('stage.FlushParameters'):
+            Smoker.FlushParameters()
+        state['mode'] = Loop.call_at(Smoker.NextDeadline(), Mode)
+
+    def Temps(Ts):
+        with timed('stage.RecordTemps'):
+            Smoker.RecordTemps(Ts)
+        Mode()
+
+    def Parameters(NewParameters=None):
+        # NewParameters is None on the polls where the backend had nothing new
+        with timed('stage.UpdateParameters'):
+            changed = Smoker.UpdateParameters(NewParameters or {})
+        if changed:
+            Mode()
+
+    def ProgramChanged():
+        # The program arrives as several pushed changes; read it once they stop
+        Loop.cancel(state['program'])
+        state['program'] = Loop.call_later(PROGRAM_SETTLE, Program)
+
+    def ReadProgram():
+        # Worker thread: the backend may block on the network
+        return backend_db.ReadProgram(Smoker.Parameters['program'])
+
+    def Program():
+        Loop.run_in_worker(ReadProgram, LoadProgram)
+
+    def LoadProgram(NewProgram):
+        with timed('stage.LoadProgram'):
+            changed = Smoker.LoadProgram(NewProgram)
+        if changed:
+            Mode()
+
+    Smoker.ProgramReader = Program
+
+    ReadTemps = timed_fn('stage.ReadTemps', Smoker.ReadTemps)
+
+    # Apply web UI changes as the backend pushes them (the ReadParameters poll below stays as a fallback)
+    if backend_db.Subscribe(lambda changes: Loop.call_soon(Parameters, changes),
+                            lambda changes: Loop.call_soon(ProgramChanged)):
+        _logger.info('Streaming parameters from the backend')
+
+    # Apply LCD button input straight away rather than on the next backend poll
+    Bus.subscribe(LCD_INPUT, callback=lambda NewParameters: Loop.call_soon(Parameters, {}))
+
+    # Prometheus style metrics on http://<pi>:9105/metrics
+    registry = MetricsRegistry()
+    metrics = MetricsServer(registry, collect=PiSmokerCollector(Smoker, registry))
+    metrics.start()
+
+    # The www dashboard served locally on http://<pi>:8080/, with temperatures and parameters pushed over a WebSocket;
+    # changes made there are validated by the server and applied on the loop thread like pushed backend changes
+    def SetProgram(steps):
+        # Stored either way, but only applied while programs are on, as ReadProgram does for the backend's.  Otherwise
+        # it is loaded to start when programs are switched on: backends do not hand the smoker's own writes back
+        Smoker.db.WriteProgram(steps)
+        if not Smoker.Parameters['program']:
+            Smoker.Program = steps
+            Smoker.Engine.load(steps)
+        elif Smoker.Engine.remaining() != steps:
+            Smoker.SetProgram(steps)
+            Mode()
+
+    def GetProgram():
+        return Smoker.Engine.remaining() if Smoker.Parameters['program'] else Smoker.Program
+
+    web = WebServer(Bus, history=Hist, on_parameters=lambda changes: Loop.call_soon(Parameters, changes),
+                    on_program=lambda steps: Loop.call_soon(SetProgram, steps), get_program=GetProgram,
+                    port=kwargs.get('web_port', WEB_PORT))
+    web.start()
+
+    # Timing report: logged periodically, on SIGUSR1 (kill -USR1 <pid>) and at exit
+    signal(SIGUSR1, log_report)
+
     sleep(5)  # Wait for clock to sync
     _return_value = 1
-    #try:
-    while 1:
-        # Record temperatures
-        Smoker.UpdateTemps(Probes)
-
-        # Check for new parameters
-        Smoker.UpdateParameters()
-
-        # Check for new program
-        Smoker.ProcessProgram()
-
-        # Evaluate triggers
-        Smoker.EvaluateTriggers()
-
-        # Do mode
-        Smoker.DoMode()
-
-        sleep(0.05)
-    #except KeyboardInterrupt:
-    #    _return_value = 0
-    #    pass
-    #finally:
-    #    for relay in Smoker.relays:
-    #        # Shutdown all relays if possible.
-    #        Smoker.G.SetState(relay_id=relay, state=False)
-    #    return _return_value
+    try:
+        Loop.every(TEMP_INTERVAL, Loop.run_in_worker, ReadTemps, Temps, Probes, name='ReadTemps')
+        Loop.every(PARAMETER_INTERVAL, Loop.run_in_worker, backend_db.ReadParameters, Parameters,
+                   name='ReadParameters')
+        Loop.every(REPORT_INTERVAL, log_report, start=time() + REPORT_INTERVAL)
+        Loop.every(COOKLOG_FLUSH_INTERVAL, Log.flush)
+        Loop.call_soon(Mode)
+        Loop.run()
+    except KeyboardInterrupt:
+        _return_value = 0
+    finally:
+        Loop.stop()
+        for relay in Smoker.relays:
+            # Shutdown all relays if possible.
+            Smoker.G.SetState(relay_id=relay, state=False)
+        log_report()
+        Log.close()
+    return _return_value
 
 
 if __name__ == '__main__':
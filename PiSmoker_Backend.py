@@ -28,15 +28,27 @@ class PiSmoker_Backend(object):
 
         @param target_temp: Target Temperature
         @type target_temp: float
-        @param Ts: List of time, temperatures...
-        @type Ts: [float, ...]
-        @return: Dictionary to store
+        @param Ts: Temperature sample
+        @type Ts: TemperatureSample.TemperatureSample
+        @return: Dictionary to store, probes in their fixed columns (TemperatureSample.PROBE_COLUMNS)
         @rtype: dict
         """
-        T = {'time': Ts['time'] * 1000, 'TT': target_temp}
-        T.update({'T%i' % i: Ts[k] for (i,k) in enumerate(Ts) if k != 'time'})
+        T = Ts.columns()
+        T['time'] = Ts.time * 1000
+        T['TT'] = target_temp
         return T
 
+    def PostTempBatch(self, batch):
+        """Store several temperature samples at once, e.g. a backlog being replayed.  Backends which can send them in
+        one request override this; by default they are posted one at a time.
+
+        @type batch: TempBatch.TempBatch
+        @return: -1 if a sample could not be stored (samples after it were not tried)
+        """
+        for target_temp, Ts in batch:
+            if self.PostTemps(target_temp, Ts) == -1:
+                return -1
+
     def WriteParameters(self, Parameters):
         raise NotImplementedError("Template class, must be implemented.")
 
@@ -52,9 +64,39 @@ class PiSmoker_Backend(object):
         """Write Control settings to backend"""
         raise NotImplementedError("Template class, must be implemented.")
 
+    def WriteControlBatch(self, Ds):
+        """Write several control records at once, e.g. a backlog being replayed.  Backends which can send them in one
+        request override this; by default they are written one at a time.
+
+        @type Ds: [dict, ...]
+        @return: -1 if a record could not be stored (records after it were not tried)
+        """
+        for D in Ds:
+            if self.WriteControl(D) == -1:
+                return -1
+
     def WriteProgram(self, Program):
         """Write Control settings to backend"""
         raise NotImplementedError("Template class, must be implemented.")
 
     def ReadProgram(self, run_program):
         raise NotImplementedError("Template class, must be implemented.")
+
+    def AdvanceProgram(self, Program):
+        """The program moved on to its next step.  Backends which can drop completed steps cheaply override this;
+        by default the remaining steps are written out again.
+
+        @param Program: Steps remaining, the active one first
+        @type Program: [dict, ...]
+        """
+        return self.WriteProgram(Program)
+
+    def Subscribe(self, on_parameters, on_program=None):
+        """Push parameter and program changes instead of waiting to be polled, for backends that can.
+
+        @param on_parameters: on_parameters(changes) with only the changed keys, may be called on another thread
+        @param on_program: [Optional] on_program(changes) when the program changes
+        @return: True if the backend will push changes, False if it must be polled
+        @rtype: bool
+        """
+        return False
@@ -0,0 +1,194 @@
+import logging.config
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+MODES = ('Off', 'Start', 'Smoke', 'Hold', 'Ignite', 'Shutdown')
+
+
+class Parameter(object):
+    """Schema entry: name, type, default and valid range/choices for a single parameter.
+
+    @param external: Accepted from the backend or the LCD (otherwise the controller owns it and ingest() ignores it)
+    @type external: bool
+    """
+    __slots__ = ('name', 'type', 'default', 'min', 'max', 'choices', 'external')
+
+    def __init__(self, name, type, default, min=None, max=None, choices=None, external=False):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.min = min
+        self.max = max
+        self.choices = choices
+        self.external = external
+
+    def coerce(self, value):
+        """Convert value to this parameter's type and check it.
+
+        @raise ValueError: value is malformed or out of range
+        """
+        if self.type is bool:
+            if isinstance(value, basestring):
+                if value.lower() in ('true', '1', 'on'):
+                    return True
+                if value.lower() in ('false', '0', 'off', ''):
+                    return False
+                raise ValueError('%s: %r is not a boolean' % (self.name, value))
+            return bool(value)
+
+        try:
+            value = self.type(value)
+        except (TypeError, ValueError):
+            raise ValueError('%s: %r is not a %s' % (self.name, value, self.type.__name__))
+        if self.choices is not None and value not in self.choices:
+            raise ValueError('%s: %r not one of %r' % (self.name, value, self.choices))
+        if self.min is not None and not value >= self.min:  # 'not >=' also rejects NaN
+            raise ValueError('%s: %r below %r' % (self.name, value, self.min))
+        if self.max is not None and not value <= self.max:
+            raise ValueError('%s: %r above %r' % (self.name, value, self.max))
+        return value
+
+
+SCHEMA = (
+    # Set from the web UI / LCD
+    Parameter('mode', str, 'Off', choices=MODES, external=True),
+    Parameter('target', float, 225., 0., 700., external=True),
+    Parameter('PB', float, 60., 1., 1000., external=True),
+    Parameter('Ti', float, 180., 1., 1e6, external=True),
+    Parameter('Td', float, 45., 0., 1e4, external=True),
+    Parameter('PMode', float, 2., 0., 10., external=True),
+    Parameter('CycleTime', float, 20., 3., 3600., external=True),  # At least one PiSmoker.TEMP_INTERVAL
+    Parameter('program', bool, False, external=True),
+    Parameter('FFAmb', float, 0.004, 0., 1., external=True),
+    Parameter('FFFirebox', float, 0.05, 0., 10., external=True),
+    # Controller state, published but never taken from outside
+    Parameter('u', float, 0.15, 0., 1.),
+    Parameter('ProgramToggle', float, 0.),
+    Parameter('LastReadProgram', float, 0.),
+    Parameter('LastWritten', float, 0.),
+    Parameter('StartDuration', float, 0.),
+    Parameter('auger', bool, False),
+    Parameter('fan', bool, False),
+    Parameter('igniter', bool, False),
+)
+_SCHEMA = {p.name: p for p in SCHEMA}
+KEYS = tuple(p.name for p in SCHEMA)
+
+
+class PiSmoker_Parameters(object):
+    """Typed parameter store with per-key change notifications.
+
+    Values live in __slots__ (one per SCHEMA entry), so reads in the control loop are plain attribute loads and the
+    store has a fixed layout.  Item access (P['target']) is kept for existing callers.
+
+    * Assignments are validated against SCHEMA; unknown keys raise KeyError, bad values ValueError.
+    * ingest() is the entry point for untrusted input (backend, LCD): it validates each key, logs and skips anything
+      malformed instead of raising, and only applies keys marked external.
+    * Observers registered with subscribe() fire only when the value of one of their keys actually changes.
+    * Changed keys are tracked as dirty and bump version, for diff-only writes (see PiSmoker.FlushParameters).
+    """
+    __slots__ = KEYS + ('_dirty', '_observers', 'version')
+
+    def __init__(self, **overrides):
+        for p in SCHEMA:
+            object.__setattr__(self, p.name, p.default)
+        for key in overrides:
+            object.__setattr__(self, key, _SCHEMA[key].coerce(overrides[key]))
+        self._dirty = set(KEYS)
+        self._observers = {}
+        self.version = 0
+
+    # Mapping interface
+    def __getitem__(self, key):
+        if key not in _SCHEMA:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        try:
+            p = _SCHEMA[key]
+        except KeyError:
+            raise KeyError('Unknown parameter %r' % key)
+        value = p.coerce(value)
+        if getattr(self, key) == value:
+            return
+        object.__setattr__(self, key, value)
+        self._dirty.add(key)
+        self.version += 1
+        for callback in self._observers.get(key, ()):
+            callback(key, value)
+
+    def __contains__(self, key):
+        return key in _SCHEMA
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def keys(self):
+        return list(KEYS)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in KEYS]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in _SCHEMA else default
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'PiSmoker_Parameters(%r)' % self.to_dict()
+
+    # Notifications
+    def subscribe(self, keys, callback):
+        """Call callback(key, value) whenever one of keys changes value.
+
+        @param keys: Parameter names
+        @type keys: [str, ...]
+        @param callback: Observer
+        @type callback: callable
+        """
+        for key in keys:
+            if key not in _SCHEMA:
+                raise KeyError('Unknown parameter %r' % key)
+            self._observers.setdefault(key, []).append(callback)
+
+    def ingest(self, NewParameters):
+        """Apply untrusted input.  Never raises for bad input; returns the keys that changed.
+
+        @param NewParameters: Raw parameters from a backend or the LCD
+        @type NewParameters: dict
+        @return: Changed keys and their new values
+        @rtype: dict
+        """
+        changed = {}
+        for key in NewParameters or ():
+            p = _SCHEMA.get(key)
+            if p is None or not p.external:
+                continue
+            try:
+                value = p.coerce(NewParameters[key])
+            except ValueError as e:
+                logger.warning('Ignoring parameter: %s', e)
+                continue
+            if getattr(self, key) != value:
+                logger.info('New Parameters: %s -- %r (%r)', key, value, getattr(self, key))
+                self[key] = value
+                changed[key] = value
+        return changed
+
+    # Dirty tracking
+    def dirty(self):
+        """Changed keys and their current values since the last clear_dirty().
+
+        @rtype: dict
+        """
+        return {key: getattr(self, key) for key in self._dirty}
+
+    def clear_dirty(self):
+        self._dirty.clear()
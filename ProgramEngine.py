@@ -0,0 +1,255 @@
+import heapq
+import logging.config
+from collections import deque
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+STALL_WINDOW = 30 * 60  # Default look-back for Stall triggers
+
+
+class Condition(object):
+    """Compiled trigger.  start() is called when its step becomes active, check() on every evaluation."""
+    deadlines = ()  # Absolute times this condition is waiting for, filled by start()
+
+    def start(self, now):
+        pass
+
+    def check(self, now, Ts, rate):
+        """
+        @param now: time()
+        @param Ts: Latest temperature sample
+        @type Ts: TemperatureSample.TemperatureSample
+        @param rate: Grill rate of change (F/min), None if unknown
+        @type rate: float
+        @rtype: bool
+        """
+        raise NotImplementedError("Template class, must be implemented.")
+
+
+class Elapsed(Condition):
+    """'Time': triggerValue seconds after the step started."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = None
+
+    def start(self, now):
+        self.deadline = now + self.seconds
+        self.deadlines = (self.deadline,)
+
+    def check(self, now, Ts, rate):
+        return now > self.deadline
+
+
+class Threshold(Condition):
+    """'MeatTemp' / 'GrillTemp': probe above triggerValue."""
+
+    def __init__(self, probe, value):
+        self.probe = probe
+        self.value = value
+
+    def check(self, now, Ts, rate):
+        T = getattr(Ts, self.probe, None) if Ts is not None else None
+        return T is not None and T > self.value
+
+
+class Settled(Condition):
+    """'Rate': grill rate of change within +-triggerValue F/min, i.e. the grill has come to temperature."""
+
+    def __init__(self, value):
+        self.value = abs(value)
+
+    def check(self, now, Ts, rate):
+        return rate is not None and abs(rate) < self.value
+
+
+class Stall(Condition):
+    """'Stall': probe (meat by default) rose less than triggerValue F over the last window seconds.
+
+    Keeps only the samples inside the window, each is appended and dropped once, so a check is O(1) amortised.
+    """
+
+    def __init__(self, value, window=STALL_WINDOW, probe='meat'):
+        self.value = value
+        self.window = window
+        self.probe = probe
+        self.history = deque()
+        self.since = None
+
+    def start(self, now):
+        self.history.clear()
+        self.since = now
+
+    def check(self, now, Ts, rate):
+        T = getattr(Ts, self.probe, None) if Ts is not None else None
+        if T is None:
+            return False
+        if not self.history or Ts.time > self.history[-1][0]:
+            self.history.append((Ts.time, T))
+        while len(self.history) > 1 and self.history[1][0] <= now - self.window:
+            self.history.popleft()
+        if now - self.since < self.window:
+            return False  # Not watched for a full window yet
+        return T - self.history[0][1] < self.value
+
+
+class All(Condition):
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    def start(self, now):
+        for c in self.conditions:
+            c.start(now)
+        self.deadlines = tuple(d for c in self.conditions for d in c.deadlines)
+
+    def check(self, now, Ts, rate):
+        return all([c.check(now, Ts, rate) for c in self.conditions])  # Every child sees every sample (Stall)
+
+
+class Any(All):
+    def check(self, now, Ts, rate):
+        return any([c.check(now, Ts, rate) for c in self.conditions])
+
+
+def compile_condition(P):
+    """Build a Condition from a step (or a nested condition) dictionary.
+
+    {'trigger': 'Time'|'MeatTemp'|'GrillTemp'|'Rate'|'Stall', 'triggerValue': x} or
+    {'trigger': 'All'|'Any', 'conditions': [{...}, ...]}
+
+    @raise ValueError: Unknown trigger or malformed value
+    @rtype: Condition
+    """
+    trigger = P.get('trigger')
+    if trigger in ('All', 'Any'):
+        conditions = [compile_condition(c) for c in P.get('conditions') or ()]
+        if not conditions:
+            raise ValueError('%s trigger without conditions' % trigger)
+        return All(conditions) if trigger == 'All' else Any(conditions)
+
+    try:
+        value = float(P.get('triggerValue'))
+    except (TypeError, ValueError):
+        raise ValueError('Bad triggerValue %r for %s trigger' % (P.get('triggerValue'), trigger))
+    if trigger == 'Time':
+        return Elapsed(value)
+    elif trigger == 'MeatTemp':
+        return Threshold('meat', value)
+    elif trigger == 'GrillTemp':
+        return Threshold('grill', value)
+    elif trigger == 'Rate':
+        return Settled(value)
+    elif trigger == 'Stall':
+        return Stall(value, float(P.get('window', STALL_WINDOW)))
+    raise ValueError('Unknown trigger %r' % trigger)
+
+
+class Step(object):
+    __slots__ = ('mode', 'target', 'condition', 'raw')
+
+    def __init__(self, P):
+        """
+        @param P: Step as stored in the backend: {'mode', 'target', 'trigger', 'triggerValue'}
+        @type P: dict
+        @raise ValueError: Malformed step
+        """
+        self.mode = P.get('mode')
+        try:
+            self.target = float(P.get('target'))
+        except (TypeError, ValueError):
+            raise ValueError('Bad target %r' % P.get('target'))
+        self.condition = compile_condition(P)
+        self.raw = P
+
+
+class ProgramEngine(object):
+    """Runs a program compiled once into typed steps.
+
+    Only the active step is evaluated, and its time triggers are kept in a deadline heap, so a check costs the same
+    however long the program is: a heap peek for time, one comparison per temperature trigger of the current step.
+    Advancing moves an index rather than popping the front of a list.
+    """
+    Steps = None  # type: [Step, ...]
+    Raw = None  # type: [dict, ...]
+    Index = 0
+    _positions = None  # type: [int, ...]
+    _deadlines = None  # type: list
+
+    def __init__(self, Program=()):
+        self.load(Program)
+
+    def load(self, Program):
+        """Compile a program.  Malformed steps are logged and dropped.
+
+        @param Program: Steps as read from the backend
+        @type Program: [dict, ...]
+        """
+        self.Raw = list(Program or ())
+        self.Steps = []
+        self._positions = []  # Position of each compiled step in Raw
+        for i, P in enumerate(self.Raw):
+            try:
+                self.Steps.append(Step(P))
+                self._positions.append(i)
+            except (ValueError, AttributeError) as e:
+                logger.warning('Skipping program step %i (%r): %s', i, P, e)
+        self.Index = 0
+        self._deadlines = []
+
+    def current(self):
+        """Active step, None once the program has run out.
+
+        @rtype: Step
+        """
+        return self.Steps[self.Index] if self.Index < len(self.Steps) else None
+
+    def remaining(self):
+        """Raw steps not yet completed, including the active one (what the backend stores).
+
+        Malformed steps which were skipped stay in, so this compares equal to the program as it was loaded (and as
+        the backend holds it) until a step completes.
+        """
+        start = self._positions[self.Index - 1] + 1 if self.Index else 0
+        return self.Raw[start:]
+
+    def start(self, now):
+        """Start the active step's clock."""
+        step = self.current()
+        self._deadlines = []
+        if step is not None:
+            step.condition.start(now)
+            self._deadlines = list(step.condition.deadlines)
+            heapq.heapify(self._deadlines)
+
+    def advance(self, now):
+        """Move to the next step and start it.
+
+        @return: New active step (None at the end of the program)
+        @rtype: Step
+        """
+        self.Index += 1
+        self.start(now)
+        return self.current()
+
+    def next_deadline(self):
+        """Earliest pending time trigger of the active step, None if there is none."""
+        return self._deadlines[0] if self._deadlines else None
+
+    def update(self, now, Ts, rate=None):
+        """Evaluate the active step.
+
+        @param Ts: Latest temperature sample
+        @type Ts: TemperatureSample.TemperatureSample
+        @param rate: Grill rate of change (F/min)
+        @type rate: float
+        @return: True when the active step's trigger has fired
+        @rtype: bool
+        """
+        step = self.current()
+        if step is None:
+            return False
+        while self._deadlines and self._deadlines[0] < now:
+            heapq.heappop(self._deadlines)
+        return step.condition.check(now, Ts, rate)
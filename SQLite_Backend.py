@@ -0,0 +1,246 @@
+import json
+import logging.config
+import sqlite3
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+from time import time
+
+from Instrumentation import count
+from PiSmoker_Backend import PiSmoker_Backend
+from TemperatureSample import PROBE_COLUMNS
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+DB_PATH = '/home/pi/PiSmoker/PiSmoker.db'
+BATCH_SIZE = 500  # Most writes committed in one transaction
+BATCH_INTERVAL = 1.0  # Longest a write waits for more to batch with
+MAX_PENDING = 10000  # Writes queued for the writer thread before new ones are dropped
+
+TEMP_COLUMNS = ('time', 'TT') + tuple(column for probe, column in PROBE_COLUMNS)
+CONTROL_COLUMNS = ('time', 'u', 'P', 'I', 'D', 'PID', 'Error', 'Derv', 'Inter', 'Estimate', 'FF', 'FFAmb',
+                   'FFFirebox')
+SMOKER = 'smoker'  # Source of parameters and programs written by the controller itself
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS Temps (%s)' % ', '.join('%s REAL' % c for c in TEMP_COLUMNS),
+    'CREATE INDEX IF NOT EXISTS Temps_time ON Temps (time)',
+    'CREATE TABLE IF NOT EXISTS Controls (%s)' % ', '.join('%s REAL' % c for c in CONTROL_COLUMNS),
+    'CREATE INDEX IF NOT EXISTS Controls_time ON Controls (time)',
+    'CREATE TABLE IF NOT EXISTS Parameters (key TEXT PRIMARY KEY, value TEXT, source TEXT, seq INTEGER)',
+    'CREATE INDEX IF NOT EXISTS Parameters_seq ON Parameters (seq)',
+    'CREATE TABLE IF NOT EXISTS Program (step INTEGER PRIMARY KEY, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS ProgramSource (source TEXT)',
+)
+
+INSERT_TEMPS = 'INSERT INTO Temps (%s) VALUES (%s)' % (', '.join(TEMP_COLUMNS), ', '.join('?' * len(TEMP_COLUMNS)))
+INSERT_CONTROL = 'INSERT INTO Controls (%s) VALUES (%s)' % (', '.join(CONTROL_COLUMNS),
+                                                            ', '.join('?' * len(CONTROL_COLUMNS)))
+UPSERT_PARAMETER = 'INSERT OR REPLACE INTO Parameters (key, value, source, seq) VALUES (?, ?, ?, ' \
+                   '(SELECT COALESCE(MAX(seq), 0) + 1 FROM Parameters))'
+DELETE_PROGRAM = 'DELETE FROM Program'
+INSERT_PROGRAM = 'INSERT INTO Program (step, data) VALUES (?, ?)'
+DELETE_PROGRAM_SOURCE = 'DELETE FROM ProgramSource'
+INSERT_PROGRAM_SOURCE = 'INSERT INTO ProgramSource (source) VALUES (?)'
+COMPOUND = 'compound'  # Queued in place of a statement: params is ((sql, [params, ...]), ...), committed together
+
+
+# noinspection PyBroadException
+class SQLite_Backend(PiSmoker_Backend):
+    """Local SQLite (WAL mode) backend, works with no network at all.
+
+    Writes are only queued on the caller's thread.  A writer thread owns the write connection and commits whatever
+    has queued up in one transaction (up to BATCH_SIZE statements, grouped into executemany() per statement), so
+    logging every sample costs the control loop a Queue.put.  Reads use their own connection; WAL lets them run while
+    the writer commits.
+
+    Parameters are stored one row per key with the source of the last write.  ReadParameters() returns only keys
+    changed by someone other than the smoker (web UI, LCD, tools) since the previous call.  Likewise ReadProgram()
+    returns the program only when someone other than the smoker wrote it, so the smoker's own copy never shadows a
+    program uploaded through another backend.
+    """
+    _polling_interval = 0
+    _read_program_interval = 0
+    _queue = None  # type: Queue
+    _writer = None  # type: Thread
+    _read_lock = None  # type: Lock
+    _last_seq = 0
+
+    def __init__(self, path=DB_PATH, batch_size=BATCH_SIZE, batch_interval=BATCH_INTERVAL, max_pending=MAX_PENDING):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._queue = Queue(maxsize=max_pending)
+        self._read_lock = Lock()
+
+        self._reader = self._connect()
+        for statement in SCHEMA:
+            self._reader.execute(statement)
+        self._reader.commit()
+        self._last_seq = self._reader.execute('SELECT COALESCE(MAX(seq), 0) FROM Parameters').fetchone()[0]
+
+        self._writer = Thread(target=self._write_loop, name='SQLiteWriter')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')  # WAL + NORMAL: durable across application crashes, fsync on checkpoint
+        return db
+
+    # Writer thread
+    def _enqueue(self, sql, params):
+        try:
+            self._queue.put_nowait((sql, params))
+        except Full:
+            count('sqlite.dropped')
+            logger.info('SQLite write queue full, dropping write')
+            return -1
+
+    def _enqueue_all(self, statements):
+        """Queue several statements as one write, so they are committed (or dropped) together.
+
+        @param statements: ((sql, [params, ...]), ...)
+        """
+        return self._enqueue(COMPOUND, tuple((sql, list(rows)) for sql, rows in statements))
+
+    def _write_loop(self):
+        db = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            stop = batch[-1] is None
+            self._commit(db, [op for op in batch if op is not None])
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                db.close()
+                return
+
+    def _commit(self, db, batch):
+        if not batch:
+            return
+        # Group consecutive statements so each runs as one executemany() on the cached prepared statement
+        groups = []
+        for sql, params in batch:
+            if sql == COMPOUND:
+                groups.extend((statement, list(rows)) for statement, rows in params)
+            elif groups and groups[-1][0] == sql:
+                groups[-1][1].append(params)
+            else:
+                groups.append((sql, [params]))
+        try:
+            with db:
+                for sql, rows in groups:
+                    db.executemany(sql, rows)
+            count('sqlite.commits')
+            count('sqlite.rows', len(batch))
+        except sqlite3.Error as e:
+            count('sqlite.errors')
+            logger.info('Error writing to SQLite (%s), %i writes lost', e, len(batch))
+
+    def flush(self):
+        """Block until everything queued so far is committed."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._reader.close()
+
+    # PiSmoker_Backend
+    def PostTemps(self, target_temp, Ts):
+        T = super(SQLite_Backend, self).PostTemps(target_temp, Ts)
+        return self._enqueue(INSERT_TEMPS, tuple(T.get(c) for c in TEMP_COLUMNS))
+
+    def WriteControl(self, D):
+        return self._enqueue(INSERT_CONTROL, tuple(D.get(c) for c in CONTROL_COLUMNS))
+
+    def WriteControlBatch(self, Ds):
+        return self._enqueue_all([(INSERT_CONTROL, [tuple(D.get(c) for c in CONTROL_COLUMNS) for D in Ds])])
+
+    def WriteParameters(self, Parameters, source=SMOKER):
+        """Store a parameter patch.
+
+        @param source: Who is writing (the smoker, or e.g. 'web' / 'lcd' for requests the smoker should pick up)
+        @type source: str
+        """
+        return self._enqueue_all([(UPSERT_PARAMETER, [(key, json.dumps(Parameters[key]), source)
+                                                      for key in Parameters])])
+
+    def ReadParameters(self):
+        """Parameters changed by anyone but the smoker since the last call.
+
+        @rtype: dict
+        """
+        try:
+            with self._read_lock:
+                rows = self._reader.execute('SELECT key, value, source, seq FROM Parameters WHERE seq > ? ORDER BY seq',
+                                            (self._last_seq,)).fetchall()
+        except sqlite3.Error as e:
+            logger.info('Error reading parameters from SQLite (%s)', e)
+            return {}
+        NewParameters = {}
+        for key, value, source, seq in rows:
+            self._last_seq = max(self._last_seq, seq)
+            if source != SMOKER:
+                NewParameters[key] = json.loads(value)
+        return NewParameters
+
+    def ReadAllParameters(self):
+        with self._read_lock:
+            rows = self._reader.execute('SELECT key, value FROM Parameters').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def WriteProgram(self, Program, source=SMOKER):
+        """Replace the stored program in one transaction.  Queued, so it commits in order with the other writes.
+
+        @param source: Who is writing (the smoker, or e.g. 'web' / 'tool' for programs the smoker should pick up)
+        @type source: str
+        """
+        return self._enqueue_all([(DELETE_PROGRAM, [()]),
+                                  (INSERT_PROGRAM, [(i, json.dumps(P)) for i, P in enumerate(Program)]),
+                                  (DELETE_PROGRAM_SOURCE, [()]),
+                                  (INSERT_PROGRAM_SOURCE, [(source,)])])
+
+    def ReadProgram(self, run_program):
+        """
+
+        @param run_program: Only read when a program is running
+        @type run_program: bool
+        @return: Program steps, None if not running, empty or last written by the smoker
+        @rtype: [dict, ...]
+        """
+        if not run_program:
+            return None
+        try:
+            with self._read_lock:
+                # Programs stored before the source was recorded were written by the smoker
+                source = self._reader.execute('SELECT source FROM ProgramSource').fetchone()
+                if (source[0] if source else SMOKER) == SMOKER:
+                    return None
+                rows = self._reader.execute('SELECT data FROM Program ORDER BY step').fetchall()
+        except sqlite3.Error as e:
+            logger.info('Error reading Program from SQLite (%s)', e)
+            return None
+        return [json.loads(data) for (data,) in rows] or None
+
+    def ReadTemps(self, start, end=None):
+        """Temperature rows between two times (seconds), using the time index.
+
+        @rtype: [dict, ...]
+        """
+        end = time() if end is None else end
+        with self._read_lock:
+            rows = self._reader.execute('SELECT %s FROM Temps WHERE time BETWEEN ? AND ? ORDER BY time'
+                                        % ', '.join(TEMP_COLUMNS), (start * 1000, end * 1000)).fetchall()
+        return [dict(zip(TEMP_COLUMNS, row)) for row in rows]
@@ -0,0 +1,171 @@
+import heapq
+import logging.config
+import os
+import select
+from Queue import Queue
+from itertools import count
+from threading import Thread, Lock, current_thread
+from time import time
+
+from Instrumentation import count as count_event, histogram
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+
+class Event(object):
+    """Handle for a scheduled call, returned by Scheduler.call_at and friends."""
+    __slots__ = ('when', 'fn', 'args', 'interval', 'cancelled', 'name')
+
+    def __init__(self, when, fn, args, interval=None, name=None):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self.name = name or getattr(fn, '__name__', repr(fn))
+
+
+# noinspection PyBroadException
+class Scheduler(object):
+    """Single threaded deadline scheduler.
+
+    All callbacks run on the thread which calls run(), in deadline order.  Between deadlines the loop blocks in
+    select() on a wake-up pipe, so an idle smoker does not wake up at all until the next thing is due.  Blocking work
+    (SPI reads, network calls) is handed to a small pool of worker threads with run_in_worker(), and its result is
+    passed back to the loop thread, so it can never delay a relay toggle.
+    """
+    _heap = None
+    _lock = None
+    _seq = None
+    _running = False
+    _work = None  # type: Queue
+    _workers = None
+    _in_flight = None  # type: set
+    _thread = None
+    _jitter = None
+
+    def __init__(self, workers=2):
+        self._heap = []
+        self._lock = Lock()
+        self._seq = count()
+        self._wake_r, self._wake_w = os.pipe()
+        self._jitter = histogram('loop.jitter')
+        self._work = Queue()
+        self._in_flight = set()
+        self._workers = []
+        for i in range(workers):
+            t = Thread(target=self._worker, name='Worker-%i' % i)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    # Scheduling, safe to call from any thread
+    def call_at(self, when, fn, *args):
+        return self._push(Event(when, fn, args))
+
+    def call_later(self, delay, fn, *args):
+        return self._push(Event(time() + delay, fn, args))
+
+    def call_soon(self, fn, *args):
+        return self._push(Event(time(), fn, args))
+
+    def every(self, interval, fn, *args, **kwargs):
+        """Call fn every interval seconds.  Deadlines are kept on a fixed grid so they do not drift.
+
+        @param start: [Optional] First deadline (default: now)
+        @type start: float
+        @param name: [Optional] Task name used in logs and timing histograms (default: fn.__name__)
+        @type name: str
+        """
+        return self._push(Event(kwargs.get('start', time()), fn, args, interval, kwargs.get('name')))
+
+    def cancel(self, event):
+        if event is not None:
+            event.cancelled = True
+
+    def _push(self, event):
+        with self._lock:
+            heapq.heappush(self._heap, (event.when, next(self._seq), event))
+        if current_thread() is not self._thread:
+            self._wakeup()
+        return event
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    # Worker pool
+    def run_in_worker(self, fn, callback=None, *args):
+        """Run fn(*args) on a worker thread, then callback(result) on the loop thread.
+
+        Exceptions in fn are logged and the callback is skipped.  While an earlier call of the same fn is still queued
+        or running, fn is not queued again (counted in counters['worker.<name>.skipped']): a periodic backend read
+        stuck on the network then ties up at most one worker and never builds a queue for the probe reads to wait
+        behind.
+        """
+        with self._lock:
+            if fn in self._in_flight:
+                count_event('worker.%s.skipped' % getattr(fn, '__name__', 'task'))
+                return
+            self._in_flight.add(fn)
+        self._work.put((fn, args, callback))
+
+    def _worker(self):
+        while True:
+            fn, args, callback = self._work.get()
+            start = time()
+            try:
+                result = fn(*args)
+            except Exception:
+                logger.exception('Error in worker task %s', getattr(fn, '__name__', fn))
+                continue
+            finally:
+                with self._lock:
+                    self._in_flight.discard(fn)
+                histogram('worker.' + getattr(fn, '__name__', 'task')).record(time() - start)
+            if callback is not None:
+                self.call_soon(callback, result)
+
+    # Loop
+    def run(self):
+        self._thread = current_thread()
+        self._running = True
+        while self._running:
+            with self._lock:
+                timeout = self._heap[0][0] - time() if self._heap else None
+            if timeout is None or timeout > 0:
+                ready = select.select([self._wake_r], [], [], timeout)[0]
+                if ready:
+                    os.read(self._wake_r, 4096)
+            self._run_due()
+
+    def _run_due(self):
+        now = time()
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                event = heapq.heappop(self._heap)[2]
+            if event.cancelled:
+                continue
+            start = time()
+            self._jitter.record(start - event.when)
+            if event.interval:
+                event.when += event.interval
+                if event.when < now:
+                    # Fell behind (e.g. clock step), skip missed deadlines instead of bursting.
+                    event.when = now + event.interval - (now - event.when) % event.interval
+                self._push(event)
+            try:
+                event.fn(*event.args)
+            except Exception:
+                logger.exception('Error in scheduled task %s', event.name)
+            histogram('task.' + event.name).record(time() - start)
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
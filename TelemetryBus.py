@@ -0,0 +1,151 @@
+import logging.config
+from collections import deque
+from threading import Condition
+
+from Instrumentation import count
+
+# Start logging
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+# Topics
+PARAMETERS = 'parameters'  # Controller parameters snapshot (dict), published once per flush
+TEMPS = 'temps'  # Latest TemperatureSample
+LCD_INPUT = 'lcd.input'  # Parameter changes entered on the LCD buttons (dict), kept in a short history
+LCD_INPUT_HISTORY = 16
+
+
+class Topic(object):
+    """A single named value plus an optional bounded history of the values published before it.
+
+    Publishing replaces the value and bumps a sequence number; nothing is queued per subscriber, so memory stays the
+    same no matter how many subscribers there are or how far behind they fall.
+    """
+    __slots__ = ('name', 'value', 'seq', 'history', 'callbacks', 'cond')
+
+    def __init__(self, name, history=0):
+        self.name = name
+        self.value = None
+        self.seq = 0
+        self.history = deque(maxlen=history) if history else None
+        self.callbacks = []
+        self.cond = Condition()
+
+
+class Subscription(object):
+    """A consumer's read position on a topic.
+
+    A new subscriber gets the current value on its first poll(); on a topic with history it starts from the next
+    publish, so it is not handed input that was meant for whoever was there before.
+    """
+    __slots__ = ('topic', 'seen')
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.seen = 0 if topic.history is None else topic.seq
+
+    def poll(self):
+        """Latest value if anything was published since the last poll/drain, else None.  Skipped values are lost.
+
+        @return: Latest value or None
+        """
+        topic = self.topic
+        with topic.cond:
+            if topic.seq == self.seen:
+                return None
+            self.seen = topic.seq
+            return topic.value
+
+    def drain(self):
+        """Every value published since the last poll/drain, oldest first (topics with history only).
+
+        If the subscriber fell further behind than the topic's history, the oldest values are lost and counted in
+        counters['bus.<topic>.dropped'].
+
+        @rtype: list
+        """
+        topic = self.topic
+        with topic.cond:
+            if topic.seq == self.seen:
+                return []
+            if topic.history is None:
+                self.seen = topic.seq
+                return [topic.value]
+            missed = topic.seq - self.seen
+            if missed > len(topic.history):
+                count('bus.%s.dropped' % topic.name, missed - len(topic.history))
+                missed = len(topic.history)
+            self.seen = topic.seq
+            return list(topic.history)[-missed:]
+
+    def wait(self, timeout=None):
+        """Block until something new is published (or timeout), then poll().
+
+        @param timeout: Seconds to wait, None waits forever
+        @type timeout: float
+        """
+        topic = self.topic
+        with topic.cond:
+            if topic.seq == self.seen:
+                topic.cond.wait(timeout)
+        return self.poll()
+
+
+# noinspection PyBroadException
+class TelemetryBus(object):
+    """In-process publish/subscribe with latest-value (conflating) semantics.
+
+    Replaces the qT/qP/qR queues between the controller and the LCD.  A queue nobody drains grows for the whole cook;
+    a topic holds one value (plus a bounded history where asked for), and a slow consumer simply sees the newest
+    snapshot next time it looks instead of working through stale ones.  Any number of consumers may subscribe.
+    """
+    _topics = None  # type: dict
+
+    def __init__(self):
+        self._topics = {}
+
+    def topic(self, name, history=0):
+        """Get (or create) a topic.
+
+        @param history: Number of past values to keep for drain() (0: latest value only)
+        @type history: int
+        @rtype: Topic
+        """
+        t = self._topics.get(name)
+        if t is None:
+            t = self._topics.setdefault(name, Topic(name, history))
+        return t
+
+    def publish(self, name, value):
+        t = self.topic(name)
+        with t.cond:
+            t.value = value
+            t.seq += 1
+            if t.history is not None:
+                t.history.append(value)
+            t.cond.notify_all()
+            callbacks = list(t.callbacks)
+        for callback in callbacks:
+            try:
+                callback(value)
+            except Exception:
+                logger.exception('Error in %s subscriber', name)
+
+    def subscribe(self, name, callback=None):
+        """Subscribe to a topic.
+
+        @param callback: [Optional] Called as callback(value) on the publishing thread after every publish, keep it
+            short (e.g. hand off to the scheduler with call_soon)
+        @type callback: callable
+        @rtype: Subscription
+        """
+        t = self.topic(name)
+        if callback is not None:
+            with t.cond:
+                t.callbacks.append(callback)
+        return Subscription(t)
+
+    def latest(self, name, default=None):
+        """Current value of a topic without subscribing."""
+        t = self._topics.get(name)
+        return default if t is None or t.seq == 0 else t.value
@@ -0,0 +1,140 @@
+from base64 import b64encode, b64decode
+
+from TemperatureSample import TemperatureSample, PROBES
+
+VERSION = 1
+SCALE = 10  # Fixed point: temperatures are stored in tenths of a degree
+COLUMNS = ('target',) + PROBES
+
+
+def _put_varint(buf, n):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _get_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+class TempBatch(object):
+    """Temperature samples and their target, packed column by column for upload and spooling.
+
+    Layout: version byte, sample count, first time (ms), then the time deltas, then for each of COLUMNS one value
+    per sample.  Values are fixed point (SCALE), stored as the difference from the column's previous value, zigzag
+    mapped and offset by one so 0 can mean "no reading".  Every number is a varint, so a steady 3 s sample of four
+    probes and a target packs into about 7 bytes against ~110 as a JSON object under a push id.
+
+    Times are kept to the millisecond and temperatures to 1/SCALE degree.
+
+    >>> TempBatch.decode(TempBatch([(225., TemperatureSample(1.5, grill=224.96))]).encode()).rows
+    [(225.0, {'grill': 225.0, 'time': 1.5})]
+    """
+    __slots__ = ('rows',)
+
+    def __init__(self, rows=()):
+        """
+
+        @param rows: (target, TemperatureSample) pairs, in time order
+        """
+        self.rows = list(rows)
+
+    def append(self, target, Ts):
+        self.rows.append((target, Ts))
+
+    def extend(self, batch):
+        self.rows.extend(batch.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def encode(self):
+        """
+        @rtype: str
+        """
+        buf = bytearray([VERSION])
+        _put_varint(buf, len(self.rows))
+        prev = None
+        for target, Ts in self.rows:
+            t = int(round(Ts.time * 1000))
+            if prev is None:
+                _put_varint(buf, t)
+            else:
+                _put_varint(buf, _zigzag(t - prev))
+            prev = t
+        for column in COLUMNS:
+            prev = 0
+            for target, Ts in self.rows:
+                value = target if column == 'target' else getattr(Ts, column)
+                if value is None:
+                    buf.append(0)
+                    continue
+                v = int(round(value * SCALE))
+                _put_varint(buf, _zigzag(v - prev) + 1)
+                prev = v
+        return str(buf)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        @type data: str
+        @rtype: TempBatch
+        @raise ValueError: Unknown version or truncated data
+        """
+        data = bytearray(data)
+        if not data or data[0] != VERSION:
+            raise ValueError('Unknown TempBatch version %r' % (data[:1],))
+        try:
+            n, pos = _get_varint(data, 1)
+            samples = []
+            t = None
+            for i in range(n):
+                d, pos = _get_varint(data, pos)
+                t = d if t is None else t + _unzigzag(d)
+                samples.append(TemperatureSample(t / 1000.))
+            targets = [None] * n
+            for column in COLUMNS:
+                prev = 0
+                for i in range(n):
+                    d, pos = _get_varint(data, pos)
+                    if not d:
+                        continue
+                    prev += _unzigzag(d - 1)
+                    if column == 'target':
+                        targets[i] = float(prev) / SCALE
+                    else:
+                        setattr(samples[i], column, float(prev) / SCALE)
+        except IndexError:
+            raise ValueError('Truncated TempBatch')
+        return cls(zip(targets, samples))
+
+    def to_text(self):
+        """Encoded batch as base64, for JSON transports (Firebase, the spool)."""
+        return b64encode(self.encode())
+
+    @classmethod
+    def from_text(cls, text):
+        try:
+            data = b64decode(text)
+        except TypeError:
+            raise ValueError('Bad TempBatch text')
+        return cls.decode(data)
@@ -5,7 +5,8 @@ from functools import partial
 THERMOCOUPLE = 'TC'
 THERMISTOR = 'TR'
 RTD = 'RTD'
-VALID_PROBE_TYPES = [RTD, THERMISTOR, THERMOCOUPLE]
+INTERNAL = 'ITS'  # Sensor which reads directly in deg. C, e.g. the ADS1118 internal temperature sensor
+VALID_PROBE_TYPES = [RTD, THERMISTOR, THERMOCOUPLE, INTERNAL]
 
 # Parameters for RTD correction from IEC 751 (PT100)
 # Solved for alpha = 0.00385055
@@ -204,7 +205,8 @@ class TemperatureProbe(object):
                  thermis_fn=None, thermis_fn_args=None, temp_in_F=None, **kwargs):
         """
 
-        @param probe_type: Probe type, recognizes: [RTD, THERMISTOR, THERMOCOUPLE] (['RTD', 'TR', 'TC'])
+        @param probe_type: Probe type, recognizes: [RTD, THERMISTOR, THERMOCOUPLE, INTERNAL]
+                           (['RTD', 'TR', 'TC', 'ITS'])
         @type probe_type:  str
         @param read_fn:  Function which returns the ADC voltage. Signature read_fn(*read_fn_args,**read_fn_kwargs)
         @type read_fn: callable
@@ -314,6 +316,8 @@ class TemperatureProbe(object):
             Tc = self._read_THERMOCOUPLE()
         elif self.type == THERMISTOR:
             Tc = self._read_THERMISTOR()
+        elif self.type == INTERNAL:
+            Tc = self.read_fn()
         else:
             raise TypeError("Unknown probe type %s" % self.type)
 
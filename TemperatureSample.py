@@ -0,0 +1,78 @@
+PROBES = ('grill', 'meat', 'firebox', 'ambient')
+FIELDS = ('time',) + PROBES
+# Backend column for each probe, fixed so it never depends on dict ordering (the web UI plots T1 = grill, T2 = meat)
+PROBE_COLUMNS = (('grill', 'T1'), ('meat', 'T2'), ('firebox', 'T3'), ('ambient', 'T4'))
+
+
+class TemperatureSample(object):
+    """One temperature sample: time plus one slot per probe (None when the probe is not fitted).
+
+    Fixed layout, so a sample costs a single small object instead of a dict per reading.  Item access and get() are
+    kept so code written against the old {'time': ..., 'grill': ...} dicts keeps working.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, time=0., grill=None, meat=None, firebox=None, ambient=None):
+        self.time = time
+        self.grill = grill
+        self.meat = meat
+        self.firebox = firebox
+        self.ambient = ambient
+
+    @classmethod
+    def from_dict(cls, Ts):
+        """Build a sample from an old style dict (e.g. a logged 'Temps: {...}' line).
+
+        @type Ts: dict
+        @rtype: TemperatureSample
+        """
+        sample = cls(Ts.get('time', 0.))
+        for probe in PROBES:
+            if probe in Ts:
+                setattr(sample, probe, Ts[probe])
+        return sample
+
+    def __getitem__(self, key):
+        try:
+            value = getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def __iter__(self):
+        """Fields which hold a value, in FIELDS order."""
+        return (field for field in FIELDS if getattr(self, field) is not None)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self}
+
+    def columns(self):
+        """Probe readings keyed by backend column name.
+
+        @rtype: dict
+        """
+        T = {}
+        for probe, column in PROBE_COLUMNS:
+            value = getattr(self, probe)
+            if value is not None:
+                T[column] = value
+        return T
+
+    def __eq__(self, other):
+        return isinstance(other, TemperatureSample) and all(getattr(self, f) == getattr(other, f) for f in FIELDS)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        # Same text as the old dict samples, so FireboxMonitor.replay() can still read the logs
+        return repr(self.to_dict())
@@ -11,12 +11,16 @@ logger = logging.getLogger(__name__)
 class Traeger:
     _relays = None  # type: list
     ToggleTime = None  # type: dict
+    ToggleCount = None  # type: dict
     GPIO_Invert = False  # type: bool
+    # Called as listener(time, relay_id, state) on every toggle, e.g. CookLog.log_relay
+    listener = None  # type: callable
     _GPIO_MODE = GPIO.BCM
 
     def __init__(self, relays, invert=False):
         self._relays = relays
         self.ToggleTime = dict()
+        self.ToggleCount = {k: 0 for k in relays}
         self.GPIO_Invert = bool(invert)
 
     def Initialize(self):
@@ -34,6 +38,9 @@ class Traeger:
         state = bool(state)
         if self.GetState(relay_id) != state:
             logger.info('Toggling %s: %s', relay_id, state and 'On' or 'Off')
+            self.ToggleCount[relay_id] += 1
+            if self.listener is not None:
+                self.listener(time(), relay_id, state)
         self.ToggleTime[relay_id] = time()
         GPIO.output(self._relays[relay_id], state != self.GPIO_Invert)
 
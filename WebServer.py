@@ -0,0 +1,399 @@
+import errno
+import json
+import logging.config
+import mimetypes
+import os
+import socket
+import struct
+from base64 import b64encode
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from hashlib import sha1
+from select import select
+from threading import Thread, Condition, Lock
+from urlparse import urlsplit, parse_qs
+
+from Instrumentation import count
+from PiSmoker_Parameters import SCHEMA
+from ProgramEngine import Step
+from TelemetryBus import PARAMETERS, TEMPS
+
+logging.config.fileConfig('/home/pi/PiSmoker/logging.conf')
+logger = logging.getLogger(__name__)
+
+WEB_PORT = 8080
+WWW_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'www')
+SEND_TIMEOUT = 10.0  # A client whose socket takes nothing for this long is dropped
+MAX_BODY = 64 * 1024  # Largest request body or WebSocket message accepted
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PUSH_TOPICS = (TEMPS, PARAMETERS)
+
+# WebSocket opcodes
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+_EXTERNAL = {p.name: p for p in SCHEMA if p.external}
+
+
+def _frame(payload, opcode=OP_TEXT):
+    """Unmasked, unfragmented server frame."""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def _read_exact(rfile, n):
+    data = rfile.read(n)
+    if len(data) < n:
+        raise EOFError
+    return data
+
+
+def _read_frame(rfile):
+    """
+    @return: (opcode, payload)
+    @raise EOFError: Connection closed
+    @raise ValueError: Frame too large
+    """
+    b1, b2 = struct.unpack('!BB', _read_exact(rfile, 2))
+    n = b2 & 0x7f
+    if n == 126:
+        n = struct.unpack('!H', _read_exact(rfile, 2))[0]
+    elif n == 127:
+        n = struct.unpack('!Q', _read_exact(rfile, 8))[0]
+    if n > MAX_BODY:
+        raise ValueError('WebSocket frame of %i bytes' % n)
+    mask = bytearray(_read_exact(rfile, 4)) if b2 & 0x80 else None
+    payload = bytearray(_read_exact(rfile, n))
+    if mask:
+        for i in range(n):
+            payload[i] ^= mask[i & 3]
+    return b1 & 0x0f, str(payload)
+
+
+def temps_message(target, Ts):
+    """A sample shaped like a backend /Temps child (time in ms, T1..T4, TT), which is what the web UI plots."""
+    T = Ts.columns()
+    T['time'] = Ts.time * 1000
+    T['TT'] = target
+    return T
+
+
+class Client(object):
+    """One WebSocket connection.
+
+    Nothing is queued per message: the client holds its own read position on each pushed bus topic, and its writer
+    thread sends the newest value of whatever changed since it last looked.  A phone that falls behind skips
+    intermediate samples (counted as web.conflated) instead of building a backlog, and one that stops reading
+    entirely is dropped after SEND_TIMEOUT, so no client can hold up the controller or the other clients.
+    """
+
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.subscriptions = [(topic, server.bus.subscribe(topic)) for topic in PUSH_TOPICS]
+        self.cond = Condition()
+        self.send_lock = Lock()
+        self.closed = False
+        self.writer = Thread(target=self._write_loop, name='WebSocket-writer')
+        self.writer.setDaemon(True)
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify()
+
+    def send(self, payload, opcode=OP_TEXT):
+        """
+        @raise socket.timeout: The client took nothing for SEND_TIMEOUT
+        """
+        data = _frame(payload, opcode)
+        with self.send_lock:
+            # Never blocks in send(), so the reader (which shares the socket) needs no timeout
+            while data:
+                if not select([], [self.connection], [], SEND_TIMEOUT)[1]:
+                    raise socket.timeout('send')
+                try:
+                    data = data[self.connection.send(data, socket.MSG_DONTWAIT):]
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def _pending(self):
+        return any(subscription.topic.seq != subscription.seen for topic, subscription in self.subscriptions)
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and not self._pending():
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                for topic, subscription in self.subscriptions:
+                    seen = subscription.seen
+                    value = subscription.poll()
+                    if value is None:
+                        continue
+                    if seen and subscription.seen - seen > 1:
+                        count('web.conflated', subscription.seen - seen - 1)
+                    self.send(json.dumps({'type': topic, 'data': self.server.message(topic, value)}))
+                    count('web.sent')
+        except socket.error as e:  # Including socket.timeout
+            count('web.dropped_clients')
+            logger.info('Dropping WebSocket client (%s)', e)
+        finally:
+            self.closed = True
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# noinspection PyBroadException
+class WebServer(Thread):
+    """Local dashboard server, so www/ works on the smoker's own network with no internet connection.
+
+    Serves www/ as static files and, under /api:
+      GET   /api/parameters                  Latest parameters snapshot
+      PATCH /api/parameters                  {key: value}: web UI settings, validated against the parameter schema
+      GET   /api/program                     Program steps not yet completed
+      PUT   /api/program                     [step, ...]: replace the program
+      GET   /api/history?start=&end=&points= Series downsampled with LTTB (History.query)
+      GET   /api/rollups?start=&end=&width=  Per-minute or per-hour min/mean/max (History.rollups)
+      GET   /api/config.js                   Tells www/js to use this server rather than Firebase, and what it accepts
+      GET   /ws                              WebSocket: {'type': 'temps'|'parameters', 'data': ...} as they happen
+
+    Threaded (one thread per connection, plus a writer per WebSocket client) like the metrics server.  Changes are
+    not applied here: they are validated and handed to on_parameters / on_program, which main() runs on the control
+    loop's thread.
+    """
+
+    def __init__(self, bus, history=None, on_parameters=None, on_program=None, get_program=None, port=WEB_PORT,
+                 address='', root=WWW_ROOT):
+        """
+
+        @param bus: Telemetry bus the controller publishes temperatures and parameters on
+        @type bus: TelemetryBus.TelemetryBus
+        @param history: [Optional] For /api/history and /api/rollups
+        @type history: History.History
+        @param on_parameters: on_parameters(changes) with validated parameter changes
+        @param on_program: on_program(steps) with a validated new program
+        @param get_program: get_program() returns the current program steps
+        """
+        super(WebServer, self).__init__(name='WebServer')
+        self.setDaemon(True)
+        self.bus = bus
+        self.history = history
+        self.on_parameters = on_parameters
+        self.on_program = on_program
+        self.get_program = get_program
+        self.root = os.path.realpath(root)
+        self.clients = []
+        self._clients_lock = Lock()
+        for topic in PUSH_TOPICS:
+            bus.subscribe(topic, callback=lambda value: self._notify_clients())
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, status, body, content_type='application/json'):
+                if content_type == 'application/json':
+                    body = json.dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _body(self):
+                length = int(self.headers.getheader('content-length') or 0)
+                if length > MAX_BODY:
+                    raise ValueError('Request body too large')
+                return json.loads(self.rfile.read(length)) if length else None
+
+            def _dispatch(self):
+                parts = urlsplit(self.path)
+                query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+                try:
+                    if parts.path == '/ws' and self.command == 'GET':
+                        return server.websocket(self)
+                    if parts.path.startswith('/api/'):
+                        status, body, content_type = server.api(self.command, parts.path[5:], query, self._body)
+                        return self._reply(status, body, content_type)
+                    if self.command not in ('GET', 'HEAD'):
+                        return self._reply(405, {'error': 'Method not allowed'})
+                    status, body, content_type = server.static(parts.path)
+                    self._reply(status, body, content_type)
+                except ValueError as e:
+                    self._reply(400, {'error': str(e)})
+                except socket.error:
+                    raise
+                except Exception:
+                    logger.exception('Error serving %s %s', self.command, self.path)
+                    self._reply(500, {'error': 'Internal error'})
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((address, port), Handler)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    # Static files
+    def static(self, path):
+        if path.endswith('/'):
+            path += 'index.html'
+        full = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if not full.startswith(self.root + os.sep) or not os.path.isfile(full):
+            return 404, {'error': 'Not found'}, 'application/json'
+        with open(full, 'rb') as f:
+            body = f.read()
+        return 200, body, mimetypes.guess_type(full)[0] or 'application/octet-stream'
+
+    # REST
+    def api(self, method, path, query, body):
+        """
+        @param body: Callable returning the decoded JSON request body
+        @return: (status, body, content type)
+        @raise ValueError: Bad request
+        """
+        if path == 'config.js' and method == 'GET':
+            config = "var PISMOKER_API = '/api';\nvar PISMOKER_SETTABLE = %s;\n" % json.dumps(sorted(_EXTERNAL))
+            return 200, config, 'application/javascript'
+
+        if path == 'parameters':
+            if method == 'GET':
+                return 200, self.bus.latest(PARAMETERS, {}), 'application/json'
+            if method in ('PATCH', 'POST'):
+                changes = self.parameters(body())
+                if self.on_parameters is not None:
+                    self.on_parameters(changes)
+                return 200, changes, 'application/json'
+
+        elif path == 'program':
+            if method == 'GET':
+                return 200, list(self.get_program() if self.get_program else ()), 'application/json'
+            if method == 'PUT':
+                steps = body()
+                if not isinstance(steps, list):
+                    raise ValueError('Program must be a list of steps')
+                for i, P in enumerate(steps):
+                    try:
+                        Step(P)
+                    except (ValueError, AttributeError) as e:
+                        raise ValueError('Step %i: %s' % (i, e))
+                if self.on_program is not None:
+                    self.on_program(steps)
+                return 200, steps, 'application/json'
+
+        elif path in ('history', 'rollups') and method == 'GET':
+            if self.history is None:
+                return 404, {'error': 'No history'}, 'application/json'
+            end = float(query.get('end', 0)) or None
+            start = float(query.get('start', 0))
+            series = tuple(query['series'].split(',')) if 'series' in query else ('grill', 'meat', 'target')
+            if path == 'history':
+                result = self.history.query(start, end or float('inf'), int(query.get('points', 500)), series)
+            else:
+                width = {'minute': 60, 'hour': 3600}.get(query.get('width', 'minute'))
+                if width is None:
+                    raise ValueError('width must be minute or hour')
+                result = self.history.rollups(start, end or float('inf'), width, series)
+            return 200, result, 'application/json'
+
+        return 404, {'error': 'Not found'}, 'application/json'
+
+    @staticmethod
+    def parameters(changes):
+        """Validate parameter changes from a client.
+
+        @raise ValueError: Not a dict, unknown or read-only key, or a bad value
+        @rtype: dict
+        """
+        if not isinstance(changes, dict):
+            raise ValueError('Parameters must be an object')
+        valid = {}
+        for key, value in changes.items():
+            if key not in _EXTERNAL:
+                raise ValueError('%s cannot be set' % key)
+            valid[key] = _EXTERNAL[key].coerce(value)
+        return valid
+
+    # WebSocket
+    def message(self, topic, value):
+        if topic == TEMPS:
+            return temps_message(self.bus.latest(PARAMETERS, {}).get('target'), value)
+        return value
+
+    def websocket(self, handler):
+        key = handler.headers.getheader('sec-websocket-key')
+        if not key or 'websocket' not in (handler.headers.getheader('upgrade') or '').lower():
+            raise ValueError('Not a WebSocket request')
+        handler.send_response(101, 'Switching Protocols')
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', b64encode(sha1(key + WS_GUID).digest()))
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = 1
+
+        client = Client(self, handler.connection)
+        with self._clients_lock:
+            self.clients.append(client)
+        client.writer.start()
+        try:
+            while not client.closed:
+                opcode, payload = _read_frame(handler.rfile)
+                if opcode == OP_CLOSE:
+                    client.send(payload[:2], OP_CLOSE)
+                    break
+                elif opcode == OP_PING:
+                    client.send(payload, OP_PONG)
+        except (EOFError, ValueError, socket.error):
+            pass
+        finally:
+            client.close()
+            with self._clients_lock:
+                self.clients.remove(client)
+
+    def _notify_clients(self):
+        # Runs on the publishing (control loop) thread: only wakes the writers
+        with self._clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.notify()
+
+    def run(self):
+        logger.info('Serving the dashboard on port %i', self.port)
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self._clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
@@ -89,32 +89,34 @@ function CUpdatePlot() {
 }
 
 
-//Firebase	
-var ControlsRef = Ref.child('Controls');
+//Firebase (the controls plot is not shown in local mode)
+if (typeof PISMOKER_API === 'undefined') {
+	var ControlsRef = Ref.child('Controls');
 
 
-ControlsRef.once("value", function(snapshot) {
-	var Controls = snapshot.val();
-	for (var k in Controls) {
-		u.push([Controls[k].time, Controls[k].u]);
-		P.push([Controls[k].time, Controls[k].P]);
-		I.push([Controls[k].time, Controls[k].I]);
-		D.push([Controls[k].time, Controls[k].D]);
-	}
-	ControlsRef.limitToLast(1).on("child_added", function(snapshot, prevChildKey) { //Establish callback
+	ControlsRef.once("value", function(snapshot) {
 		var Controls = snapshot.val();
-		u.push([Controls.time, Controls.u]);
-		P.push([Controls.time, Controls.P]);
-		I.push([Controls.time, Controls.I]);
-		D.push([Controls.time, Controls.D]);
-		CUpdatePlot()
+		for (var k in Controls) {
+			u.push([Controls[k].time, Controls[k].u]);
+			P.push([Controls[k].time, Controls[k].P]);
+			I.push([Controls[k].time, Controls[k].I]);
+			D.push([Controls[k].time, Controls[k].D]);
+		}
+		ControlsRef.limitToLast(1).on("child_added", function(snapshot, prevChildKey) { //Establish callback
+			var Controls = snapshot.val();
+			u.push([Controls.time, Controls.u]);
+			P.push([Controls.time, Controls.P]);
+			I.push([Controls.time, Controls.I]);
+			D.push([Controls.time, Controls.D]);
+			CUpdatePlot()
 		
+		});
+	});
+	ControlsRef.on("child_removed", function(snapshot, prevChildKey) {
+		u = [];
+		P = [];
+		I = [];
+		D = []; 
+		CUpdatePlot()
 	});
-});
-ControlsRef.on("child_removed", function(snapshot, prevChildKey) {
-	u = [];
-	P = [];
-	I = [];
-	D = []; 
-	CUpdatePlot()
-});
+}
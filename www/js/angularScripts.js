@@ -1,4 +1,6 @@
-var app = angular.module(['PiSmoker'],["firebase",'toggle-switch']);
+var app = angular.module(['PiSmoker'], (typeof PISMOKER_API === 'undefined' ? ["firebase"] : []).concat(['toggle-switch']));
+
+if (typeof PISMOKER_API === 'undefined') {
     app.controller('ProgramController',function($scope, $firebaseArray) {
         this.Program = $firebaseArray(ProgramRef);
 
@@ -41,4 +43,100 @@ var app = angular.module(['PiSmoker'],["firebase",'toggle-switch']);
         $interval(this.CheckActive,3000)
 
 
-    });
\ No newline at end of file
+    });
+} else {
+    //Local mode (see local.js): the same forms on /api and the WebSocket
+    app.controller('ProgramController',function($scope, $http) {
+        var ctrl = this;
+        this.Program = [];
+
+        //The template edits the steps through $save/$remove, as on a $firebaseArray
+        function Load(steps) {
+            steps.$save = Save;
+            steps.$remove = function(step) {
+                steps.splice(steps.indexOf(step), 1);
+                Save();
+            };
+            ctrl.Program = steps;
+        }
+
+        function Reload() {
+            $http.get(PISMOKER_API + '/program').then(function(response) {
+                Load(response.data);
+            });
+        }
+
+        function Save() {
+            $http.put(PISMOKER_API + '/program', angular.toJson(ctrl.Program)).then(null, Reload); //Rejected: show what the smoker has
+        }
+
+        this.add = function add() {
+            ctrl.Program.push({"mode": "Off", "target": 0, "trigger": "Time", "triggerValue": 600});
+            Save();
+        };
+
+        //Steps completing, or programs switching on or off, show up as a new ProgramToggle
+        var toggle = null;
+        LocalSubscribe('parameters', function(P) {
+            if (P.ProgramToggle != toggle) {
+                toggle = P.ProgramToggle;
+                $scope.$apply(Reload);
+            }
+        });
+        Reload();
+    });
+
+    app.controller('ParametersController',function($scope, $http, $interval, $timeout) {
+        var ctrl = this;
+        this.Auth = true; //No login: anyone on the smoker's own network may change settings, as at the LCD
+        this.Active = false;
+
+        var saved = {}; //As the smoker last reported them
+        function Load(P) {
+            saved = angular.copy(P);
+            $scope.Parameters = P;
+        }
+        $http.get(PISMOKER_API + '/parameters').then(function(response) {
+            Load(response.data);
+        });
+        var editing = false; //Form changes not yet sent, or not yet answered: the smoker's updates would undo them
+        LocalSubscribe('parameters', function(P) {
+            if (!editing) {
+                $scope.$apply(function() {
+                    Load(P);
+                });
+            }
+        });
+
+        //Send the settings which were changed on the form, once typing stops
+        var pending = null;
+        $scope.$watch('Parameters', function(P) {
+            var changes = {};
+            var changed = false;
+            PISMOKER_SETTABLE.forEach(function(key) {
+                if (P && key in P && P[key] != saved[key]) { //Loosely: text inputs hold numbers as strings
+                    changes[key] = P[key];
+                    changed = true;
+                }
+            });
+            $timeout.cancel(pending);
+            editing = changed;
+            if (changed) {
+                pending = $timeout(function() {
+                    $http({method: 'PATCH', url: PISMOKER_API + '/parameters', data: changes}).then(function(response) {
+                        angular.extend(saved, response.data);
+                        editing = false;
+                    }, function() {
+                        editing = false; //Rejected: the next update from the smoker resets the form
+                    });
+                }, 500);
+            }
+        }, true);
+
+        this.CheckActive = function CheckActive() {
+            ctrl.Active = T1.length > 0 && ((new Date).getTime() - T1[T1.length-1][0]) < 5000;
+        }
+
+        $interval(this.CheckActive,3000)
+    });
+}
@@ -0,0 +1,59 @@
+//Local mode: temperatures, parameters and the program from the PiSmoker's own web server (see WebServer.py) instead
+//of Firebase
+var LOCAL_WINDOW = 3600 * 16; //Plot the last 16 hours
+var LOCAL_REFRESH = 60 * 15; //Reload the downsampled history this often, rather than keep every live sample
+var LocalListeners = {};
+
+//callback(data) for each WebSocket message of a type ('temps' or 'parameters')
+function LocalSubscribe(type, callback) {
+	(LocalListeners[type] = LocalListeners[type] || []).push(callback);
+}
+
+function LocalTemps() {
+	LocalSubscribe('temps', function(Ts) {
+		T1.push([Ts.time, Ts.T1]);
+		T2.push([Ts.time, Ts.T2]);
+		TT.push([Ts.time, Ts.TT]);
+		LocalTrim();
+		UpdatePlot();
+	});
+	LocalHistory();
+	setInterval(LocalHistory, LOCAL_REFRESH * 1000);
+	LocalSocket();
+}
+
+function LocalHistory() {
+	var since = Date.now() / 1000 - LOCAL_WINDOW;
+	$.getJSON(PISMOKER_API + '/history', {start: since, points: 1000, series: 'grill,meat,target'}, function(H) {
+		T1 = H.grill;
+		T2 = H.meat;
+		TT = H.target;
+		UpdatePlot();
+	});
+}
+
+//Drop points which have left the window
+function LocalTrim() {
+	var since = Date.now() - LOCAL_WINDOW * 1000;
+	[T1, T2, TT].forEach(function(S) {
+		var n = 0;
+		while (n < S.length && S[n][0] < since) {
+			n++;
+		}
+		S.splice(0, n);
+	});
+}
+
+function LocalSocket() {
+	var scheme = location.protocol == 'https:' ? 'wss://' : 'ws://';
+	var ws = new WebSocket(scheme + location.host + '/ws');
+	ws.onmessage = function(event) {
+		var msg = JSON.parse(event.data);
+		(LocalListeners[msg.type] || []).forEach(function(callback) {
+			callback(msg.data);
+		});
+	};
+	ws.onclose = function() {
+		setTimeout(LocalSocket, 5000); //Reconnect, e.g. after the phone slept
+	};
+}
@@ -152,40 +152,49 @@ var gM = new JustGage({
 });
 
 
-//Firebase	
-var Ref = new Firebase('https://pismoker.firebaseio.com/');
-var TempsRef = Ref.child('Temps');
-var ParametersRef = Ref.child('Parameters');
-var ProgramRef = Ref.child('Program');
+//Firebase, unless the page is served by the PiSmoker itself (api/config.js, see local.js)
+if (typeof PISMOKER_API === 'undefined') {
+	var Ref = new Firebase('https://pismoker.firebaseio.com/');
+	var TempsRef = Ref.child('Temps');
+	var ParametersRef = Ref.child('Parameters');
+	var ProgramRef = Ref.child('Program');
 
-TempsRef.limitToLast(3600/3*16).once("value", function(snapshot) { //Limit to last 16 hours
-	var Ts = snapshot.val();
-	for (var k in Ts) {
-		T1.push([Ts[k].time, Ts[k].T1]);
-		T2.push([Ts[k].time, Ts[k].T2]);
-		TT.push([Ts[k].time, Ts[k].TT]);
-	}
-	TempsRef.limitToLast(1).on("child_added", function(snapshot, prevChildKey) { //Establish callback
+	TempsRef.limitToLast(3600/3*16).once("value", function(snapshot) { //Limit to last 16 hours
 		var Ts = snapshot.val();
-		T1.push([Ts.time, Ts.T1])
-		T2.push([Ts.time, Ts.T2])
-		TT.push([Ts.time, Ts.TT])
-		UpdatePlot()
+		for (var k in Ts) {
+			T1.push([Ts[k].time, Ts[k].T1]);
+			T2.push([Ts[k].time, Ts[k].T2]);
+			TT.push([Ts[k].time, Ts[k].TT]);
+		}
+		TempsRef.limitToLast(1).on("child_added", function(snapshot, prevChildKey) { //Establish callback
+			var Ts = snapshot.val();
+			T1.push([Ts.time, Ts.T1])
+			T2.push([Ts.time, Ts.T2])
+			TT.push([Ts.time, Ts.TT])
+			UpdatePlot()
+		});
+		UpdatePlot();
 	});
-	UpdatePlot();
-});
-TempsRef.on("child_removed", function(snapshot, prevChildKey) {
-  T1 = []
-  T2 = []
-  TT = []  
-  UpdatePlot()
-});
-
+	TempsRef.on("child_removed", function(snapshot, prevChildKey) {
+	  T1 = []
+	  T2 = []
+	  TT = []  
+	  UpdatePlot()
+	});
+} else {
+	LocalTemps();
+}
 
 
 function clearData() {
-	TempsRef.remove();
-	ControlsRef.remove();
+	if (typeof PISMOKER_API === 'undefined') {
+		TempsRef.remove();
+		ControlsRef.remove();
+	} else {
+		//The cook log keeps every sample, only the plot is cleared
+		T1.length = T2.length = TT.length = 0;
+		UpdatePlot();
+	}
 }
 
 
@@ -0,0 +1,22 @@
+#!/bin/sh
+# Fetch the web UI's libraries into www/lib (and Bootstrap's icon font into www/fonts), so the dashboard served by
+# WebServer.py works on the smoker's own network with no internet connection.  Run once while online.
+cd "$(dirname "$0")" || exit 1
+mkdir -p ../fonts
+
+fetch() {
+    curl -fsSL -o "$1" "$2" || echo "Could not fetch $2"
+}
+
+fetch bootstrap.min.css https://netdna.bootstrapcdn.com/bootstrap/3.0.3/css/bootstrap.min.css
+for ext in eot svg ttf woff; do
+    fetch ../fonts/glyphicons-halflings-regular.$ext \
+        https://netdna.bootstrapcdn.com/bootstrap/3.0.3/fonts/glyphicons-halflings-regular.$ext
+done
+fetch jquery.min.js https://cdnjs.cloudflare.com/ajax/libs/jquery/1.11.3/jquery.min.js
+fetch jquery.flot.min.js https://cdnjs.cloudflare.com/ajax/libs/flot/0.8.3/jquery.flot.min.js
+fetch jquery.flot.time.min.js https://cdnjs.cloudflare.com/ajax/libs/flot/0.8.3/jquery.flot.time.min.js
+fetch raphael-min.js https://cdnjs.cloudflare.com/ajax/libs/raphael/2.1.4/raphael-min.js
+fetch angular.js https://cdnjs.cloudflare.com/ajax/libs/angular.js/1.5.0-beta.2/angular.js
+fetch firebase.js https://cdn.firebase.com/js/client/2.2.1/firebase.js
+fetch angularfire.min.js https://cdn.firebase.com/libs/angularfire/1.1.3/angularfire.min.js